@@ -1,5 +1,9 @@
 import logging
 
+from os import path
+from time import time
+
+from lakesuperior.api import query
 from lakesuperior.env import env
 from lakesuperior.store.ldp_rs.lmdb_store import TxnManager
 
@@ -17,11 +21,110 @@ def stats():
     '''
     Get repository statistics.
 
-    @return dict Store statistics, resource statistics.
+    @return dict Store statistics, resource statistics, SPARQL result cache
+    statistics.
     '''
     repo_stats = {'rsrc_stats': env.app_globals.rdfly.count_rsrc()}
     with TxnManager(env.app_globals.rdf_store) as txn:
         repo_stats['store_stats'] = env.app_globals.rdf_store.stats()
+    repo_stats['query_cache_stats'] = query.result_cache.stats()
 
     return repo_stats
 
+
+def migrate_terms():
+    '''
+    Convert the stored RDF terms from the legacy pickle format to the binary
+    term format.
+
+    The repository should not be serving requests while this runs.
+
+    @return int Number of converted terms.
+    '''
+    return env.app_globals.rdf_store.migrate_term_format()
+
+
+def migrate_keys(key_format='fixed'):
+    '''
+    Convert the stored triple keys to a different key format.
+
+    The repository should not be serving requests while this runs.
+
+    @param key_format (string) Format to convert to. See
+    `LmdbStore.KEY_FORMATS`.
+
+    @return int Number of converted triple keys.
+    '''
+    return env.app_globals.rdf_store.migrate_key_format(key_format)
+
+
+def checkpoint():
+    '''
+    Flush all committed transactions to disk.
+
+    Only needed if the store is not synced on each commit, e.g. with the
+    `fast-ingest` LMDB profile.
+    '''
+    env.app_globals.rdf_store.checkpoint()
+
+
+def cleanup(compact=True):
+    '''
+    Delete terms not used by any triple from the graph store, and compact
+    the store files.
+
+    The repository should not be serving requests while this runs.
+
+    @param compact (bool) Whether to compact the store files.
+
+    @return dict Number of deleted terms; store size in bytes before and
+    after compaction.
+    '''
+    store = env.app_globals.rdf_store
+    ret = {'orphan_terms': store.remove_orphan_terms()}
+    if compact:
+        ret['size_before'], ret['size_after'] = store.compact()
+
+    return ret
+
+
+def reindex(workers=None):
+    '''
+    Rebuild the graph store indices from the main data.
+
+    The repository should not be serving requests while this runs.
+
+    @param workers (int) Number of worker processes. By default, one per CPU.
+
+    @return int Number of indexed triples.
+    '''
+    return env.app_globals.rdf_store.rebuild_indices(workers)
+
+
+def backup(dest):
+    '''
+    Copy the graph and binary stores to a folder while the repository is
+    running.
+
+    The graph store is copied first, so any binary file referenced by the
+    copy is also copied.
+
+    @param dest (string) Destination folder. Each store is copied into a
+    subfolder with the name of its folder in the repository.
+
+    @return dict Number of bytes copied and copy speed in bytes per second.
+    '''
+    rdf_store = env.app_globals.rdf_store
+    nonrdfly = env.app_globals.nonrdfly
+    start = time()
+    size = rdf_store.backup(path.join(
+            dest, path.basename(path.normpath(rdf_store.path))))
+    size += nonrdfly.backup(path.join(
+            dest, path.basename(path.normpath(nonrdfly.root))))
+    elapsed = time() - start
+
+    return {
+        'bytes': size,
+        'seconds': elapsed,
+        'bytes_per_second': size / elapsed if elapsed else None,
+    }
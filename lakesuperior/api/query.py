@@ -1,32 +1,577 @@
+import csv
+import json
 import logging
+import re
+import threading
 
-from io import BytesIO
+from contextlib import contextmanager
+from io import BytesIO, StringIO
+from itertools import chain, islice
+
+from rdflib import BNode, Literal, URIRef
+from rdflib.namespace import XSD
 
 from lakesuperior.dictionaries.namespaces import ns_collection as nsc
 from lakesuperior.dictionaries.namespaces import ns_mgr as nsm
 from lakesuperior.env import env
-from lakesuperior.store.ldp_rs.lmdb_store import LmdbStore, TxnManager
+from lakesuperior.exceptions import QueryAbortedError, QueryFormatError
+from lakesuperior.store.ldp_rs import term_codec
+from lakesuperior.store.ldp_rs.lmdb_store import (
+        LmdbStore, LruCache, QueryBudget, TxnManager)
 
 
 logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger('lakesuperior.slow_queries')
 rdfly = env.app_globals.rdfly
 rdf_store = env.app_globals.rdf_store
 
+'''
+Formats that the results of `sparql_query_stream` can be serialized into, and
+the query types that each format applies to.
+'''
+STREAM_FORMATS = {
+    'csv': ('SELECT',),
+    'tsv': ('SELECT',),
+    'json': ('SELECT', 'ASK'),
+    'nt': ('CONSTRUCT', 'DESCRIBE'),
+}
+
+'''Number of serialized rows or triples in each chunk of a streamed result.'''
+STREAM_CHUNK_ROWS = 1000
+
+'''
+Parts of a query that are kept verbatim when normalizing it for the result
+cache: string literals and IRIs. Everything else matched is whitespace or
+comments.
+'''
+_query_tokens = re.compile(r'''
+    (?P<keep>
+        """(?:[^"\\]|\\.|"(?!""))*"""
+        | \'\'\'(?:[^'\\]|\\.|'(?!''))*\'\'\'
+        | "(?:[^"\\\n]|\\.)*"
+        | '(?:[^'\\\n]|\\.)*'
+        | <[^<>"{}|^`\\\s]*>
+    )
+    | (?:\s|\#[^\n]*)+
+''', re.X)
+
+'''
+Functions and clauses whose results can change without any change to the
+store. Queries using them are not cached.
+'''
+_volatile = re.compile(
+        r'\b(?:NOW|RAND|UUID|STRUUID|BNODE)\s*\(|\bSERVICE\b', re.I)
+
+
+class ResultCache(LruCache):
+    '''
+    Cache of serialized SPARQL query results.
+
+    Each entry is tagged with the generation of the store (see
+    `LmdbStore.generation`) that it was computed from, and is only returned
+    for the same generation: any commit to the store, from any process,
+    invalidates all the entries. A lookup only reads the generation, and does
+    not open a transaction.
+
+    The cache is bounded both by the number of entries and by the total size
+    of the results.
+    '''
+    def __init__(self, size, max_bytes):
+        '''
+        @param size (int) Maximum number of entries. If 0, nothing is ever
+        cached.
+        @param max_bytes (int) Maximum total size of the cached results.
+        '''
+        super().__init__(size)
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.generation = None
+        self._lock = threading.Lock()
+
+
+    @staticmethod
+    def key(qry_str, fmt, bindings=None, limit=None):
+        '''
+        Cache key of a query.
+
+        The key is made of the query text with comments removed and
+        whitespace collapsed, and of the other parameters of the query.
+
+        @param qry_str (string | bytes) SPARQL query.
+        @param fmt (string) Serialization format.
+        @param bindings (dict | None) Initial variable bindings.
+        @param limit (int | None) Maximum number of results.
+
+        @return tuple | None The key, or None if the results of the query
+        cannot be cached.
+        '''
+        if isinstance(qry_str, bytes):
+            qry_str = qry_str.decode('UTF-8')
+        # Literals and IRIs are left out of the search for volatile functions.
+        if _volatile.search(_query_tokens.sub(' ', qry_str)):
+            return None
+        norm = _query_tokens.sub(
+                lambda m: m.group('keep') or ' ', qry_str).strip()
+
+        return norm, fmt, frozenset((bindings or {}).items()), limit
+
+
+    def get(self, key, generation):
+        '''
+        Get cached results.
+
+        @param key (tuple) Cache key, as returned by `key`.
+        @param generation (tuple) Current store generation.
+
+        @return bytes | None The serialized results, or None if the query is
+        not cached or was cached for a different generation.
+        '''
+        try:
+            entry_gen, out = self._data[key]
+            self._data.move_to_end(key)
+        except KeyError:
+            entry_gen = None
+        if entry_gen != generation:
+            self.misses += 1
+            return None
+        self.hits += 1
+
+        return out
+
+
+    def put(self, key, generation, out):
+        '''
+        Cache results, evicting the oldest ones if the cache is full.
+
+        Entries of older generations are dropped as soon as results of a
+        newer one are added. Results computed from an older generation than
+        the cached ones are not added.
+
+        @param key (tuple) Cache key, as returned by `key`.
+        @param generation (tuple) Store generation that the results were
+        computed from.
+        @param out (bytes) Serialized results.
+        '''
+        if not self.size or len(out) > self.max_bytes:
+            return
+        with self._lock:
+            if generation != self.generation:
+                if self.generation is not None and generation < self.generation:
+                    return
+                self._data.clear()
+                self.bytes = 0
+                self.generation = generation
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old[1])
+            self._data[key] = (generation, out)
+            self.bytes += len(out)
+            while len(self._data) > self.size or self.bytes > self.max_bytes:
+                self.bytes -= len(self._data.popitem(last=False)[1][1])
+
+
+    def clear(self):
+        '''
+        Empty the cache. The hit and miss counters are preserved.
+        '''
+        with self._lock:
+            super().clear()
+            self.bytes = 0
+
+
+    def stats(self):
+        '''
+        Cache usage statistics.
+
+        @return dict
+        '''
+        stats = super().stats()
+        stats['bytes'] = self.bytes
+        stats['max_bytes'] = self.max_bytes
+
+        return stats
+
 
-def sparql_query(qry_str, fmt):
+result_cache = ResultCache(
+        rdfly.config.get('sparql_cache_size', 0),
+        rdfly.config.get('sparql_cache_max_bytes', 0))
+
+
+def sparql_query(qry_str, fmt, bindings=None):
     '''
     Send a SPARQL query to the triplestore.
 
+    Results are cached in `result_cache` until the store changes. The query
+    is aborted if it exceeds the `sparql_timeout` or `sparql_row_budget`
+    configuration values (see `lmdb_store.QueryBudget`).
+
     @param qry_str (str) SPARQL query string. SPARQL 1.1 Query Language
     (https://www.w3.org/TR/sparql11-query/) is supported.
     @param fmt(string) Serialization format. This varies depending on the
     query type (SELECT, ASK, CONSTRUCT, etc.). [@TODO Add reference to RDFLib
     serialization formats]
+    @param bindings (dict | None) Initial variable bindings.
 
     @return BytesIO
+
+    @raise InvalidQueryError If the query cannot be parsed.
+    '''
+    key, generation, out = _cache_lookup(qry_str, fmt, bindings)
+    if out is None:
+        qry = rdfly.prepare_query(qry_str)
+        with TxnManager(rdf_store) as txn, _query_budget(qry_str):
+            qres = rdfly.raw_query(qry, bindings)
+            out = qres.serialize(format=fmt)
+        if key:
+            result_cache.put(key, generation, out)
+
+    return BytesIO(out)
+
+
+def sparql_query_stream(qry_str, fmt, limit=None, bindings=None):
+    '''
+    Send a SPARQL query to the triplestore and stream the serialized results.
+
+    The query is parsed and evaluated up to its first chunk of results right
+    away, so that syntax errors, unsupported formats and queries aborted
+    early are raised before any output. The other results are only computed
+    and serialized as the returned generator is consumed, within a read
+    transaction of their own that is held until the generator is exhausted
+    or closed. No more than a chunk of the serialized results is kept in
+    memory, except for results small enough to be added to `result_cache`.
+
+    The query is subject to the same limits as in `sparql_query`, which can
+    also abort it while its results are being consumed. The time spent
+    waiting for the consumer to take each chunk is not part of the
+    `sparql_timeout` limit, but the whole transaction, including that time,
+    is limited by `sparql_stream_timeout`. When a limit is exceeded after the
+    first chunk, the output is cut short.
+
+    @param qry_str (str) SPARQL query string.
+    @param fmt (string) Serialization format: one of the keys of
+    `STREAM_FORMATS`.
+    @param limit (int | None) Maximum number of rows (SELECT) or triples
+    (CONSTRUCT, DESCRIBE) to return. If None, the `sparql_row_limit`
+    configuration value is used. 0 means no limit.
+    @param bindings (dict | None) Initial variable bindings.
+
+    @return generator(bytes) Chunks of the serialized results.
+
+    @raise InvalidQueryError If the query cannot be parsed.
+    @raise QueryFormatError If the results of the query cannot be serialized
+    in the requested format.
+    '''
+    if fmt not in STREAM_FORMATS:
+        raise QueryFormatError('Format {} cannot be streamed.'.format(fmt))
+    if limit is None:
+        limit = rdfly.config.get('sparql_row_limit', 0)
+    key, generation, out = _cache_lookup(qry_str, fmt, bindings, limit)
+    if out is not None:
+        return iter((out,))
+
+    qry = rdfly.prepare_query(qry_str)
+    qtype = qry.algebra.name.replace('Query', '').upper()
+    if qtype not in STREAM_FORMATS[fmt]:
+        raise QueryFormatError(
+                '{} results cannot be serialized as {}.'.format(qtype, fmt))
+
+    out = _stream_results(qry_str, qry, fmt, limit, bindings, key, generation)
+
+    return _resume(next(out, None), out)
+
+
+def term_search(term, prop=None, cmp='~'):
     '''
+    Search resources by the value of their properties.
+
+    @param term (string) Search term.
+    @param prop (string | None) Property to search, as a full URI or a
+    prefixed name with one of the configured prefixes. If None, all
+    properties are searched.
+    @param cmp (string) Comparison between the values and the term: `~`
+    matches values containing all the words of the term; `^` also matches
+    words starting with the ones of the term. `>`, `<` and `<>` compare
+    numbers, dates and date-times by value; the term is read as an integer,
+    a decimal, an `xsd:date` or an `xsd:dateTime`, in this order of
+    preference, and only values of the same kind match.
+
+    @return list(tuple) UID, property and value of each match.
+    '''
+    if prop:
+        pfx, _, local = prop.partition(':')
+        if pfx in nsc and not local.startswith('//'):
+            prop = nsc[pfx][local]
+        else:
+            prop = URIRef(prop)
+
+    if cmp in ('>', '<', '<>'):
+        value = _typed_literal(term)
+        with TxnManager(rdf_store) as txn:
+            below = rdfly.search_values(
+                    high=value, prop=prop or None, incl_high=False)
+            above = rdfly.search_values(
+                    low=value, prop=prop or None, incl_low=False)
+            if cmp == '>':
+                return list(above)
+            elif cmp == '<':
+                return list(below)
+            else:
+                return list(chain(below, above))
+
+    if cmp not in ('~', '^'):
+        raise ValueError(
+                'Comparison operator \'{}\' is not supported.'.format(cmp))
+
     with TxnManager(rdf_store) as txn:
-        qres = rdfly.raw_query(qry_str)
-        out_stream = BytesIO(qres.serialize(format=fmt))
+        return list(rdfly.search_literals(term, prop or None, cmp == '^'))
+
+
+def _typed_literal(term):
+    '''
+    Convert a search term into a literal that can be compared by value.
+
+    @param term (string) Search term.
+
+    @return rdflib.Literal
+    '''
+    for datatype in (XSD.integer, XSD.decimal, XSD.date, XSD.dateTime):
+        value = Literal(term.strip(), datatype=datatype)
+        if term_codec.value_key(value) is not None:
+            return value
 
-    return out_stream
+    raise ValueError(
+            '\'{}\' is not a number, date or date-time.'.format(term))
+
+
+def _cache_lookup(qry_str, fmt, bindings=None, limit=None):
+    '''
+    Look up the results of a query in `result_cache`.
+
+    Queries run within an open transaction are not cached, since they may
+    see uncommitted changes or an older snapshot than the current generation.
+
+    @return tuple Cache key, or None if the results cannot be cached; store
+    generation; and cached results, or None if they are not cached.
+    '''
+    if not result_cache.size or rdf_store.is_txn_open:
+        return None, None, None
+    key = result_cache.key(qry_str, fmt, bindings, limit)
+    if key is None:
+        return None, None, None
+    # The generation is read before the query transaction is opened, so
+    # that the results are never tagged with an older one than their data.
+    generation = rdf_store.generation
+
+    return key, generation, result_cache.get(key, generation)
+
+
+@contextmanager
+def _query_budget(qry_str, max_duration=None):
+    '''
+    Apply the configured limits to a query, and log it if it is slow or
+    aborted.
+
+    @param qry_str (string | bytes) SPARQL query, for the log.
+    @param max_duration (float | None) Limit of the total time of the query,
+    including the time spent with the budget paused. See `QueryBudget`.
+    '''
+    budget = QueryBudget(
+            rdf_store, rdfly.config.get('sparql_timeout', 0),
+            rdfly.config.get('sparql_row_budget', 0), max_duration)
+    slow_time = rdfly.config.get('sparql_slow_query_time', 0)
+    try:
+        with budget:
+            yield budget
+    except QueryAbortedError as e:
+        slow_query_logger.warning(
+                '{} Time: {:.3f} s. Triples read: {}. Query: {}'.format(
+                    e, budget.elapsed, budget.rows, _log_query(qry_str)))
+        raise
+    if slow_time and budget.elapsed >= slow_time:
+        slow_query_logger.info(
+                'Slow query. Time: {:.3f} s. Triples read: {}. '
+                'Query: {}'.format(
+                    budget.elapsed, budget.rows, _log_query(qry_str)))
+
+
+def _log_query(qry_str):
+    '''
+    Query text on a single line.
+    '''
+    if isinstance(qry_str, bytes):
+        qry_str = qry_str.decode('UTF-8', 'replace')
+
+    return ' '.join(qry_str.split())
+
+
+def _resume(first, rest):
+    '''
+    Generate an item taken from a generator, then the rest of the generator.
+
+    Closing this generator closes the other one.
+
+    @param first Item already generated, or None if there was none.
+    @param rest (generator) Generator of the other items.
+    '''
+    if first is not None:
+        yield first
+    yield from rest
+
+
+def _stream_results(qry_str, qry, fmt, limit, bindings, key, generation):
+    '''
+    Evaluate a query and serialize its results in chunks.
+
+    The results are added to `result_cache` if they have a key and fit in
+    it.
+
+    See `sparql_query_stream`.
+    '''
+    cached = [] if key else None
+    cached_size = 0
+    # Most of this runs while the response is being sent, after the request
+    # has been handled, so it opens a transaction of its own.
+    max_duration = rdfly.config.get('sparql_stream_timeout', 0)
+    with TxnManager(rdf_store) as txn, \
+            _query_budget(qry_str, max_duration) as budget:
+        qtype, qvars, results = rdfly.stream_query(qry, bindings)
+        if limit and qtype != 'ASK':
+            all_results = results
+            results = islice(all_results, limit)
+
+        if fmt == 'csv':
+            out = _csv_rows(qvars, results)
+        elif fmt == 'tsv':
+            out = _tsv_rows(qvars, results)
+        elif fmt == 'json':
+            out = _json_rows(qtype, qvars, results)
+        else:
+            out = _nt_rows(results)
+
+        while True:
+            chunk = ''.join(islice(out, STREAM_CHUNK_ROWS)).encode('UTF-8')
+            if not chunk:
+                break
+            if cached is not None:
+                cached_size += len(chunk)
+                if cached_size > result_cache.max_bytes:
+                    cached = None
+                else:
+                    cached.append(chunk)
+            # The time taken by the client to read the results is not part
+            # of the query time, but it is part of the time that the
+            # transaction is held.
+            with budget.paused():
+                yield chunk
+            budget.check()
+
+        if limit and qtype != 'ASK' and next(all_results, None) is not None:
+            logger.warning('Query results truncated to {} rows.'.format(limit))
+
+    if cached is not None:
+        result_cache.put(key, generation, b''.join(cached))
+
+
+def _csv_rows(qvars, results):
+    '''
+    Serialize SELECT results as SPARQL 1.1 CSV.
+
+    @return generator(string) Header line and one line per result.
+    '''
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([str(var) for var in qvars])
+    yield buf.getvalue()
+    for row in results:
+        buf.seek(0)
+        buf.truncate()
+        writer.writerow([
+            '' if term is None
+            else '_:' + term if isinstance(term, BNode)
+            else str(term)
+            for term in (row.get(var) for var in qvars)])
+        yield buf.getvalue()
+
+
+def _tsv_rows(qvars, results):
+    '''
+    Serialize SELECT results as SPARQL 1.1 TSV.
+
+    @return generator(string) Header line and one line per result.
+    '''
+    yield '\t'.join('?' + var for var in qvars) + '\n'
+    for row in results:
+        yield '\t'.join(
+            '' if term is None else _nt_term(term)
+            for term in (row.get(var) for var in qvars)) + '\n'
+
+
+def _json_rows(qtype, qvars, results):
+    '''
+    Serialize SELECT or ASK results as SPARQL 1.1 JSON.
+
+    @return generator(string) Head of the document, one binding per result
+    and closing brackets.
+    '''
+    if qtype == 'ASK':
+        yield '{{"head": {{}}, "boolean": {}}}'.format(
+                json.dumps(next(results)))
+        return
+
+    yield '{{"head": {{"vars": {}}}, "results": {{"bindings": [\n'.format(
+            json.dumps([str(var) for var in qvars]))
+    sep = ''
+    for row in results:
+        yield sep + json.dumps({
+            str(var): _json_term(row[var])
+            for var in qvars if row.get(var) is not None})
+        sep = ',\n'
+    yield '\n]}}'
+
+
+def _nt_rows(results):
+    '''
+    Serialize triples as N-Triples.
+
+    @return generator(string) One line per triple.
+    '''
+    for trp in results:
+        yield ' '.join(_nt_term(term) for term in trp) + ' .\n'
+
+
+def _nt_term(term):
+    '''
+    N-Triples representation of a term.
+
+    Unlike `rdflib.term.Identifier.n3`, this never uses the long literal
+    syntax, and escapes tabs so that terms can be used in TSV.
+    '''
+    if isinstance(term, Literal):
+        out = '"{}"'.format(
+                term.replace('\\', '\\\\').replace('"', '\\"')
+                .replace('\n', '\\n').replace('\r', '\\r')
+                .replace('\t', '\\t'))
+        if term.language:
+            return out + '@' + term.language
+        elif term.datatype:
+            return out + '^^<{}>'.format(term.datatype)
+        return out
+    elif isinstance(term, BNode):
+        return '_:' + term
+    return '<{}>'.format(term)
+
+
+def _json_term(term):
+    '''
+    SPARQL 1.1 JSON representation of a term.
+    '''
+    if isinstance(term, Literal):
+        out = {'type': 'literal', 'value': str(term)}
+        if term.language:
+            out['xml:lang'] = term.language
+        elif term.datatype:
+            out['datatype'] = str(term.datatype)
+        return out
+    elif isinstance(term, BNode):
+        return {'type': 'bnode', 'value': str(term)}
+    return {'type': 'uri', 'value': str(term)}
@@ -1,11 +1,16 @@
 import logging
 
-from flask import Blueprint, current_app, request, render_template, send_file
+from flask import (
+        Blueprint, Response, current_app, jsonify, request, render_template,
+        send_file)
 from rdflib.plugin import PluginException
 
 from lakesuperior.env import env
 from lakesuperior.dictionaries.namespaces import ns_mgr as nsm
 from lakesuperior.api import query as query_api
+from lakesuperior.exceptions import (
+        InvalidQueryError, QueryFormatError, QueryRowLimitError,
+        QueryTimeoutError)
 
 # Query endpoint. raw SPARQL queries exposing the underlying layout can be made
 # available. Also convenience methods that allow simple lookups based on simple
@@ -22,20 +27,37 @@ query = Blueprint('query', __name__)
 def term_search():
     '''
     Search by entering a search term and optional property and comparison term.
+
+    Results are returned as JSON if requested in the `Accept` header.
     '''
     valid_operands = (
-        ('=', 'Equals'),
+        ('~', 'Contains Words'),
+        ('^', 'Contains Words Starting With'),
         ('>', 'Greater Than'),
         ('<', 'Less Than'),
         ('<>', 'Not Equal'),
-        ('a', 'RDF Type'),
     )
 
     term = request.args.get('term')
-    prop = request.args.get('prop', default=1)
-    cmp = request.args.get('cmp', default='=')
+    prop = request.args.get('prop')
+    cmp = request.args.get('cmp', default='~')
+
+    results = None
+    if term:
+        try:
+            results = query_api.term_search(term, prop, cmp)
+        except ValueError as e:
+            return str(e), 400
 
-    return render_template('term_search.html')
+    if request.accept_mimetypes.best_match(
+            ('text/html', 'application/json')) == 'application/json':
+        return jsonify([
+            {'uid': uid, 'prop': str(p), 'value': str(o)}
+            for uid, p, o in results or ()])
+
+    return render_template(
+            'term_search.html', operands=valid_operands, term=term,
+            prop=prop, cmp=cmp, results=results, nsm=nsm)
 
 
 @query.route('/sparql', methods=['GET', 'POST'])
@@ -43,12 +65,24 @@ def sparql():
     '''
     Perform a direct SPARQL query on the underlying triplestore.
 
+    Results in one of `query_api.STREAM_FORMATS` are streamed as they are
+    computed. Queries that cannot be parsed are rejected with a 400 status,
+    and results that cannot be serialized in the accepted format with a 406
+    status. Queries exceeding the configured time limit are aborted with a
+    408 status, and queries reading too many triples with a 503 status,
+    unless they have already started sending results, in which case the
+    response is cut short. Streamed results are also cut short past the
+    `sparql_stream_timeout` limit, which includes the time spent sending
+    them.
+
     @param qry SPARQL query string.
     '''
     accept_mimetypes = {
         'text/csv': 'csv',
+        'text/tab-separated-values': 'tsv',
         'application/sparql-results+json': 'json',
         'application/sparql-results+xml': 'xml',
+        'application/n-triples': 'nt',
     }
     if request.method == 'GET':
         return render_template('sparql_query.html', nsm=nsm)
@@ -65,9 +99,21 @@ def sparql():
                 else request.accept_mimetypes.best)
 
         try:
+            if fmt in query_api.STREAM_FORMATS:
+                out_stream = query_api.sparql_query_stream(qstr, fmt)
+                return Response(out_stream, mimetype=match), 200
+
             out_stream = query_api.sparql_query(qstr, fmt)
+        except InvalidQueryError as e:
+            return str(e), 400
+        except QueryFormatError as e:
+            return str(e), 406
         except PluginException:
             return (
                 'Unable to serialize results into format {}'.format(fmt), 406)
+        except QueryTimeoutError as e:
+            return str(e), 408
+        except QueryRowLimitError as e:
+            return str(e), 503
 
     return send_file(out_stream, mimetype=fmt), 200
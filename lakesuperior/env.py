@@ -17,9 +17,39 @@ e.g.:
 
 This is automated in non-test environments by importing
 `lakesuperior.env_setup`.
+
+Values related to a single request, such as the transaction timestamp, are
+kept separately for each thread (or greenlet, if threads are patched by
+gevent), so that concurrent requests do not overwrite each other's.
 '''
+
+def _thread_local_attr(name):
+    '''
+    Property stored in the thread-local namespace of an `Env` instance.
+    '''
+    def fget(self):
+        try:
+            return getattr(self._local, name)
+        except AttributeError:
+            raise AttributeError(name) from None
+
+    def fset(self, val):
+        setattr(self._local, name, val)
+
+    def fdel(self):
+        try:
+            delattr(self._local, name)
+        except AttributeError:
+            raise AttributeError(name) from None
+
+    return property(fget, fset, fdel)
+
+
 class Env:
-    pass
+    timestamp = _thread_local_attr('timestamp')
+    timestamp_term = _thread_local_attr('timestamp_term')
+
+    def __init__(self):
+        self._local = threading.local()
 
 env = Env()
-#env = threading.local()
@@ -163,3 +163,62 @@ class TombstoneError(RuntimeError):
             'To resurrect this resource, send a POST request to its tombstone.'
             .format(self.uid, self.ts)
         )
+
+
+class QueryAbortedError(RuntimeError):
+    '''
+    Raised when a query exceeds its time or row budget and is aborted.
+    '''
+    def __init__(self, limit, elapsed, rows):
+        self.limit = limit
+        self.elapsed = elapsed
+        self.rows = rows
+
+
+
+class QueryTimeoutError(QueryAbortedError):
+    '''
+    Raised when a query runs longer than the time allowed.
+
+    This usually surfaces at the HTTP level as a 408.
+    '''
+    def __str__(self):
+        return 'Query aborted after exceeding the time limit of {} s.'.format(
+                self.limit)
+
+
+
+class QueryRowLimitError(QueryAbortedError):
+    '''
+    Raised when a query reads more triples from the store than allowed.
+
+    This usually surfaces at the HTTP level as a 503.
+    '''
+    def __str__(self):
+        return (
+            'Query aborted after reading more than {} triples from the '
+            'store.'.format(self.limit))
+
+
+
+class InvalidQueryError(RuntimeError):
+    '''
+    Raised when a SPARQL query cannot be parsed.
+
+    This usually surfaces at the HTTP level as a 400.
+    '''
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return 'Invalid query: {}'.format(self.msg)
+
+
+
+class QueryFormatError(RuntimeError):
+    '''
+    Raised when the results of a query cannot be serialized in the requested
+    format.
+
+    This usually surfaces at the HTTP level as a 406.
+    '''
@@ -41,6 +41,18 @@ class BaseNonRdfLayout(metaclass=ABCMeta):
         pass
 
 
+    @abstractmethod
+    def backup(self, dest):
+        '''
+        Copy all the stored files to a folder while the store is in use.
+
+        @param dest (string) Destination folder.
+
+        @return int Size of the copied files in bytes.
+        '''
+        pass
+
+
     @abstractmethod
     def local_path(self, uuid):
         '''
@@ -87,6 +87,45 @@ class DefaultLayout(BaseNonRdfLayout):
         os.unlink(self.local_path(uuid))
 
 
+    def backup(self, dest):
+        '''
+        See BaseNonRdfLayout.backup.
+
+        Stored files are never modified, since their path is their checksum,
+        so they are hard-linked into the destination rather than copied. If
+        the destination is on a different file system, they are copied.
+        Incomplete uploads in the `tmp` folder are skipped, and so are files
+        deleted while the backup runs. Files already in the destination have
+        the same content, and are counted in the size of the backup.
+        '''
+        size = 0
+        for src_dir, dirs, files in os.walk(self.root):
+            rel_dir = os.path.relpath(src_dir, self.root)
+            if rel_dir == 'tmp':
+                dirs.clear()
+                files = []
+            dest_dir = os.path.normpath(os.path.join(dest, rel_dir))
+            os.makedirs(dest_dir, exist_ok=True)
+            for fname in files:
+                src = os.path.join(src_dir, fname)
+                dst = os.path.join(dest_dir, fname)
+                try:
+                    os.link(src, dst)
+                except FileExistsError:
+                    pass
+                except FileNotFoundError:
+                    # Purged since the folder was listed.
+                    continue
+                except OSError:
+                    try:
+                        shutil.copy2(src, dst)
+                    except FileNotFoundError:
+                        continue
+                size += os.stat(dst).st_size
+
+        return size
+
+
     ## PROTECTED METHODS ##
 
     def local_path(self, uuid):
@@ -1,8 +1,15 @@
 import hashlib
 import logging
+import multiprocessing
 import os
-
-from contextlib import ContextDecorator, ExitStack
+import re
+import threading
+import time
+
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ContextDecorator, ExitStack, contextmanager
+from itertools import islice
 from os import makedirs
 from os.path import exists, abspath
 from shutil import rmtree
@@ -10,10 +17,13 @@ from urllib.request import pathname2url
 
 import lmdb
 
-from rdflib import Graph, Namespace, URIRef, Variable
+from rdflib import Graph, Literal, Namespace, URIRef, Variable
 from rdflib.graph import DATASET_DEFAULT_GRAPH_ID as RDFLIB_DEFAULT_GRAPH_URI
 from rdflib.store import Store, VALID_STORE, NO_STORE
 
+from lakesuperior.exceptions import QueryRowLimitError, QueryTimeoutError
+from lakesuperior.store.ldp_rs import term_codec
+
 
 logger = logging.getLogger(__name__)
 
@@ -32,6 +42,20 @@ def b2s(u, enc='UTF-8'):
     return bytes(u).decode(enc)
 
 
+def _hash_terms(algo, terms):
+    '''
+    Hash serialized terms.
+
+    This runs in a separate process during an index rebuild.
+
+    @param algo (string) Hash algorithm name.
+    @param terms (list(tuple(bytes))) Key and serialized term pairs.
+
+    @return list(tuple(bytes)) Hash and key pairs.
+    '''
+    return [(hashlib.new(algo, st).digest(), tk) for tk, st in terms]
+
+
 class TxnManager(ContextDecorator):
     '''
     Handle ACID transactions with an LmdbStore.
@@ -43,6 +67,10 @@ class TxnManager(ContextDecorator):
     >>>
 
     The transaction will be opened and handled automatically.
+
+    If a transaction is already open in the current thread, it is reused and
+    left for the outer context to commit or roll back. A read-write context
+    can not be nested in a read-only one.
     '''
     def __init__(self, store, write=False):
         '''
@@ -56,11 +84,23 @@ class TxnManager(ContextDecorator):
         self.write = write
 
     def __enter__(self):
-        # Only open a R/W transaction if one is not already open.
-        if not self.write or not self.store.is_txn_rw:
+        # Whether each nested context opened its transaction. This is kept
+        # in the store's thread-local state rather than in this instance,
+        # which can be shared when used as a decorator.
+        txn_stack = self.store._txn.txn_stack
+        if self.store.is_txn_open:
+            if self.write and not self.store.is_txn_rw:
+                raise RuntimeError(
+                        'Cannot open a read-write transaction within a '
+                        'read-only one.')
+            txn_stack.append(False)
+        else:
             self.store.begin(write=self.write)
+            txn_stack.append(True)
 
     def __exit__(self, exc_type, exc_value, traceback):
+        if not self.store._txn.txn_stack.pop():
+            return
         if exc_type:
             self.store.rollback()
         else:
@@ -68,6 +108,118 @@ class TxnManager(ContextDecorator):
 
 
 
+class QueryBudget:
+    '''
+    Limit the time taken by, and the number of triples read by, the queries
+    on a store in the current thread.
+
+    Wrap this within a `with` statement, within or around a transaction:
+
+    >>> with TxnManager(store), QueryBudget(store, timeout=30):
+    ...     # Query the database
+    >>>
+
+    In the context, `LmdbStore.triples` and `LmdbStore.join_patterns` check
+    the budget for each triple that they read, and raise `QueryTimeoutError`
+    if the time is up or `QueryRowLimitError` if too many triples have been
+    read. `LmdbStore.join_patterns` also checks the time for each solution,
+    since a join can generate many solutions from few triples. A query is
+    thus aborted as soon as it reads from the store past its budget, while
+    its time spent on anything else (e.g. sorting its results) is only
+    accounted for at that point.
+
+    Budgets can be nested. The innermost one replaces the others until it
+    exits.
+    '''
+    def __init__(self, store, timeout=None, max_rows=None, max_duration=None):
+        '''
+        @param store (LmdbStore) The store to limit the queries of.
+        @param timeout (float | None) Maximum time in seconds from the start
+        of the context, excluding the time spent in `paused`. If None or 0,
+        the time is not limited.
+        @param max_rows (int | None) Maximum number of triples read. If None
+        or 0, the triples are only counted.
+        @param max_duration (float | None) Maximum time in seconds from the
+        start of the context, including the time spent in `paused`. This
+        bounds how long a transaction used by a paused query stays open. If
+        None or 0, only `timeout` applies.
+        '''
+        self.store = store
+        self.timeout = timeout
+        self.max_rows = max_rows
+        self.max_duration = max_duration
+        self.rows = 0
+        self.start = None
+        self.deadline = None
+        self.end = None
+
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        self.deadline = self.start + self.timeout if self.timeout else None
+        self.end = (
+                self.start + self.max_duration if self.max_duration else None)
+        self._outer = self.store._txn.budget
+        self.store._txn.budget = self
+
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.store._txn.budget = self._outer
+
+
+    @property
+    def elapsed(self):
+        '''
+        Time in seconds since the start of the context, except the time spent
+        in `paused`.
+        '''
+        return time.monotonic() - self.start
+
+
+    @contextmanager
+    def paused(self):
+        '''
+        Stop counting the time, e.g. while the results found so far are sent
+        to a client.
+
+        The time spent in this context is not part of `elapsed`, and the
+        `timeout` deadline is moved forward by as much. The `max_duration`
+        deadline is not.
+        '''
+        paused_at = time.monotonic()
+        try:
+            yield
+        finally:
+            pause = time.monotonic() - paused_at
+            self.start += pause
+            if self.deadline:
+                self.deadline += pause
+
+
+    def charge(self):
+        '''
+        Account for one triple read, and check the budget.
+        '''
+        self.rows += 1
+        if self.max_rows and self.rows > self.max_rows:
+            raise QueryRowLimitError(self.max_rows, self.elapsed, self.rows)
+        self.check()
+
+
+    def check(self):
+        '''
+        Check the time budget.
+        '''
+        now = time.monotonic()
+        if self.deadline and now > self.deadline:
+            raise QueryTimeoutError(self.timeout, self.elapsed, self.rows)
+        if self.end and now > self.end:
+            raise QueryTimeoutError(self.max_duration, self.elapsed, self.rows)
+
+
+
 class LexicalSequence:
     '''
     Fixed-length lexicographically ordered byte sequence.
@@ -86,6 +238,10 @@ class LexicalSequence:
         '''
         self.start = start
         self.length = max_len
+        # Single-byte values that the last byte of a sequence can take.
+        self._last_bytes = [bytes((b,)) for b in range(start, 256)]
+        # Last computed run position and leading bytes, used by `range`.
+        self._prefix = (None, None)
 
 
     def first(self):
@@ -135,6 +291,182 @@ class LexicalSequence:
                 return bytes(n)
 
 
+    def to_int(self, n):
+        '''
+        Position of a byte sequence in the sequence, `first()` being 0.
+
+        @param n (bytes | memoryview) Byte sequence.
+
+        @return int
+        '''
+        base = 256 - self.start
+        i = 0
+        for b in bytes(n):
+            i = i * base + b - self.start
+
+        return i
+
+
+    def from_int(self, i):
+        '''
+        Byte sequence at a position in the sequence. Inverse of `to_int`.
+
+        @param i (int) Position.
+
+        @return bytes
+        '''
+        base = 256 - self.start
+        n = bytearray(self.length)
+        for pos in range(self.length - 1, -1, -1):
+            i, rem = divmod(i, base)
+            n[pos] = rem + self.start
+        if i:
+            raise RuntimeError('BAD DAY: Sequence exhausted. No more '
+                    'combinations are possible.')
+
+        return bytes(n)
+
+
+    def range(self, i, count):
+        '''
+        Consecutive byte sequences starting at a position.
+
+        Only the last byte changes within each run of `256 - start`
+        sequences, so the leading bytes are only computed once per run, and
+        kept for the next call.
+
+        @param i (int) Position of the first sequence.
+        @param count (int) Number of sequences.
+
+        @return list(bytes)
+        '''
+        base = 256 - self.start
+        last_bytes = self._last_bytes
+        seqs = []
+        prefix_pos, prefix = self._prefix
+        for pos in range(i, i + count):
+            prefix_i, last_i = divmod(pos, base)
+            if prefix_i != prefix_pos:
+                prefix = self.from_int(pos)[:-1]
+                prefix_pos = prefix_i
+            seqs.append(prefix + last_bytes[last_i])
+        self._prefix = (prefix_pos, prefix)
+
+        return seqs
+
+
+
+class LruCache:
+    '''
+    Size-bounded mapping that evicts the least recently used entry.
+
+    Hit and miss counters are kept to help sizing the cache. The cache can be
+    shared by multiple threads: an entry evicted by another thread while it is
+    being read is reported as a miss, and the counters are approximate.
+    '''
+    def __init__(self, size):
+        '''
+        @param size (int) Maximum number of entries. If 0, nothing is ever
+        cached.
+        '''
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+
+    def __len__(self):
+        return len(self._data)
+
+
+    def __contains__(self, key):
+        return key in self._data
+
+
+    def get(self, key):
+        '''
+        Get a cached value and mark it as most recently used.
+
+        @return The cached value or None if the key is not cached.
+        '''
+        try:
+            val = self._data[key]
+            self._data.move_to_end(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+
+        return val
+
+
+    def put(self, key, val):
+        '''
+        Add or replace a value, evicting the oldest one if the cache is full.
+        '''
+        if not self.size:
+            return
+        self._data[key] = val
+        self._data.move_to_end(key)
+        while len(self._data) > self.size:
+            try:
+                self._data.popitem(last=False)
+            except KeyError:
+                break
+
+
+    def clear(self):
+        '''
+        Empty the cache. The hit and miss counters are preserved.
+        '''
+        self._data.clear()
+
+
+    def stats(self):
+        '''
+        Cache usage statistics.
+
+        @return dict
+        '''
+        return {
+            'size': self.size,
+            'entries': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+
+class _TxnState(threading.local):
+    '''
+    Transaction state of a store, bound to the current thread.
+
+    If threads are patched by gevent, this is bound to the current greenlet.
+    '''
+    def __init__(self):
+        self.data_txn = None
+        self.idx_txn = None
+        self.is_txn_rw = None
+
+        # See `TxnManager`.
+        self.txn_stack = []
+
+        # See `QueryBudget`.
+        self.budget = None
+
+        # Lookup index updates pending in the current write transaction.
+        # Keys are triple keys, values are the last action ('add' or
+        # 'remove') requested for each triple. Using a dict eliminates
+        # duplicate updates, and the last action on a triple overrides the
+        # previous ones.
+        self.idx_queue = {}
+
+        # Position in `_key_seq` of the next term key to assign in the current
+        # write transaction. It is read from `t:st` when the first term is
+        # added.
+        self.next_key = None
+
+
 
 class LmdbStore(Store):
     '''
@@ -152,7 +484,9 @@ class LmdbStore(Store):
 
     There are 4 main data sets (preservation worthy data):
 
-    - t:st (term key: serialized term; 1:1)
+    - t:st (term key: serialized term; 1:1). Terms are serialized with
+      `term_codec`; stores created with older versions may contain pickled
+      terms until they are migrated with `migrate_term_format`.
     - spo:c (joined S, P, O keys: context key; dupsort, dupfixed)
     - c: (context keys only, values are the empty bytestring; 1:1)
     - pfx:ns (prefix: pickled namespace; 1:1)
@@ -166,6 +500,20 @@ class LmdbStore(Store):
     - o:sp (O key: joined S, P keys; dupsort, dupfixed)
     - c:spo (context → triple association; dupsort, dupfixed)
     - ns:pfx (pickled namespace: prefix; 1:1)
+
+    If the `composite_indices` option is set, 3 more indices are maintained
+    to look up triples with two bound terms directly:
+
+    - sp:o (joined S, P keys: O key; dupsort, dupfixed)
+    - po:s (joined P, O keys: S key; dupsort, dupfixed)
+    - so:p (joined S, O keys: P key; dupsort, dupfixed)
+
+    Two more optional indices are maintained for the terms themselves if the
+    `text_index` and `range_index` options are set:
+
+    - tok:t (literal word: term key; dupsort, dupfixed)
+    - val:t (literal value key: term key; dupsort, dupfixed). See
+      `term_codec.value_key`.
     '''
 
     context_aware = True
@@ -180,6 +528,46 @@ class LmdbStore(Store):
     '''
     MAP_SIZE = 1024 ** 4 # 1Tb
 
+    '''
+    Named sets of LMDB environment options, selected with the `lmdb_profile`
+    configuration option. Individual options can be overridden with
+    `lmdb_options`. See
+    http://lmdb.readthedocs.io/en/release/#environment-class for the meaning
+    of each option.
+
+    - `safe`: every commit is flushed to disk before it returns. A crash never
+      loses committed data. This is the default.
+    - `fast-ingest`: commits are not flushed to disk. Committed data survive a
+      crash of the application, but the last transactions may be lost if the
+      operating system crashes or the machine loses power. The database
+      structure stays intact unless the file system reorders writes. Call
+      `checkpoint` (e.g. with `lsup-admin checkpoint`) after a batch to make
+      it durable. The environments are also flushed when the store is
+      closed.
+    - `read-replica`: the environments are opened read-only and without LMDB
+      locks, with more reader slots. This is only safe for a copy of the
+      data that no process writes to, e.g. one restored from a backup to
+      serve reads.
+    '''
+    ENV_PROFILES = {
+        'safe': {},
+        'fast-ingest': {
+            'sync': False,
+            'metasync': False,
+        },
+        'read-replica': {
+            'readonly': True,
+            'lock': False,
+            'max_readers': 1024,
+        },
+    }
+    DEFAULT_ENV_PROFILE = 'safe'
+
+    '''LMDB environment options that can be set in profiles and overrides.'''
+    ENV_OPTIONS = (
+        'map_size', 'readonly', 'metasync', 'sync', 'map_async', 'readahead',
+        'writemap', 'meminit', 'max_readers', 'lock')
+
     '''
     Key hashing algorithm. If you are paranoid, use SHA1. Otherwise, MD5 is
     faster and takes up less space (16 bytes vs. 20 bytes). This may make a
@@ -187,12 +575,63 @@ class LmdbStore(Store):
     '''
     KEY_HASH_ALGO = 'sha1'
 
-    '''Separator byte. Used to join and split individual term keys.'''
+    '''
+    Number of terms hashed by a worker process at a time in
+    `rebuild_indices`.
+    '''
+    HASH_CHUNK_SIZE = 10000
+
+    '''
+    Separator byte. Used to join and split individual term keys in stores
+    with the `separator` key format.
+    '''
     SEP_BYTE = b'\x00'
 
+    '''
+    Formats of compound (triple and term pair) keys:
+
+    - `fixed`: term keys are concatenated and split by offset, since they all
+      have the same length (`KEY_LENGTH`);
+    - `separator`: term keys are joined with `SEP_BYTE`. This was the only
+      format in earlier versions.
+
+    The format of an existing store is detected from its data. New stores
+    use the `key_format` configuration option, or `DEFAULT_KEY_FORMAT`.
+    '''
+    KEY_FORMATS = ('fixed', 'separator')
+    DEFAULT_KEY_FORMAT = 'fixed'
+
+    '''
+    Layouts of the LMDB environments on disk:
+
+    - `split`: the main data and the indices are in two environments, each
+      with its own file (`main` and `index`), committed one after the other;
+    - `single`: all databases are in one environment (file `store`), so that
+      data and indices are committed together by one LMDB transaction. This
+      halves the disk flushes per commit and a crash can never leave the
+      indices out of sync with the data.
+
+    The layout of an existing store is detected from its files. New stores
+    use the `env_layout` configuration option, or `DEFAULT_ENV_LAYOUT`.
+    '''
+    ENV_LAYOUTS = ('split', 'single')
+    DEFAULT_ENV_LAYOUT = 'split'
+
     KEY_LENGTH = 5 # Max key length for terms. That allows for A LOT of terms.
     KEY_START = 2 # \x00 is reserved as a separator. \x01 is spare.
 
+    '''
+    Default maximum number of entries in the term-to-key cache. This can be
+    overridden with the `term_key_cache_size` configuration option.
+    '''
+    TERM_KEY_CACHE_SIZE = 65536
+
+    '''
+    Default maximum number of entries in the key-to-term cache. This can be
+    overridden with the `key_term_cache_size` configuration option.
+    '''
+    KEY_TERM_CACHE_SIZE = 65536
+
     data_keys = (
         # Term key to serialized term content: 1:1
         't:st',
@@ -210,17 +649,28 @@ class LmdbStore(Store):
         'th:t',
         # Lookups: 1:m, fixed-length values
         's:po', 'p:so', 'o:sp', 'c:spo',
+        # Optional two-term lookups: 1:m, fixed-length values
+        'sp:o', 'po:s', 'so:p',
+        # Optional literal word tokens to term keys: m:m, fixed-length values
+        'tok:t',
+        # Optional literal value keys to term keys: 1:m, fixed-length values
+        'val:t',
     )
 
+    '''Two-term lookup indices, only maintained if enabled in the config.'''
+    composite_keys = ('sp:o', 'po:s', 'so:p')
+
+    '''
+    Indices of the terms in `t:st`, only maintained if enabled in the config.
     '''
-    Order in which keys are looked up if two terms are bound.
-    The indices with the smallest average number of values per key should be
-    looked up first.
+    term_idx_keys = ('tok:t', 'val:t')
 
-    If we want to get fancy, this can be rebalanced from time to time by
-    looking up the number of keys in (s:spo, p:spo, o:spo).
     '''
-    _lookup_rank = ('s', 'o', 'p')
+    Words in literals, for the optional text index. Tokens are case-folded
+    and cut to `TOKEN_MAX_LENGTH` characters.
+    '''
+    TOKEN_RE = re.compile(r'\w+')
+    TOKEN_MAX_LENGTH = 64
 
     '''
     Order of terms in the lookup indices. Used to rebuild a triple from lookup.
@@ -229,45 +679,52 @@ class LmdbStore(Store):
         's:po': (0, 1, 2),
         'p:so': (1, 0, 2),
         'o:sp': (2, 0, 1),
+        'sp:o': (0, 1, 2),
+        'po:s': (1, 2, 0),
+        'so:p': (0, 2, 1),
     }
 
 
     data_env = None
     idx_env = None
     db = None
-    dbs = {}
-    data_txn = None
-    idx_txn = None
-    is_txn_rw = None
-
-    '''
-    List of actions to be performed when a transaction is committed.
-
-    Each element is a tuple of (action name, database index, key, value).
-    '''
-    _data_queue = []
-    '''
-    Set of indices to update. A set has been preferred to a list since the
-    index update don't need to be sequential and there may be duplicate entries
-    that can be eliminated.
 
-    Each element is a tuple of (triple key, pickled context, pre-pickled triple
-    ). The third value can be None, and in that case, it is calculated from
-    the triple key.
-    '''
-    _idx_queue = []
-
-
-    def __init__(self, path, identifier=None):
+    def __init__(self, path, identifier=None, config=None):
+        '''
+        @param path (string) Filesystem path to the store folder.
+        @param identifier (rdflib.URIRef) Store identifier. By default it is
+        derived from the path.
+        @param config (dict) Store options, normally the `store.ldp_rs`
+        section of the application configuration.
+        '''
         self.path = path
+        self.config = config or {}
         self.__open = False
+        self.dbs = {}
+
+        # Transactions are bound to the thread (or greenlet) that opened them.
+        # Any number of threads can read at the same time, while the write
+        # lock lets only one of them write at a time.
+        self._txn = _TxnState()
+        self._write_lock = threading.Lock()
+
+        # Term-to-key and key-to-term caches. Shared by all transactions on
+        # this environment.
+        self._term_key_cache = LruCache(self.config.get(
+                'term_key_cache_size', self.TERM_KEY_CACHE_SIZE))
+        self._key_term_cache = LruCache(self.config.get(
+                'key_term_cache_size', self.KEY_TERM_CACHE_SIZE))
+
+        # Whether to maintain and use the two-term lookup indices.
+        self.composite_idx = bool(self.config.get('composite_indices', False))
+        # Whether to maintain and use the literal text index.
+        self.text_idx = bool(self.config.get('text_index', False))
+        # Whether to maintain and use the literal value range index.
+        self.range_idx = bool(self.config.get('range_index', False))
 
         self.identifier = identifier or URIRef(pathname2url(abspath(path)))
         super().__init__(path)
 
-        self._pickle = self.node_pickler.dumps
-        self._unpickle = self.node_pickler.loads
-
         self._key_seq = LexicalSequence(self.KEY_START, self.KEY_LENGTH)
 
 
@@ -281,15 +738,16 @@ class LmdbStore(Store):
         context = self._normalize_context(context)
 
         if context is not None:
-            #dataset = self.triples((None, None, None), context)
+            ck = self._to_key(context)
+            if not ck:
+                return 0
             with self.cur('c:spo') as cur:
-                if cur.set_key(self._to_key(context)):
-                    dataset = set(cur.iternext_dup())
-                    return len(dataset)
-                else:
-                    return 0
+                return cur.count() if cur.set_key(ck) else 0
         else:
-            return self.data_txn.stat(self.dbs['spo:c'])['entries']
+            # `spo:c` has one entry per triple and context. `s:po` has one
+            # per triple.
+            self._apply_idx_queue()
+            return self.idx_txn.stat(self.dbs['s:po'])['entries']
 
 
     @property
@@ -297,6 +755,42 @@ class LmdbStore(Store):
         return self.__open
 
 
+    @property
+    def data_txn(self):
+        '''
+        Main data transaction of the current thread.
+        '''
+        return self._txn.data_txn
+
+    @data_txn.setter
+    def data_txn(self, txn):
+        self._txn.data_txn = txn
+
+
+    @property
+    def idx_txn(self):
+        '''
+        Index transaction of the current thread.
+        '''
+        return self._txn.idx_txn
+
+    @idx_txn.setter
+    def idx_txn(self, txn):
+        self._txn.idx_txn = txn
+
+
+    @property
+    def is_txn_rw(self):
+        '''
+        Whether the transaction of the current thread is read-write.
+        '''
+        return self._txn.is_txn_rw
+
+    @is_txn_rw.setter
+    def is_txn_rw(self, rw):
+        self._txn.is_txn_rw = rw
+
+
     def open(self, configuration=None, create=True):
         '''
         Open the database.
@@ -313,21 +807,49 @@ class LmdbStore(Store):
         if self.data_env == NO_STORE:
             return NO_STORE
         self.__open = True
+        self._check_composite_indices()
+        self._check_term_indices()
 
         return VALID_STORE
 
 
     def begin(self, write=False):
         '''
-        Begin the main write transaction and create cursors.
+        Begin the main transaction of the current thread.
+
+        A write transaction waits until no other thread holds one. The wait
+        is on a Python lock rather than on the LMDB writer lock, so that it
+        yields to other greenlets under gevent.
+
+        Read-only transactions are not pooled here: py-lmdb resets the handle
+        of a read-only transaction when it ends and renews it for the next one
+        on the same environment, which keeps its reader slot. A reset handle
+        holds no snapshot, so it does not prevent pages from being reused.
+        Transactions must therefore be released (see `commit` and `rollback`)
+        rather than kept open between requests.
+
+        @param write (bool) Whether the transaction is read-write.
         '''
         if not self.is_open:
             raise RuntimeError('Store must be opened first.')
         logger.debug('Beginning a {} transaction.'.format(
             'read/write' if write else 'read-only'))
 
-        self.data_txn = self.data_env.begin(buffers=True, write=write)
-        self.idx_txn = self.idx_env.begin(buffers=False, write=write)
+        if write:
+            self._write_lock.acquire()
+        try:
+            if self.env_layout == 'single':
+                # Only one write transaction can be open on an environment.
+                self.data_txn = self.idx_txn = self.data_env.begin(
+                        buffers=False, write=write)
+            else:
+                self.data_txn = self.data_env.begin(buffers=True, write=write)
+                self.idx_txn = self.idx_env.begin(buffers=False, write=write)
+        except:
+            if write:
+                self._write_lock.release()
+            raise
+        self._txn.next_key = None
 
         self.is_txn_rw = write
 
@@ -336,18 +858,37 @@ class LmdbStore(Store):
         '''
         Gather statistics about the database.
         '''
-        stats = {
-            'data_db_stats': {
-                db_label: self.data_txn.stat(self.dbs[db_label])
-                for db_label in self.data_keys},
-
-            'idx_db_stats': {
-                db_label: self.idx_txn.stat(self.dbs[db_label])
-                for db_label in self.idx_keys},
+        self._apply_idx_queue()
+        data_db_stats = {
+            db_label: self.data_txn.stat(self.dbs[db_label])
+            for db_label in self.data_keys}
+        idx_db_stats = {
+            db_label: self.idx_txn.stat(self.dbs[db_label])
+            for db_label in self.idx_keys}
+
+        if self.env_layout == 'single':
+            # Attribute the pages used by the indices to them, and everything
+            # else in the file (including free pages) to the main data.
+            idx_db_size = sum(
+                    st['psize'] * (
+                        st['branch_pages'] + st['leaf_pages']
+                        + st['overflow_pages'])
+                    for st in idx_db_stats.values())
+            data_db_size = (
+                    os.stat(self.data_env.path()).st_size - idx_db_size)
+        else:
+            data_db_size = os.stat(self.data_env.path()).st_size
+            idx_db_size = os.stat(self.idx_env.path()).st_size
 
-            'data_db_size': os.stat(self.data_env.path()).st_size,
-            'idx_db_size': os.stat(self.idx_env.path()).st_size,
+        stats = {
+            'env_layout': self.env_layout,
+            'data_db_stats': data_db_stats,
+            'idx_db_stats': idx_db_stats,
+            'data_db_size': data_db_size,
+            'idx_db_size': idx_db_size,
             'num_triples': len(self),
+            'term_key_cache': self._term_key_cache.stats(),
+            'key_term_cache': self._key_term_cache.stats(),
         }
 
         return stats
@@ -430,8 +971,51 @@ class LmdbStore(Store):
             else:
                 self.rollback()
 
-        self.data_env.close()
-        self.idx_env.close()
+        if not self.env_options.get('sync', True):
+            self.checkpoint()
+        for env in self.envs:
+            env.close()
+
+
+    def checkpoint(self):
+        '''
+        Flush all committed transactions to disk.
+
+        This is only needed if the environments are opened without `sync`,
+        e.g. with the `fast-ingest` profile, where commits return before their
+        data are on disk. Data committed before a checkpoint survive an
+        operating system crash or a power loss.
+        '''
+        logger.info('Flushing store {} to disk.'.format(self.path))
+        for env in self.envs:
+            env.sync(True)
+
+
+    @property
+    def envs(self):
+        '''
+        Distinct LMDB environments of the store.
+
+        @return tuple(lmdb.Environment)
+        '''
+        if self.env_layout == 'single':
+            return (self.data_env,)
+        return (self.data_env, self.idx_env)
+
+
+    @property
+    def generation(self):
+        '''
+        Generation of the store data.
+
+        This is the ID of the last committed write transaction of each
+        environment. It changes with every commit that modifies the store,
+        including commits by other processes, and is read without opening a
+        transaction.
+
+        @return tuple(int)
+        '''
+        return tuple(env.info()['last_txnid'] for env in self.envs)
 
 
     def destroy(self, path):
@@ -444,6 +1028,7 @@ class LmdbStore(Store):
         '''
         if exists(path):
             rmtree(path)
+        self._clear_caches()
 
 
     def add(self, triple, context=None, quoted=False):
@@ -455,7 +1040,6 @@ class LmdbStore(Store):
         'None' inserts in the default graph.
         @param quoted (bool) Not used.
         '''
-        #import pdb; pdb.set_trace()
         context = self._normalize_context(context)
         if context is None:
             context = RDFLIB_DEFAULT_GRAPH_URI
@@ -463,34 +1047,19 @@ class LmdbStore(Store):
         Store.add(self, triple, context)
 
         #logger.info('Adding triple: {}'.format(triple))
-        pk_trp = self._pickle(triple)
-
-        pk_s, pk_p, pk_o = [self._pickle(t) for t in triple]
-        #logger.debug('Adding quad: {} {}'.format(triple, context))
-        pk_c = self._pickle(context)
-
         # Add new individual terms or gather keys for existing ones.
-        keys = [None, None, None, None]
-        with self.cur('th:t') as icur:
-            for i, pk_t in enumerate((pk_s, pk_p, pk_o, pk_c)):
-                thash = self._hash(pk_t)
-                if icur.set_key(thash):
-                    keys[i] = icur.value()
-                else:
-                    # Put new term.
-                    with self.cur('t:st') as dcur:
-                        keys[i] = self._append(dcur, (pk_t,))[0]
-                    # Index.
-                    icur.put(thash, keys[i])
+        quad = (*triple, context)
+        ckeys = [self._cache_key(t) for t in quad]
+        keys = self._get_or_create_keys(dict(zip(ckeys, quad)))
+        sk, pk, ok, ck = [keys[k] for k in ckeys]
 
         # Add context in context DB.
-        ck = keys[3]
         with self.cur('c:') as cur:
             if not cur.set_key(ck):
                 cur.put(ck, b'')
 
         # Add triple:context association.
-        spok = self.SEP_BYTE.join(keys[:3])
+        spok = self._sep.join((sk, pk, ok))
         with self.cur('spo:c') as dcur:
             if not dcur.set_key_dup(spok, ck):
                 dcur.put(spok, ck)
@@ -498,7 +1067,61 @@ class LmdbStore(Store):
         with self.cur('c:spo') as icur:
             icur.put(ck, spok)
 
-        self._index_triple('add', spok)
+        self._index_triples('add', (spok,))
+
+
+    def addN(self, quads):
+        '''
+        Add a batch of triples with their contexts and index them.
+
+        The quads are deduplicated, all their terms are resolved to keys in
+        one pass, and the data and index entries are written in key order with
+        `putmulti`. This is much cheaper than adding triples one by one.
+
+        @param quads (iterable) Tuples of (s, p, o, c) where `c` is a context
+        identifier or graph. A `None` context inserts in the default graph.
+        '''
+        cache_key = self._cache_key
+        terms = {}
+        quad_ckeys = []
+        for s, p, o, c in quads:
+            c = self._normalize_context(c)
+            if c is None:
+                c = RDFLIB_DEFAULT_GRAPH_URI
+            Store.add(self, (s, p, o), c)
+
+            sc, pc, oc, cc = cache_key(s), cache_key(p), cache_key(o), \
+                    cache_key(c)
+            terms[sc] = s
+            terms[pc] = p
+            terms[oc] = o
+            terms[cc] = c
+            quad_ckeys.append((sc, pc, oc, cc))
+
+        if not quad_ckeys:
+            return
+
+        # Add new individual terms or gather keys for existing ones.
+        keys = self._get_or_create_keys(terms)
+
+        # Triple key: context key pairs.
+        assocs = {
+            (self._sep.join((keys[sc], keys[pc], keys[oc])), keys[cc])
+            for sc, pc, oc, cc in quad_ckeys}
+
+        # Add contexts in context DB.
+        with self.cur('c:') as cur:
+            cur.putmulti(
+                    [(ck, b'') for ck in sorted({a[1] for a in assocs})],
+                    overwrite=False)
+        # Add triple:context associations.
+        with self.cur('spo:c') as dcur:
+            dcur.putmulti(sorted(assocs))
+        # Index spo:c associations.
+        with self.cur('c:spo') as icur:
+            icur.putmulti(sorted((ck, spok) for spok, ck in assocs))
+
+        self._index_triples('add', {a[0] for a in assocs})
 
 
     def remove(self, triple_pattern, context=None):
@@ -517,7 +1140,9 @@ class LmdbStore(Store):
         else:
             ck = None
 
-        for spok in set(self._triple_keys(triple_pattern, context)):
+        # Keys are copied since buffers are invalidated by the deletions.
+        spoks = {bytes(k) for k in self._triple_keys(triple_pattern, context)}
+        for spok in spoks:
             # Delete context association.
             with self.cur('spo:c') as dcur:
                 with self.cur('c:spo') as icur:
@@ -529,22 +1154,25 @@ class LmdbStore(Store):
                     else:
                         # If no context is specified, remove all associations.
                         if dcur.set_key(spok):
-                            for ck in dcur.iternext_dup():
+                            for trp_ck in dcur.iternext_dup():
                                 # Delete index first while we have the
                                 # context reference.
-                                if icur.set_key_dup(ck, spok):
+                                if icur.set_key_dup(trp_ck, spok):
                                     icur.delete()
                             # Then delete the main entry.
                             dcur.set_key(spok)
                             dcur.delete(dupdata=True)
 
-            self._index_triple('remove', spok)
+        self._index_triples('remove', spoks)
 
 
     def triples(self, triple_pattern, context=None):
         '''
         Generator over matching triples.
 
+        Each triple read is charged to the `QueryBudget` of the current
+        thread, if any.
+
         @param triple_pattern (tuple) 3 RDFLib terms
         @param context (rdflib.Graph | None) Context graph, if available.
 
@@ -562,8 +1190,11 @@ class LmdbStore(Store):
         if context == RDFLIB_DEFAULT_GRAPH_URI:
             context = None
 
+        budget = self._txn.budget
         with self.cur('spo:c') as cur:
             for spok in self._triple_keys(triple_pattern, context):
+                if budget:
+                    budget.charge()
                 if context is not None:
                     contexts = (Graph(identifier=context),)
                 else:
@@ -572,45 +1203,231 @@ class LmdbStore(Store):
                             Graph(identifier=self._from_key(ck)[0], store=self)
                             for ck in cur.iternext_dup())
 
-                #print('Found triples: {} In contexts: {}'.format(
-                #    self._from_key(spok), contexts))
                 yield self._from_key(spok), contexts
 
 
-    def bind(self, prefix, namespace):
-        '''
-        Bind a prefix to a namespace.
+    def context_triples(self, contexts):
         '''
-        prefix = s2b(prefix)
-        namespace = s2b(namespace)
-        if self.is_txn_rw:
-            with self.data_txn.cursor(self.dbs['pfx:ns']) as cur:
-                cur.put(prefix, namespace)
-            with self.idx_txn.cursor(self.dbs['ns:pfx']) as cur:
-                cur.put(namespace, prefix)
-        else:
-            with self.data_env.begin(write=True) as wtxn:
-                with wtxn.cursor(self.dbs['pfx:ns']) as cur:
-                    cur.put(prefix, namespace)
-            with self.idx_env.begin(write=True) as wtxn:
-                with wtxn.cursor(self.dbs['ns:pfx']) as cur:
-                    cur.put(namespace, prefix)
+        Generator over all the triples in a number of contexts.
 
+        The contexts are read from `c:spo` in a single cursor pass, and the
+        triples are decoded without building any context graph. This is
+        faster than iterating over several `Dataset.graph` instances when
+        the whole content of the contexts is needed, e.g. to assemble a
+        resource from all its graphs.
 
-    def namespace(self, prefix):
-        '''
-        Get the namespace for a prefix.
+        A triple found in more than one of the contexts is generated once
+        per context. Each triple read is charged to the `QueryBudget` of the
+        current thread, if any.
+
+        @param contexts (iterable(rdflib.URIRef | rdflib.Graph)) Context URIs
+        or graphs. Contexts not in the store are skipped.
+
+        @return generator(tuple) Triples of RDFLib terms.
         '''
-        with self.cur('pfx:ns') as cur:
-            ns = cur.get(s2b(prefix))
-            return Namespace(b2s(ns)) if ns is not None else None
+        budget = self._txn.budget
+        with self.cur('c:spo') as cur:
+            for context in contexts:
+                ck = self._to_key(self._normalize_context(context))
+                if not ck or not cur.set_key(ck):
+                    continue
+                for spok in cur.iternext_dup():
+                    if budget:
+                        budget.charge()
+                    yield self._from_key(spok)
 
 
-    def prefix(self, namespace):
+    def quads(self, triple_pattern, context_filter=None):
         '''
-        Get the prefix associated with a namespace.
+        Generator over matching triples and the contexts they are found in.
 
-        @NOTE A namespace can be only bound to one prefix in this
+        Unlike `triples`, this yields a plain tuple for each triple and
+        context, and builds no `Graph`. The contexts of each matching triple
+        key are read and filtered before the triple is decoded, so a triple
+        found only in rejected contexts costs one `spo:c` lookup.
+
+        Each triple read is charged to the `QueryBudget` of the current
+        thread, if any.
+
+        @param triple_pattern (tuple) 3 RDFLib terms.
+        @param context_filter (callable | None) Function taking a context URI
+        and returning whether the matches in that context are generated. If
+        None, the matches in all contexts are.
+
+        @return generator(tuple) Quads of RDFLib terms, the last one being
+        the context URI. A triple found in more than one accepted context is
+        generated once for each.
+        '''
+        budget = self._txn.budget
+        with self.cur('spo:c') as cur:
+            for spok in self._triple_keys(triple_pattern):
+                if budget:
+                    budget.charge()
+                if not cur.set_key(spok):
+                    continue
+                contexts = [
+                        ctx for ctx in (
+                            self._from_key(ck)[0]
+                            for ck in cur.iternext_dup())
+                        if context_filter is None or context_filter(ctx)]
+                if contexts:
+                    trp = self._from_key(spok)
+                    for ctx in contexts:
+                        yield trp + (ctx,)
+
+
+    def count(self, triple_pattern=(None, None, None), context=None):
+        '''
+        Count the triples matching a pattern without retrieving them.
+
+        Patterns with no bound terms, or with one bound term (two if the
+        composite indices are enabled) and no context, are counted from the
+        number of values of a single index key. Other patterns are counted
+        by iterating over the matching triple keys, without converting them
+        to terms.
+
+        @param triple_pattern (tuple) 3 RDFLib terms
+        @param context (rdflib.Graph | None) Context graph or URI, or None.
+
+        @return int
+        '''
+        context = self._normalize_context(context)
+        if context == RDFLIB_DEFAULT_GRAPH_URI:
+            context = None
+
+        bound = [
+            label for label, term in zip('spo', triple_pattern)
+            if term is not None]
+        if not bound:
+            return self.__len__(context)
+
+        if context is None and (
+                len(bound) == 1 or len(bound) == 2 and self.composite_idx):
+            key_pattern = [
+                None if term is None else self._to_key(term)
+                for term in triple_pattern]
+            if len([k for k in key_pattern if k]) < len(bound):
+                return 0
+            return self._count_keys(key_pattern)
+
+        return sum(1 for _ in self._triple_keys(triple_pattern, context))
+
+
+    def join_patterns(self, patterns, out_vars=None, context=None):
+        '''
+        Find the solutions of a basic graph pattern.
+
+        The triple patterns are joined on term keys, and only the terms bound
+        to `out_vars` are decoded. Patterns are evaluated one at a time, in
+        the order set by `_join_plan`. Each pattern after the first one is
+        either looked up once per partial solution, with its shared
+        variables bound, or, if it has fewer matches than the first pattern
+        (see `_count_keys`) or no shared variables, looked up once and
+        hash-joined with the partial solutions.
+
+        Solutions are generated as they are found. Each triple read is
+        charged to the `QueryBudget` of the current thread, if any.
+
+        @param patterns (list(tuple)) Triple patterns. Their terms are either
+        `rdflib.Variable` instances or RDFLib terms.
+        @param out_vars (set(rdflib.Variable) | None) Variables whose terms
+        are returned. If None, all variables are returned.
+        @param context (rdflib.URIRef | rdflib.Graph | None) Context to
+        restrict the matches to. If None, all contexts are searched.
+
+        @return generator(dict) Variables and their terms in each solution.
+        '''
+        context = self._normalize_context(context)
+        if context == RDFLIB_DEFAULT_GRAPH_URI:
+            context = None
+        if context is not None:
+            ck = self._to_key(context)
+            if not ck:
+                return
+        else:
+            ck = None
+
+        key_patterns = []
+        for pattern in patterns:
+            key_pattern = []
+            for term in pattern:
+                if isinstance(term, Variable):
+                    key_pattern.append(term)
+                    continue
+                k = self._to_key(term)
+                if not k:
+                    # A bound term is not in the store.
+                    return
+                key_pattern.append(k)
+            key_patterns.append(tuple(key_pattern))
+
+        plan = self._join_plan(key_patterns)
+        if out_vars is None:
+            out_vars = {
+                term for key_pattern in key_patterns for term in key_pattern
+                if isinstance(term, Variable)}
+
+        with self.cur('c:spo') as ctx_cur:
+            ctx_filter = (
+                    (lambda spok: ctx_cur.set_key_dup(ck, spok))
+                    if ck else None)
+            rows = iter(({},))
+            bound_vars = set()
+            for key_pattern, est in plan:
+                shared = [
+                    term for term in key_pattern
+                    if isinstance(term, Variable) and term in bound_vars]
+                if bound_vars and (not shared or est <= plan[0][1]):
+                    rows = self._hash_join(
+                            rows, key_pattern, shared, ctx_filter)
+                else:
+                    rows = self._lookup_join(rows, key_pattern, ctx_filter)
+                bound_vars.update(
+                        term for term in key_pattern
+                        if isinstance(term, Variable))
+
+            budget = self._txn.budget
+            for row in rows:
+                if budget:
+                    budget.check()
+                yield {
+                    var: self._from_key(k)[0] for var, k in row.items()
+                    if var in out_vars}
+
+
+    def bind(self, prefix, namespace):
+        '''
+        Bind a prefix to a namespace.
+        '''
+        prefix = s2b(prefix)
+        namespace = s2b(namespace)
+        if self.is_txn_rw:
+            with self.data_txn.cursor(self.dbs['pfx:ns']) as cur:
+                cur.put(prefix, namespace)
+            with self.idx_txn.cursor(self.dbs['ns:pfx']) as cur:
+                cur.put(namespace, prefix)
+        else:
+            with self._side_txns() as (data_txn, idx_txn):
+                with data_txn.cursor(self.dbs['pfx:ns']) as cur:
+                    cur.put(prefix, namespace)
+                with idx_txn.cursor(self.dbs['ns:pfx']) as cur:
+                    cur.put(namespace, prefix)
+
+
+    def namespace(self, prefix):
+        '''
+        Get the namespace for a prefix.
+        '''
+        with self.cur('pfx:ns') as cur:
+            ns = cur.get(s2b(prefix))
+            return Namespace(b2s(ns)) if ns is not None else None
+
+
+    def prefix(self, namespace):
+        '''
+        Get the prefix associated with a namespace.
+
+        @NOTE A namespace can be only bound to one prefix in this
         implementation.
         '''
         with self.cur('ns:pfx') as cur:
@@ -627,6 +1444,126 @@ class LmdbStore(Store):
                 yield (b2s(pfx), Namespace(b2s(ns)))
 
 
+    def search_terms(self, text, prefix=False):
+        '''
+        Find the literals containing all the words of a text.
+
+        Words are matched regardless of case. If the text index is enabled,
+        the words are looked up in it; otherwise all terms are scanned, which
+        is only practical for small stores. Only literals that are the object
+        of at least one triple are returned.
+
+        @param text (string) Words to look for.
+        @param prefix (bool) Whether the words of the text may also match the
+        beginning of longer words.
+
+        @return generator(rdflib.Literal) Matching literals in no particular
+        order.
+        '''
+        tokens = self._tokenize(Literal(text))
+        if not tokens:
+            return
+
+        if self.text_idx:
+            matches = None
+            with self.cur('tok:t') as cur:
+                for token in sorted(tokens, key=len, reverse=True):
+                    tks = set()
+                    if prefix:
+                        if cur.set_range(token):
+                            for tok, tk in cur:
+                                if not tok.startswith(token):
+                                    break
+                                tks.add(tk)
+                    elif cur.set_key(token):
+                        tks.update(cur.iternext_dup())
+                    matches = tks if matches is None else matches & tks
+                    if not matches:
+                        return
+        else:
+            with self.cur('t:st') as cur:
+                matches = set()
+                for tk, st in cur:
+                    term_tokens = self._tokenize(self._unpickle(st))
+                    if all(
+                            any(tt.startswith(t) for tt in term_tokens)
+                            if prefix else t in term_tokens
+                            for t in tokens):
+                        matches.add(bytes(tk))
+
+        with self.cur('o:sp') as cur:
+            for tk in sorted(matches):
+                if cur.set_key(tk):
+                    yield self._from_key(tk)[0]
+
+
+    def search_range(self, low=None, high=None, incl_low=True, incl_high=True):
+        '''
+        Find the literals whose value is within a range.
+
+        Numbers, `xsd:date` and `xsd:dateTime` literals are compared by
+        value (see `term_codec.value_key`). Only literals of the same kind as
+        the bounds are returned. If the range index is enabled, the range is
+        scanned with a cursor; otherwise all terms are scanned and sorted,
+        which is only practical for small stores. Only literals that are the
+        object of at least one triple are returned.
+
+        @param low (rdflib.Literal | None) Lower bound. If None, the range is
+        open at the bottom.
+        @param high (rdflib.Literal | None) Upper bound. If None, the range is
+        open at the top.
+        @param incl_low (bool) Whether values equal to the lower bound match.
+        @param incl_high (bool) Whether values equal to the upper bound match.
+
+        @return generator(rdflib.Literal) Matching literals in value order.
+        '''
+        bounds = []
+        for bound in low, high:
+            if bound is None:
+                bounds.append(None)
+                continue
+            vk = term_codec.value_key(bound)
+            if vk is None:
+                raise ValueError(
+                        '{} cannot be compared by value.'.format(
+                            bound.n3() if hasattr(bound, 'n3') else bound))
+            bounds.append(vk)
+        lk, hk = bounds
+        if lk is None and hk is None:
+            raise ValueError('At least one bound must be given.')
+        kind = (lk or hk)[:1]
+        if lk is not None and hk is not None and hk[:1] != kind:
+            raise ValueError('The bounds are values of different kinds.')
+
+        def in_range(vk):
+            if lk is not None and (vk < lk or vk == lk and not incl_low):
+                return False
+            return hk is None or vk < hk or vk == hk and incl_high
+
+        if self.range_idx:
+            with self.cur('val:t') as cur:
+                matches = []
+                if cur.set_range(lk or kind):
+                    for vk, tk in cur:
+                        if vk[:1] != kind or hk is not None and vk > hk:
+                            break
+                        if in_range(vk):
+                            matches.append(tk)
+        else:
+            with self.cur('t:st') as cur:
+                matches = []
+                for tk, st in cur:
+                    vk = term_codec.value_key(self._unpickle(st))
+                    if vk is not None and vk[:1] == kind and in_range(vk):
+                        matches.append((vk, bytes(tk)))
+            matches = [tk for vk, tk in sorted(matches)]
+
+        with self.cur('o:sp') as cur:
+            for tk in matches:
+                if cur.set_key(tk):
+                    yield self._from_key(tk)[0]
+
+
     def contexts(self, triple=None):
         '''
         Get a list of all contexts.
@@ -661,15 +1598,12 @@ class LmdbStore(Store):
 
         @param graph (URIRef) URI of the named graph to add.
         '''
-        #import pdb; pdb.set_trace()
         if isinstance(graph, Graph):
             graph = graph.identifier
-        pk_c = self._pickle(graph)
-        c_hash = self._hash(pk_c)
-        with self.cur('th:t') as cur:
-            c_exists = cur.set_key(c_hash)
-        if not c_exists:
+        if self._to_key(graph) is None:
             # Insert context term if not existing.
+            pk_c = self._pickle(graph)
+            c_hash = self._hash(pk_c)
             if self.is_txn_rw:
                 # Use existing R/W transaction.
                 with self.cur('t:st') as cur:
@@ -680,13 +1614,15 @@ class LmdbStore(Store):
                     cur.put(ck, b'')
             else:
                 # Open new R/W transactions.
-                with self.data_env.begin(write=True) as wtxn:
-                    with wtxn.cursor(self.dbs['t:st']) as cur:
+                with self._side_txns() as (data_txn, idx_txn):
+                    if idx_txn.get(c_hash, db=self.dbs['th:t']) is not None:
+                        # Added by another writer in the meantime.
+                        return
+                    with data_txn.cursor(self.dbs['t:st']) as cur:
                         ck = self._append(cur, (pk_c,))[0]
-                    with wtxn.cursor(self.dbs['c:']) as cur:
+                    with data_txn.cursor(self.dbs['c:']) as cur:
                         cur.put(ck, b'')
-                with self.idx_env.begin(write=True) as wtxn:
-                    with wtxn.cursor(self.dbs['th:t']) as cur:
+                    with idx_txn.cursor(self.dbs['th:t']) as cur:
                         cur.put(c_hash, ck)
 
 
@@ -705,17 +1641,402 @@ class LmdbStore(Store):
                 cur.delete()
 
 
+    def migrate_term_format(self):
+        '''
+        Convert terms stored as RDFLib pickles into the binary term format.
+
+        All terms in `t:st` are rewritten under their existing keys, so no
+        triple or index needs to change, and `th:t` is rebuilt with hashes of
+        the new serialization. Everything happens in one write transaction.
+
+        No other process should write to the store while this runs, or
+        after it completes and before it is reopened.
+
+        @return int Number of converted terms. 0 if the store is already in
+        the binary format.
+        '''
+        if self.term_format == 'binary':
+            return 0
+
+        unpickle = self.node_pickler.loads
+        with TxnManager(self, True):
+            with self.cur('t:st') as cur:
+                terms = [
+                    (bytes(tk), term_codec.dumps(unpickle(pk_t)))
+                    for tk, pk_t in cur]
+            with self.cur('t:st') as cur:
+                cur.putmulti(terms)
+
+            # Pickles of different Python objects may map to the same term.
+            # Only one key per term can be indexed.
+            hashes = {self._hash(st): tk for tk, st in terms}
+            self.idx_txn.drop(self.dbs['th:t'], delete=False)
+            with self.cur('th:t') as cur:
+                cur.putmulti(sorted(hashes.items()), append=True)
+
+        self._clear_caches()
+        self.term_format = 'binary'
+        self._pickle = term_codec.dumps
+        self._unpickle = term_codec.loads
+        logger.info('Converted {} terms to binary format.'.format(len(terms)))
+
+        return len(terms)
+
+
+    def migrate_key_format(self, key_format=DEFAULT_KEY_FORMAT):
+        '''
+        Convert the compound keys of all triples to a different key format.
+
+        `spo:c` and `c:spo` are rewritten and the lookup indices are rebuilt,
+        all in one write transaction. All the triple keys of the store are
+        held in memory while this runs.
+
+        No other process should write to the store while this runs, or
+        after it completes and before it is reopened.
+
+        @param key_format (string) One of `KEY_FORMATS`.
+
+        @return int Number of converted triple:context associations. 0 if the
+        store is already in the requested format.
+        '''
+        if key_format not in self.KEY_FORMATS:
+            raise ValueError(
+                    'Key format \'{}\' is not supported.'.format(key_format))
+        if key_format == self.key_format:
+            return 0
+
+        old_format = self.key_format
+        try:
+            with TxnManager(self, True):
+                with self.cur('spo:c') as cur:
+                    assocs = [
+                        (self._split_key(spok), bytes(ck))
+                        for spok, ck in cur]
+
+                self.data_txn.drop(self.dbs['spo:c'], delete=False)
+                idx_dbs = ['c:spo', 's:po', 'p:so', 'o:sp']
+                if self.composite_idx:
+                    idx_dbs.extend(self.composite_keys)
+                for db in idx_dbs:
+                    self.idx_txn.drop(self.dbs[db], delete=False)
+
+                self._use_key_format(key_format)
+                assocs = sorted(
+                        (self._sep.join(tkeys), ck) for tkeys, ck in assocs)
+                with self.cur('spo:c') as cur:
+                    cur.putmulti(assocs, append=True)
+                with self.cur('c:spo') as cur:
+                    cur.putmulti(
+                            sorted((ck, spok) for spok, ck in assocs),
+                            append=True)
+                self._index_triples('add', {spok for spok, ck in assocs})
+        except:
+            self._use_key_format(old_format)
+            raise
+
+        logger.info('Converted {} triple keys to {} format.'.format(
+                len(assocs), key_format))
+
+        return len(assocs)
+
+
+    def rebuild_composite_indices(self):
+        '''
+        Rebuild the two-term lookup indices from the triples in `spo:c`.
+
+        If the indices are disabled in the configuration, they are only
+        emptied.
+
+        @return int Number of indexed triples.
+        '''
+        sep = self._sep
+        entries = {idx: [] for idx in self.composite_keys}
+        with TxnManager(self, True):
+            for idx in self.composite_keys:
+                self.idx_txn.drop(self.dbs[idx], delete=False)
+            if not self.composite_idx:
+                return 0
+
+            with self.cur('spo:c') as cur:
+                for spok in cur.iternext_nodup():
+                    sk, pk, ok = self._split_key(spok)
+                    entries['sp:o'].append((sk + sep + pk, ok))
+                    entries['po:s'].append((pk + sep + ok, sk))
+                    entries['so:p'].append((sk + sep + ok, pk))
+            for idx, items in entries.items():
+                items.sort()
+                with self.cur(idx) as cur:
+                    cur.putmulti(items, append=True)
+
+        return len(entries['sp:o'])
+
+
+    def rebuild_term_indices(self):
+        '''
+        Rebuild the literal text and range indices from the terms in `t:st`.
+
+        The indices that are disabled in the configuration are only emptied.
+
+        @return int Number of index entries.
+        '''
+        with TxnManager(self, True):
+            for idx in self.term_idx_keys:
+                self.idx_txn.drop(self.dbs[idx], delete=False)
+
+            with self.cur('t:st') as cur:
+                entries = self._term_index_entries(
+                        (bytes(tk), self._unpickle(st)) for tk, st in cur)
+            for idx, items in entries.items():
+                items.sort()
+                with self.cur(idx) as cur:
+                    cur.putmulti(items, append=True)
+
+        return sum(len(items) for items in entries.values())
+
+
+    def rebuild_indices(self, workers=None):
+        '''
+        Rebuild all the index databases from the main data.
+
+        The term hashes in `th:t` are computed from `t:st` by several worker
+        processes. The other indices are built from `spo:c` and `pfx:ns`.
+        Every index is then written in key order.
+
+        With the `split` layout, the indices are written to a new file which
+        then replaces the index file, so the store is never left with a
+        partial index even if this is interrupted. With the `single` layout,
+        they are replaced in one write transaction. The store is closed and
+        reopened in the process, so it must not be in use.
+
+        @param workers (int) Number of worker processes used for hashing. By
+        default, one per CPU. If 1, the hashes are computed in this process.
+
+        @return int Number of indexed triples.
+        '''
+        if self.is_txn_open:
+            raise RuntimeError(
+                    'Indices cannot be rebuilt in a transaction.')
+
+        with TxnManager(self):
+            entries = self._index_entries()
+            entries['th:t'] = self._term_hashes(workers or os.cpu_count())
+            idx_flags = {
+                db_label: self.dbs[db_label].flags(self.idx_txn)
+                for db_label in self.idx_keys}
+
+        for items in entries.values():
+            items.sort()
+        # With the legacy term format, several keys may have the same hash.
+        # Only the first one is indexed, like when the terms were stored.
+        th_t = entries['th:t']
+        entries['th:t'] = [
+                item for i, item in enumerate(th_t)
+                if i == 0 or item[0] != th_t[i - 1][0]]
+
+        if self.env_layout == 'single':
+            with TxnManager(self, True):
+                for db_label, items in entries.items():
+                    self.idx_txn.drop(self.dbs[db_label], delete=False)
+                    with self.cur(db_label) as cur:
+                        cur.putmulti(items, append=True)
+        else:
+            path = self.idx_env.path()
+            options = {
+                k: v for k, v in self.env_options.items()
+                if k not in ('readonly', 'lock')}
+            if exists(path + '.new'):
+                os.remove(path + '.new')
+            new_env = lmdb.open(
+                    path + '.new', subdir=False, lock=False,
+                    max_dbs=len(self.idx_keys), **options)
+            try:
+                with new_env.begin(write=True) as txn:
+                    for db_label, items in entries.items():
+                        db = new_env.open_db(
+                                s2b(db_label), txn=txn,
+                                **idx_flags[db_label])
+                        with txn.cursor(db) as cur:
+                            cur.putmulti(items, append=True)
+                new_env.sync(True)
+            finally:
+                new_env.close()
+            self.close()
+            os.replace(path + '.new', path)
+            self.open(create=False)
+
+        self._clear_caches()
+        logger.info('Rebuilt indices for {} triples.'.format(
+                len(entries['s:po'])))
+
+        return len(entries['s:po'])
+
+
+    def remove_orphan_terms(self):
+        '''
+        Delete the terms that are not used by any triple or context.
+
+        Removing triples leaves their terms in `t:st` and `th:t`, because
+        other triples may still use them. This finds the terms that are
+        neither subject, predicate or object of a triple in the lookup
+        indices, nor a context, and deletes them in one write transaction.
+        The keys of deleted terms may be assigned to new terms later.
+
+        No other process should use the store while this runs, since it may
+        have the deleted terms in its caches.
+
+        @return int Number of deleted terms.
+        '''
+        with TxnManager(self, True):
+            self._apply_idx_queue()
+            with ExitStack() as stack:
+                ref_curs = [
+                    stack.enter_context(self.cur(idx))
+                    for idx in ('s:po', 'p:so', 'o:sp', 'c:')]
+                with self.cur('t:st') as cur:
+                    orphans = [
+                        (bytes(tk), bytes(st)) for tk, st in cur
+                        if not any(
+                            ref_cur.set_key(tk) for ref_cur in ref_curs)]
+
+            with self.cur('t:st') as st_cur, self.cur('th:t') as th_cur:
+                for tk, st in orphans:
+                    if st_cur.set_key(tk):
+                        st_cur.delete()
+                    # With the legacy term format, several keys may have
+                    # the same hash, and only one of them is indexed.
+                    if th_cur.get(self._hash(st)) == tk:
+                        th_cur.delete()
+
+            entries = self._term_index_entries(
+                    (tk, self._unpickle(st)) for tk, st in orphans)
+            for idx, items in entries.items():
+                with self.cur(idx) as cur:
+                    for k, v in sorted(items):
+                        if cur.set_key_dup(k, v):
+                            cur.delete()
+
+        self._clear_caches()
+        logger.info('Deleted {} orphan terms.'.format(len(orphans)))
+
+        return len(orphans)
+
+
+    def compact(self):
+        '''
+        Rewrite the store files without their free pages.
+
+        LMDB files never shrink: pages freed by deleted data are reused for
+        new data, but they stay in the file. This copies all the databases of
+        each environment, in key order, into a new file, replaces the
+        original file with the copy and reopens the store. The environments
+        are closed while the files are replaced, so the store must not be in
+        use.
+
+        @return tuple(int) Size of the store files in bytes, before and after
+        compaction.
+        '''
+        if self.is_txn_open:
+            raise RuntimeError(
+                    'The store cannot be compacted in a transaction.')
+
+        paths = [env.path() for env in self.envs]
+        size_before = sum(os.stat(path).st_size for path in paths)
+        for env, db_labels in self._env_dbs():
+            with env.begin(buffers=True) as src_txn:
+                self._copy_env(src_txn, db_labels, env.path() + '.compact')
+
+        self.close()
+        for path in paths:
+            os.replace(path + '.compact', path)
+        self.open(create=False)
+        size_after = sum(os.stat(path).st_size for path in paths)
+        logger.info('Compacted store from {} to {} bytes.'.format(
+                size_before, size_after))
+
+        return size_before, size_after
+
+
+    def backup(self, dest):
+        '''
+        Copy the store to a folder while it is in use.
+
+        All environments are copied from read-only snapshots taken at the
+        same point in time, so the copy is consistent even if other threads or
+        processes are writing. Writers are only held while the snapshots are
+        opened. The copy is compacted like with `compact`.
+
+        While the copy is running, pages freed by new writes cannot be
+        reused, so the store files may grow.
+
+        @param dest (string) Destination folder. It is created if it does not
+        exist, and must not contain a store.
+
+        @return int Size of the copy in bytes.
+        '''
+        if self.is_txn_open:
+            raise RuntimeError('The store cannot be copied in a transaction.')
+
+        env_dbs = self._env_dbs()
+        dest_paths = [
+            os.path.join(dest, os.path.basename(env.path()))
+            for env, _ in env_dbs]
+        if any(exists(path) for path in dest_paths):
+            raise FileExistsError(
+                    'A store already exists in {}.'.format(dest))
+        makedirs(dest, exist_ok=True)
+
+        if self.env_options.get('readonly'):
+            snapshots = [env.begin(buffers=True) for env, _ in env_dbs]
+        else:
+            # Writers begin a write transaction on every environment before
+            # committing any, so while these are held, no commit is half
+            # done.
+            with self._write_lock:
+                wtxns = [env.begin(write=True) for env in self.envs]
+                try:
+                    snapshots = [
+                            env.begin(buffers=True) for env, _ in env_dbs]
+                finally:
+                    for wtxn in wtxns:
+                        wtxn.abort()
+
+        try:
+            for snapshot, (_, db_labels), dest_path in zip(
+                    snapshots, env_dbs, dest_paths):
+                self._copy_env(snapshot, db_labels, dest_path)
+        finally:
+            for snapshot in snapshots:
+                snapshot.abort()
+        size = sum(os.stat(path).st_size for path in dest_paths)
+        logger.info('Copied store to {}: {} bytes.'.format(dest, size))
+
+        return size
+
+
     def commit(self):
         '''
         Commit main transaction and push action queue.
         '''
         logger.debug('Committing transaction.')
+        if self.is_txn_rw:
+            # Errors writing the deferred indices, e.g. a full map, must not
+            # be swallowed below: the transaction is rolled back instead.
+            try:
+                self._apply_idx_queue()
+            except:
+                self.rollback()
+                raise
         try:
             self.data_txn.commit()
-            self.idx_txn.commit()
+            if self.idx_txn is not self.data_txn:
+                self.idx_txn.commit()
         except lmdb.Error:
             pass
+        finally:
+            if self.is_txn_rw:
+                self._write_lock.release()
 
+        self._txn.idx_queue.clear()
         self.data_txn = self.idx_txn = self.is_txn_rw = None
 
 
@@ -726,10 +2047,17 @@ class LmdbStore(Store):
         logger.debug('Rolling back transaction.')
         try:
             self.data_txn.abort()
-            self.idx_txn.abort()
+            if self.idx_txn is not self.data_txn:
+                self.idx_txn.abort()
         except lmdb.Error:
             pass
-        self.is_txn_rw = None
+        self._txn.idx_queue.clear()
+        # Keys assigned to new terms in this transaction are discarded and
+        # may be reassigned to different terms later.
+        if self.is_txn_rw:
+            self._clear_caches()
+            self._write_lock.release()
+        self.data_txn = self.idx_txn = self.is_txn_rw = None
 
 
     ## PRIVATE METHODS ##
@@ -749,7 +2077,6 @@ class LmdbStore(Store):
             context = None
 
         if context is not None:
-            pk_c = self._pickle(context)
             ck = self._to_key(context)
 
             # Shortcuts
@@ -793,13 +2120,16 @@ class LmdbStore(Store):
         '''
         Initialize the DB environment.
 
-        The main database is kept in one file, the indices in a separate one
-        (these may be even further split up depending on performance
-        considerations).
+        Depending on the layout (see `ENV_LAYOUTS`), the main database and
+        the indices are kept in two separate files or in a single one.
 
         @param create (bool) If True, the environment and its databases are
         created.
         '''
+        self.env_options = self._env_options()
+        if self.env_options.get('readonly'):
+            create = False
+
         path = self.path
         if not exists(path):
             if create is True:
@@ -807,18 +2137,26 @@ class LmdbStore(Store):
             else:
                 return NO_STORE
 
-        self.data_env = lmdb.open(path + '/main', subdir=False, create=create,
-                map_size=self.MAP_SIZE, max_dbs=4, readahead=False)
-        self.idx_env = lmdb.open(path + '/index', subdir=False, create=create,
-                map_size=self.MAP_SIZE, max_dbs=6, readahead=False)
+        self.env_layout = self._env_layout()
+        if self.env_layout == 'single':
+            self.data_env = self.idx_env = lmdb.open(
+                    path + '/store', subdir=False, create=create,
+                    max_dbs=len(self.data_keys) + len(self.idx_keys),
+                    **self.env_options)
+        else:
+            self.data_env = lmdb.open(
+                    path + '/main', subdir=False, create=create,
+                    max_dbs=len(self.data_keys), **self.env_options)
+            self.idx_env = lmdb.open(
+                    path + '/index', subdir=False, create=create,
+                    max_dbs=len(self.idx_keys), **self.env_options)
 
         # Clear stale readers.
-        data_stale_readers = self.data_env.reader_check()
-        idx_stale_readers = self.idx_env.reader_check()
-        logger.debug(
-                'Cleared data stale readers: {}'.format(data_stale_readers))
-        logger.debug(
-                'Cleared index stale readers: {}'.format(idx_stale_readers))
+        if self.env_options.get('lock', True):
+            for env in self.envs:
+                stale_readers = env.reader_check()
+                logger.debug('Cleared stale readers in {}: {}'.format(
+                        env.path(), stale_readers))
 
         # Open and optionally create main databases.
         self.dbs = {
@@ -838,6 +2176,244 @@ class LmdbStore(Store):
                 self.dbs[db_key] = self.idx_env.open_db(s2b(db_key),
                         dupsort=True, dupfixed=True, create=create)
 
+        self._set_term_format()
+        self._set_key_format()
+
+
+    def _env_layout(self):
+        '''
+        Layout of the store environments, detected from the existing files.
+
+        If no store files exist yet, the configured layout is used.
+
+        @return string One of `ENV_LAYOUTS`.
+        '''
+        if exists(self.path + '/store'):
+            return 'single'
+        if exists(self.path + '/main'):
+            return 'split'
+
+        env_layout = self.config.get('env_layout', self.DEFAULT_ENV_LAYOUT)
+        if env_layout not in self.ENV_LAYOUTS:
+            raise ValueError(
+                    'Environment layout \'{}\' is not supported.'.format(
+                        env_layout))
+
+        return env_layout
+
+
+    def _env_options(self):
+        '''
+        LMDB environment options from the configured profile and overrides.
+
+        @return dict
+        '''
+        profile = self.config.get('lmdb_profile', self.DEFAULT_ENV_PROFILE)
+        if profile not in self.ENV_PROFILES:
+            raise ValueError(
+                    'LMDB profile \'{}\' is not defined.'.format(profile))
+
+        options = {'map_size': self.MAP_SIZE, 'readahead': False}
+        options.update(self.ENV_PROFILES[profile])
+        options.update(self.config.get('lmdb_options') or {})
+        for option in options:
+            if option not in self.ENV_OPTIONS:
+                raise ValueError(
+                        'LMDB option \'{}\' is not supported.'.format(option))
+        logger.debug('LMDB profile: {}; options: {}'.format(profile, options))
+
+        return options
+
+
+    def _check_composite_indices(self):
+        '''
+        Bring the two-term lookup indices in line with the configuration.
+
+        The indices are built from `spo:c` if they are enabled and the store
+        has triples but no composite index entries, e.g. the first time an
+        existing store is opened with the option set. If they are disabled,
+        any existing entries are deleted, since they would go stale.
+        '''
+        with self.idx_env.begin() as txn:
+            idx_entries = txn.stat(self.dbs['sp:o'])['entries']
+        if self.composite_idx:
+            with self.data_env.begin() as txn:
+                missing = (
+                        not idx_entries
+                        and txn.stat(self.dbs['spo:c'])['entries'])
+            if missing and self.env_options.get('readonly'):
+                logger.warning(
+                        'Two-term lookup indices cannot be built on a '
+                        'read-only store. They will not be used.')
+                self.composite_idx = False
+            elif missing:
+                logger.info('Building two-term lookup indices.')
+                self.rebuild_composite_indices()
+        elif idx_entries and not self.env_options.get('readonly'):
+            logger.info('Two-term lookup indices are disabled. Clearing.')
+            self.rebuild_composite_indices()
+
+
+    def _check_term_indices(self):
+        '''
+        Bring the literal text and range indices in line with the
+        configuration.
+
+        Like `_check_composite_indices`, an index is built if it is enabled
+        and empty, and cleared if it is disabled. Both are rebuilt together,
+        since they are built from the same scan of `t:st`.
+        '''
+        with self.data_env.begin() as txn:
+            has_terms = bool(txn.stat(self.dbs['t:st'])['entries'])
+        rebuild = False
+        for idx, option, name in (
+                ('tok:t', 'text_idx', 'text index'),
+                ('val:t', 'range_idx', 'range index')):
+            with self.idx_env.begin() as txn:
+                idx_entries = txn.stat(self.dbs[idx])['entries']
+            if getattr(self, option):
+                if has_terms and not idx_entries:
+                    if self.env_options.get('readonly'):
+                        logger.warning(
+                                'The {} cannot be built on a read-only '
+                                'store. It will not be used.'.format(name))
+                        setattr(self, option, False)
+                    else:
+                        logger.info('Building the {}.'.format(name))
+                        rebuild = True
+            elif idx_entries and not self.env_options.get('readonly'):
+                logger.info('The {} is disabled. Clearing.'.format(name))
+                rebuild = True
+
+        if rebuild:
+            self.rebuild_term_indices()
+
+
+    def _tokenize(self, term):
+        '''
+        Words of a literal, as text index keys.
+
+        @param term (rdflib.term.Identifier) Term to tokenize. Only literals
+        have tokens.
+
+        @return set(bytes)
+        '''
+        if not isinstance(term, Literal):
+            return set()
+
+        return {
+            s2b(token[:self.TOKEN_MAX_LENGTH])
+            for token in self.TOKEN_RE.findall(str(term).casefold())}
+
+
+    def _term_index_entries(self, terms):
+        '''
+        Text and range index entries for a set of terms.
+
+        @param terms (iterable(tuple)) Term key and term pairs.
+
+        @return dict(string, list) Unsorted key and term key pairs by label
+        of the enabled indices.
+        '''
+        entries = {}
+        if self.text_idx:
+            entries['tok:t'] = []
+        if self.range_idx:
+            entries['val:t'] = []
+        if not entries:
+            return entries
+
+        for tk, term in terms:
+            if self.text_idx:
+                entries['tok:t'].extend(
+                        (token, tk) for token in self._tokenize(term))
+            if self.range_idx:
+                vk = term_codec.value_key(term)
+                if vk is not None:
+                    entries['val:t'].append((vk, tk))
+
+        return entries
+
+
+    def _set_term_format(self):
+        '''
+        Set the term serialization functions based on the stored terms.
+
+        New stores use the binary format in `term_codec`. Stores whose terms
+        were serialized as RDFLib pickles keep using pickles until they are
+        migrated, since the term hashes in `th:t` depend on the format.
+        '''
+        with self.data_env.begin() as txn:
+            with txn.cursor(self.dbs['t:st']) as cur:
+                legacy = cur.first() and term_codec.is_pickle(cur.value())
+
+        if legacy:
+            logger.warning(
+                    'Terms in store {} are in the legacy pickle format. Run '
+                    '`lsup-admin migrate_terms` to convert them.'.format(
+                        self.path))
+            self.term_format = 'pickle'
+            self._pickle = self.node_pickler.dumps
+            self._unpickle = self.node_pickler.loads
+        else:
+            self.term_format = 'binary'
+            self._pickle = term_codec.dumps
+            self._unpickle = term_codec.loads
+
+
+    def _set_key_format(self):
+        '''
+        Set the compound key format based on the stored triple keys.
+
+        If the store has no triples, no compound keys are stored anywhere and
+        the configured format is used.
+        '''
+        with self.data_env.begin() as txn:
+            with txn.cursor(self.dbs['spo:c']) as cur:
+                spok_len = len(cur.key()) if cur.first() else None
+
+        if spok_len is None:
+            key_format = self.config.get('key_format', self.DEFAULT_KEY_FORMAT)
+            if key_format not in self.KEY_FORMATS:
+                raise ValueError(
+                        'Key format \'{}\' is not supported.'.format(
+                            key_format))
+        elif spok_len == self.KEY_LENGTH * 3:
+            key_format = 'fixed'
+        else:
+            key_format = 'separator'
+            logger.info(
+                    'Store {} uses separator-joined keys. Run `lsup-admin '
+                    'migrate_keys` to convert them.'.format(self.path))
+
+        self._use_key_format(key_format)
+
+
+    def _use_key_format(self, key_format):
+        '''
+        Switch the functions that compose and split compound keys.
+
+        @param key_format (string) One of `KEY_FORMATS`.
+        '''
+        self.key_format = key_format
+        # Joining with an empty bytestring is a plain concatenation.
+        self._sep = self.SEP_BYTE if key_format == 'separator' else b''
+
+
+    def _split_key(self, key):
+        '''
+        Split a compound key into term keys.
+
+        @param key (bytes | memoryview) Compound key.
+
+        @return list(bytes)
+        '''
+        key = bytes(key)
+        if self._sep:
+            return key.split(self._sep)
+        kl = self.KEY_LENGTH
+        return [key[i:i + kl] for i in range(0, len(key), kl)]
+
 
     def _from_key(self, key):
         '''
@@ -845,12 +2421,19 @@ class LmdbStore(Store):
 
         @param key (bytes) The key to be converted. It can be a compound one
         in which case the function will return multiple terms.
+
+        Decoded terms are cached in `_key_term_cache`, so the same key always
+        yields the same term instance as long as it is cached.
         '''
         terms = []
-        with self.cur('t:st') as cur:
-            for k in bytes(key).split(self.SEP_BYTE):
-                pk_t = cur.get(k)
-                terms.append(self._unpickle(pk_t))
+        for k in self._split_key(key):
+            term = self._key_term_cache.get(k)
+            if term is None:
+                term = self._unpickle(
+                        self.data_txn.get(k, db=self.dbs['t:st']))
+                self._key_term_cache.put(k, term)
+                self._term_key_cache.put(self._cache_key(term), k)
+            terms.append(term)
 
         return tuple(terms)
 
@@ -866,23 +2449,185 @@ class LmdbStore(Store):
         database. Pairs of terms, as well as triples and quads, are expressed
         as tuples.
 
-        If more than one term is provided, the keys are concatenated using the
-        designated separator byte (`\x00`).
+        If more than one term is provided, the keys are concatenated,
+        separated by `SEP_BYTE` if the store uses the `separator` key format.
+
+        Keys of individual terms are cached in `_term_key_cache`.
 
         @return bytes
         '''
         if not isinstance(obj, list) and not isinstance(obj, tuple):
             obj = (obj,)
         key = []
-        with self.cur('th:t') as cur:
-            for term in obj:
-                tk = cur.get(self._hash(self._pickle(term)))
+        for term in obj:
+            cache_key = self._cache_key(term)
+            tk = self._term_key_cache.get(cache_key)
+            if tk is None:
+                tk = self.idx_txn.get(
+                        self._hash(self._pickle(term)), db=self.dbs['th:t'])
                 if not tk:
                     # If any of the terms is not found, return None immediately
                     return None
-                key.append(tk)
+                self._term_key_cache.put(cache_key, tk)
+                if tk not in self._key_term_cache:
+                    self._key_term_cache.put(tk, term)
+            key.append(tk)
+
+        return self._sep.join(key)
+
+
+    def _env_dbs(self):
+        '''
+        Labels of the databases in each environment.
 
-        return self.SEP_BYTE.join(key)
+        @return list(tuple) Environment and database label list pairs.
+        '''
+        if self.env_layout == 'single':
+            return [(self.data_env, self.data_keys + self.idx_keys)]
+        return [
+            (self.data_env, self.data_keys),
+            (self.idx_env, self.idx_keys)]
+
+
+    def _copy_env(self, src_txn, db_labels, dest_path):
+        '''
+        Copy databases into a new environment file, in key order.
+
+        A new environment filled with appends has no free pages and densely
+        packed leaves. LMDB's own compacting copy
+        (`Environment.copy(compact=True)`) is not used because it crashes on
+        `dupfixed` databases with more values for a key than fit in a page,
+        like the lookup indices (reproduced with py-lmdb 3.0.0 and LMDB
+        0.9.36 by `util/lmdb_compact_copy_crash.py`).
+
+        @param src_txn (lmdb.Transaction) Transaction to read the databases
+        from.
+        @param db_labels (list(string)) Labels of the databases to copy.
+        @param dest_path (string) Path of the new environment file. An
+        existing file is overwritten.
+        '''
+        options = {
+            k: v for k, v in self.env_options.items()
+            if k not in ('readonly', 'lock')}
+        if exists(dest_path):
+            os.remove(dest_path)
+        dest_env = lmdb.open(
+                dest_path, subdir=False, lock=False,
+                max_dbs=len(db_labels), **options)
+        try:
+            for db_label in db_labels:
+                src_db = self.dbs[db_label]
+                dest_db = dest_env.open_db(
+                        s2b(db_label), **src_db.flags(src_txn))
+                with dest_env.begin(write=True) as dest_txn:
+                    with src_txn.cursor(src_db) as src_cur, \
+                            dest_txn.cursor(dest_db) as dest_cur:
+                        dest_cur.putmulti(src_cur.iternext(), append=True)
+            dest_env.sync(True)
+        finally:
+            dest_env.close()
+
+
+    def _index_entries(self):
+        '''
+        Build the entries of all indices except `th:t` from the main data.
+
+        This must be run in a transaction.
+
+        @return dict(string, list) Unsorted key and value pairs by index
+        label.
+        '''
+        sep = self._sep
+        entries = {
+            db_label: [] for db_label in self.idx_keys if db_label != 'th:t'}
+        with self.cur('pfx:ns') as cur:
+            entries['ns:pfx'] = [(bytes(ns), bytes(pfx)) for pfx, ns in cur]
+
+        last_spok = None
+        with self.cur('spo:c') as cur:
+            for spok, ck in cur:
+                spok = bytes(spok)
+                entries['c:spo'].append((bytes(ck), spok))
+                if spok == last_spok:
+                    continue
+                last_spok = spok
+                sk, pk, ok = self._split_key(spok)
+                entries['s:po'].append((sk, pk + sep + ok))
+                entries['p:so'].append((pk, sk + sep + ok))
+                entries['o:sp'].append((ok, sk + sep + pk))
+                if self.composite_idx:
+                    entries['sp:o'].append((sk + sep + pk, ok))
+                    entries['po:s'].append((pk + sep + ok, sk))
+                    entries['so:p'].append((sk + sep + ok, pk))
+
+        if self.text_idx or self.range_idx:
+            with self.cur('t:st') as cur:
+                entries.update(self._term_index_entries(
+                        (bytes(tk), self._unpickle(st)) for tk, st in cur))
+
+        return entries
+
+
+    def _term_hashes(self, workers):
+        '''
+        Hash all the terms in `t:st`.
+
+        The terms are read in chunks, which are handed to the worker
+        processes. Only a few chunks per worker are queued at any time, so
+        that the terms are never all in memory. This must be run in a
+        transaction.
+
+        @param workers (int) Number of worker processes.
+
+        @return list(tuple(bytes)) Unsorted hash and key pairs.
+        '''
+        algo = self.KEY_HASH_ALGO
+        hashes = []
+        with self.cur('t:st') as cur:
+            terms = iter(cur)
+            chunks = iter(lambda: [
+                    (bytes(tk), bytes(st))
+                    for tk, st in islice(terms, self.HASH_CHUNK_SIZE)], [])
+
+            if workers == 1:
+                for chunk in chunks:
+                    hashes.extend(_hash_terms(algo, chunk))
+                return hashes
+
+            # Workers are forked, rather than spawned, so that the script
+            # that started the rebuild is not imported again. They do not
+            # touch the LMDB environments inherited from this process.
+            pending = deque()
+            with ProcessPoolExecutor(
+                    workers, mp_context=multiprocessing.get_context('fork')) \
+                            as executor:
+                for chunk in chunks:
+                    pending.append(executor.submit(_hash_terms, algo, chunk))
+                    if len(pending) > 2 * workers:
+                        hashes.extend(pending.popleft().result())
+                for future in pending:
+                    hashes.extend(future.result())
+
+        return hashes
+
+
+    def _clear_caches(self):
+        '''
+        Invalidate the term and key caches.
+        '''
+        self._term_key_cache.clear()
+        self._key_term_cache.clear()
+
+
+    def _cache_key(self, term):
+        '''
+        Key used to look up a term in the term cache.
+
+        RDFLib considers literals with the same value and differently cased
+        language tags equal, but they are serialized and stored separately,
+        therefore the language tag is part of the cache key.
+        '''
+        return (term, term.language) if isinstance(term, Literal) else term
 
 
     def _hash(self, s):
@@ -908,47 +2653,241 @@ class LmdbStore(Store):
         return context
 
 
+    def _count_keys(self, key_pattern):
+        '''
+        Count the triples matching a pattern of term keys from the number of
+        values of an index key.
+
+        The count is exact if the pattern has no bound terms, or one bound
+        term, or two if the composite indices are enabled, or three. With
+        two bound terms and no composite indices, the smaller count of the
+        single-term index keys is returned, which is an upper bound.
+
+        @param key_pattern (tuple) Subject, predicate and object keys. None
+        stands for an unbound term.
+
+        @return int
+        '''
+        # Pending index updates must be visible to the counts.
+        self._apply_idx_queue()
+
+        bound = [label for label, k in zip('spo', key_pattern) if k is not None]
+        if not bound:
+            return self.idx_txn.stat(self.dbs['s:po'])['entries']
+        if len(bound) == 3:
+            with self.cur('spo:c') as cur:
+                return int(cur.set_key(self._sep.join(key_pattern)))
+
+        if len(bound) == 2 and not self.composite_idx:
+            lookups = [(label,) for label in bound]
+        else:
+            lookups = [bound]
+        counts = []
+        for labels in lookups:
+            idx_name = '{}:{}'.format(
+                    ''.join(labels),
+                    ''.join(label for label in 'spo' if label not in labels))
+            with self.cur(idx_name) as cur:
+                counts.append(cur.count() if cur.set_key(self._sep.join(
+                    key_pattern['spo'.index(label)] for label in labels))
+                    else 0)
+
+        return min(counts)
+
+
+    def _join_plan(self, key_patterns):
+        '''
+        Order the patterns of a join.
+
+        The next pattern is chosen among those sharing a variable with the
+        patterns already chosen, or among all the remaining ones if none
+        does. It is the one with the fewest variables not yet bound, like in
+        RDFLib's own evaluation, then with the fewest matches.
+
+        @param key_patterns (list(tuple)) Patterns of term keys and
+        variables.
+
+        @return list(tuple) Patterns and their estimated match counts, in
+        evaluation order.
+        '''
+        remaining = [
+            (key_pattern, self._count_keys([
+                None if isinstance(term, Variable) else term
+                for term in key_pattern]))
+            for key_pattern in key_patterns]
+        plan = []
+        bound_vars = set()
+        while remaining:
+            connected = [
+                item for item in remaining
+                if bound_vars.intersection(item[0])] or remaining
+            item = min(connected, key=lambda item: (
+                len({
+                    term for term in item[0] if isinstance(term, Variable)}
+                    - bound_vars),
+                item[1]))
+            remaining.remove(item)
+            plan.append(item)
+            bound_vars.update(
+                    term for term in item[0] if isinstance(term, Variable))
+
+        return plan
+
+
+    def _match_keys(self, key_pattern, var_pos, ctx_filter=None):
+        '''
+        Match a pattern of term keys.
+
+        @param key_pattern (list) Subject, predicate and object keys. None
+        stands for an unbound term.
+        @param var_pos (list(tuple)) Variables and their positions in the
+        pattern, for the unbound terms.
+        @param ctx_filter (callable | None) Function returning whether a
+        triple key is in the context being searched.
+
+        @return generator(dict) Keys bound to the variables in each match.
+        '''
+        budget = self._txn.budget
+        for spok in self._lookup_keys(key_pattern):
+            if budget:
+                budget.charge()
+            if ctx_filter and not ctx_filter(spok):
+                continue
+            keys = self._split_key(spok)
+            match = {}
+            for var, i in var_pos:
+                # A variable repeated in the pattern must match the same key.
+                if match.setdefault(var, keys[i]) != keys[i]:
+                    break
+            else:
+                yield match
+
+
+    def _lookup_join(self, rows, key_pattern, ctx_filter=None):
+        '''
+        Join partial solutions with a pattern looked up for each of them.
+
+        @param rows (iterable(dict)) Partial solutions as variable: key maps.
+        @param key_pattern (tuple) Pattern of term keys and variables.
+        @param ctx_filter (callable | None) See `_match_keys`.
+
+        @return generator(dict) Extended solutions.
+        '''
+        var_pos = [
+            (term, i) for i, term in enumerate(key_pattern)
+            if isinstance(term, Variable)]
+        base_pattern = [
+            None if isinstance(term, Variable) else term
+            for term in key_pattern]
+        for row in rows:
+            bound_pattern = base_pattern[:]
+            free_pos = []
+            for var, i in var_pos:
+                k = row.get(var)
+                if k is None:
+                    free_pos.append((var, i))
+                else:
+                    bound_pattern[i] = k
+            for match in self._match_keys(
+                    bound_pattern, free_pos, ctx_filter):
+                yield {**row, **match}
+
+
+    def _hash_join(self, rows, key_pattern, shared, ctx_filter=None):
+        '''
+        Join partial solutions with the matches of a pattern, looked up once.
+
+        @param rows (iterable(dict)) Partial solutions as variable: key maps.
+        @param key_pattern (tuple) Pattern of term keys and variables.
+        @param shared (list(rdflib.Variable)) Variables of the pattern bound
+        in the partial solutions. If empty, the cross product is generated.
+        @param ctx_filter (callable | None) See `_match_keys`.
+
+        @return generator(dict) Extended solutions.
+        '''
+        var_pos = [
+            (term, i) for i, term in enumerate(key_pattern)
+            if isinstance(term, Variable)]
+        table = {}
+        for match in self._match_keys(
+                [None if isinstance(term, Variable) else term
+                    for term in key_pattern],
+                var_pos, ctx_filter):
+            table.setdefault(
+                    tuple(match[var] for var in shared), []).append(match)
+        if not table:
+            return
+
+        for row in rows:
+            for match in table.get(tuple(row[var] for var in shared), ()):
+                yield {**row, **match}
+
+
     def _lookup(self, triple_pattern):
         '''
         Look up triples in the indices based on a triple pattern.
 
         @return iterator of matching triple keys.
         '''
-        s, p, o = triple_pattern
+        key_pattern = []
+        for term in triple_pattern:
+            if term is None:
+                key_pattern.append(None)
+                continue
+            k = self._to_key(term)
+            if not k:
+                # A bound term is not in the store.
+                return
+            key_pattern.append(k)
+
+        yield from self._lookup_keys(key_pattern)
+
+
+    def _lookup_keys(self, key_pattern):
+        '''
+        Look up triples in the indices based on a pattern of term keys.
+
+        @param key_pattern (tuple) Subject, predicate and object keys. None
+        stands for an unbound term.
+
+        @return iterator of matching triple keys.
+        '''
+        # Pending index updates must be visible to lookups.
+        self._apply_idx_queue()
+
+        sk, pk, ok = key_pattern
 
-        if s is not None:
-            if p is not None:
+        if sk is not None:
+            if pk is not None:
                 # s p o
-                if o is not None:
+                if ok is not None:
                     with self.cur('spo:c') as cur:
-                        tkey = self._to_key(triple_pattern)
+                        tkey = self._sep.join(key_pattern)
                         if cur.set_key(tkey):
                             yield tkey
-                            return
-                        else:
-                            return iter(())
+                        return
                 # s p ?
                 else:
-                    yield from self._lookup_2bound({'s': s, 'p': p})
+                    yield from self._lookup_2bound({'s': sk, 'p': pk})
             else:
                 # s ? o
-                if o is not None:
-                    yield from self._lookup_2bound({'s': s, 'o': o})
+                if ok is not None:
+                    yield from self._lookup_2bound({'s': sk, 'o': ok})
                 # s ? ?
                 else:
-                    yield from self._lookup_1bound('s', s)
+                    yield from self._lookup_1bound('s', sk)
         else:
-            if p is not None:
+            if pk is not None:
                 # ? p o
-                if o is not None:
-                    yield from self._lookup_2bound({'p': p, 'o': o})
+                if ok is not None:
+                    yield from self._lookup_2bound({'p': pk, 'o': ok})
                 # ? p ?
                 else:
-                    yield from self._lookup_1bound('p', p)
+                    yield from self._lookup_1bound('p', pk)
             else:
                 # ? ? o
-                if o is not None:
-                    yield from self._lookup_1bound('o', o)
+                if ok is not None:
+                    yield from self._lookup_1bound('o', ok)
                 # ? ? ?
                 else:
                     # Get all triples in the database.
@@ -956,147 +2895,336 @@ class LmdbStore(Store):
                         yield from cur.iternext_nodup()
 
 
-    def _lookup_1bound(self, label, term):
+    def _lookup_1bound(self, label, k):
         '''
         Lookup triples for a pattern with one bound term.
 
         @TODO This can be called millions of times in a larger SPARQL
         query, so it better be as efficient as it gets.
+
+        @param label (string) Position of the bound term: 's', 'p' or 'o'.
+        @param k (bytes) Key of the bound term.
         '''
-        #import pdb; pdb.set_trace()
-        k = self._to_key(term)
-        if not k:
-            return iter(())
         idx_name = '{}:{}'.format(label, 'spo'.replace(label, ''))
         term_order = self._lookup_ordering[idx_name]
         with self.cur(idx_name) as cur:
-            if cur.set_key(k):
+            if not cur.set_key(k):
+                return
+            if not self._sep:
+                # The other two keys are stored in triple order, so the
+                # looked up key only needs to be inserted at its offset.
+                offset = term_order[0] * self.KEY_LENGTH
+                if offset == 0:
+                    for match in cur.iternext_dup():
+                        yield k + match
+                elif offset == 2 * self.KEY_LENGTH:
+                    for match in cur.iternext_dup():
+                        yield match + k
+                else:
+                    for match in cur.iternext_dup():
+                        yield match[:offset] + k + match[offset:]
+                return
+
+            for match in cur.iternext_dup():
+                subkeys = bytes(match).split(self.SEP_BYTE)
+
+                # Compose result.
+                out = [None, None, None]
+                out[term_order[0]] = k
+                out[term_order[1]] = subkeys[0]
+                out[term_order[2]] = subkeys[1]
+
+                yield self.SEP_BYTE.join(out)
+
+
+    def _lookup_2bound(self, bound_keys):
+        '''
+        Look up triples for a pattern with two bound terms.
+
+        Unless the composite indices are enabled, the term with fewer
+        entries in its single-term index is looked up, based on the
+        duplicate count of each key, and the results are filtered by the
+        other term.
+
+        @param bound_keys (dict) Triple labels and keys of the terms to
+        search for, in the format of, e.g. {'s': sk, 'o': ok}
+        '''
+        if len(bound_keys) != 2:
+            raise ValueError(
+                    'Exactly 2 terms need to be bound. Got {}'.format(
+                        len(bound_keys)))
+
+        if self.composite_idx:
+            yield from self._lookup_composite(bound_keys)
+            return
+
+        # Look up both terms in their own index and iterate over the values
+        # of the one with fewer matches, filtering by the other one.
+        curs = {}
+        try:
+            for label, tk in bound_keys.items():
+                cur = self.cur('{}:{}'.format(label, 'spo'.replace(label, '')))
+                curs[label] = (cur, tk)
+                if not cur.set_key(tk):
+                    return
+            # Lookup label and filter label.
+            k_label, f_label = sorted(
+                    curs.keys(), key=lambda label: curs[label][0].count())
+
+            cur, luk = curs[k_label]
+            ft = curs[f_label][1]
+            v_label = 'spo'.replace(k_label, '')
+            term_order = self._lookup_ordering[k_label + ':' + v_label]
+            # Position of the filter key in lookup results.
+            fpos = v_label.index(f_label)
+
+            if not self._sep:
+                kl = self.KEY_LENGTH
+                fstart = fpos * kl
+                fend = fstart + kl
+                offset = term_order[0] * kl
                 for match in cur.iternext_dup():
-                    subkeys = bytes(match).split(self.SEP_BYTE)
+                    if match[fstart:fend] == ft:
+                        yield match[:offset] + luk + match[offset:]
+                return
+
+            # Iterate over matches and filter by second term.
+            for match in cur.iternext_dup():
+                subkeys = bytes(match).split(self.SEP_BYTE)
+                flt_subkey = subkeys[fpos]
+                if flt_subkey == ft:
+                    # Remainder (not filter) key used to complete the
+                    # triple.
+                    r_subkey = subkeys[1-fpos]
 
                     # Compose result.
                     out = [None, None, None]
-                    out[term_order[0]] = k
-                    out[term_order[1]] = subkeys[0]
-                    out[term_order[2]] = subkeys[1]
+                    out[term_order[0]] = luk
+                    out[term_order[fpos+1]] = flt_subkey
+                    out[term_order[2-fpos]] = r_subkey
 
                     yield self.SEP_BYTE.join(out)
+        finally:
+            for cur, _ in curs.values():
+                cur.close()
 
 
-    def _lookup_2bound(self, bound_terms):
+    def _lookup_composite(self, bound_keys):
         '''
-        Look up triples for a pattern with two bound terms.
+        Look up triples for a pattern with two bound terms in the two-term
+        indices.
 
-        @param bound terms (dict) Triple labels and terms to search for,
-        in the format of, e.g. {'s': URIRef('urn:s:1'), 'o':
-        URIRef('urn:o:1')}
+        @param bound_keys (dict) Triple labels and keys of the terms to
+        search for, as in `_lookup_2bound`.
         '''
-        #import pdb; pdb.set_trace()
-        if len(bound_terms) != 2:
-            raise ValueError(
-                    'Exactly 2 terms need to be bound. Got {}'.format(
-                        len(bound_terms)))
-
-        # Establish lookup ranking.
-        luc = None
-        for k_label in self._lookup_rank:
-            if k_label in bound_terms.keys():
-                # First match is lookup term.
-                if not luc:
-                    v_label = 'spo'.replace(k_label, '')
-                    # Lookup database key (cursor) name
-                    luc = k_label + ':' + v_label
-                    term_order = self._lookup_ordering[luc]
-                    # Term to look up
-                    luk = self._to_key(bound_terms[k_label])
-                    if not luk:
-                        return iter(())
-                    # Position of key in final triple.
-                # Second match is the filter.
-                else:
-                    # Filter key (position of sub-key in lookup results)
-                    fpos = v_label.index(k_label)
-                    # Fliter term
-                    ft = self._to_key(bound_terms[k_label])
-                    if not ft:
-                        return iter(())
-                    break
+        k_labels = [label for label in 'spo' if label in bound_keys]
+        keys = [bound_keys[label] for label in k_labels]
+        idx_name = '{}:{}'.format(
+                ''.join(k_labels),
+                'spo'.replace(k_labels[0], '').replace(k_labels[1], ''))
+        term_order = self._lookup_ordering[idx_name]
 
-        # Look up in index.
-        with self.cur(luc) as cur:
-            if cur.set_key(luk):
-                # Iterate over matches and filter by second term.
+        with self.cur(idx_name) as cur:
+            if not cur.set_key(self._sep.join(keys)):
+                return
+            if not self._sep:
+                # The looked up keys are in triple order, so the value only
+                # needs to be inserted at its offset.
+                lukey = keys[0] + keys[1]
+                offset = term_order[2] * self.KEY_LENGTH
                 for match in cur.iternext_dup():
-                    subkeys = bytes(match).split(self.SEP_BYTE)
-                    flt_subkey = subkeys[fpos]
-                    if flt_subkey == ft:
-                        # Remainder (not filter) key used to complete the
-                        # triple.
-                        r_subkey = subkeys[1-fpos]
+                    yield lukey[:offset] + match + lukey[offset:]
+                return
+
+            for match in cur.iternext_dup():
+                # Compose result.
+                out = [None, None, None]
+                out[term_order[0]] = keys[0]
+                out[term_order[1]] = keys[1]
+                out[term_order[2]] = match
+
+                yield self.SEP_BYTE.join(out)
 
-                        # Compose result.
-                        out = [None, None, None]
-                        out[term_order[0]] = luk
-                        out[term_order[fpos+1]] = flt_subkey
-                        out[term_order[2-fpos]] = r_subkey
 
-                        yield self.SEP_BYTE.join(out)
+    def _get_or_create_keys(self, terms):
+        '''
+        Get the keys of a set of terms, storing the terms not yet in the
+        database.
+
+        Terms not found in the cache are looked up in `th:t` in hash order,
+        and the new ones are appended to `t:st` and indexed in single
+        `putmulti` calls.
+
+        @param terms (dict) Terms keyed by their cache key (see `_cache_key`).
+
+        @return dict Term keys keyed by the same cache keys.
+        '''
+        keys = {}
+        missing = []
+        for cache_key, term in terms.items():
+            tk = self._term_key_cache.get(cache_key)
+            if tk is None:
+                st = self._pickle(term)
+                missing.append((self._hash(st), st, cache_key))
+            else:
+                keys[cache_key] = tk
+
+        if missing:
+            missing.sort(key=lambda m: m[0])
+            new_terms = []
+            with self.cur('th:t') as icur:
+                for thash, st, cache_key in missing:
+                    if icur.set_key(thash):
+                        keys[cache_key] = icur.value()
+                    else:
+                        new_terms.append((thash, st, cache_key))
+
+            if new_terms:
+                with self.cur('t:st') as dcur:
+                    new_keys = self._append(
+                            dcur, [nt[1] for nt in new_terms], append=True)
+                with self.cur('th:t') as icur:
+                    icur.putmulti(
+                            [(nt[0], tk) for nt, tk in zip(new_terms, new_keys)])
+                for nt, tk in zip(new_terms, new_keys):
+                    keys[nt[2]] = tk
+                term_idx_entries = self._term_index_entries(
+                        (tk, terms[nt[2]])
+                        for nt, tk in zip(new_terms, new_keys))
+                for idx, items in term_idx_entries.items():
+                    with self.cur(idx) as cur:
+                        cur.putmulti(sorted(items))
+
+            for thash, st, cache_key in missing:
+                tk = keys[cache_key]
+                self._term_key_cache.put(cache_key, tk)
+                if tk not in self._key_term_cache:
+                    self._key_term_cache.put(tk, terms[cache_key])
+
+        return keys
+
+
+    @contextmanager
+    def _side_txns(self):
+        '''
+        Open write transactions for a change made outside of the main
+        transaction of the current thread, e.g. by RDFLib during a read-only
+        operation.
+
+        The transactions are committed on exit, or aborted on error. The
+        write lock is held until then, so that this waits for the write
+        transaction of another thread or greenlet instead of conflicting with
+        it.
+
+        @return tuple(lmdb.Transaction) Data and index transactions. They are
+        the same transaction if the environment layout is `single`.
+        '''
+        with self._write_lock, ExitStack() as stack:
+            data_txn = stack.enter_context(self.data_env.begin(write=True))
+            if self.env_layout == 'single':
+                idx_txn = data_txn
+            else:
+                idx_txn = stack.enter_context(self.idx_env.begin(write=True))
+            # Keys must not be assigned from the counter of another
+            # transaction.
+            self._txn.next_key = None
+            try:
+                yield data_txn, idx_txn
+            finally:
+                self._txn.next_key = None
+
 
     def _append(self, cur, values, **kwargs):
         '''
-        Append one or more values to the end of a database.
+        Append one or more values to the end of `t:st` with new term keys.
+
+        The last key in the database is only read for the first append in a
+        write transaction. Further keys are assigned from a counter.
 
-        @param cur (lmdb.Cursor) The write cursor to act on.
+        @param cur (lmdb.Cursor) The write cursor on `t:st`.
         @param data (list(bytes)) Value(s) to append.
 
         @return list(bytes) Last key(s) inserted.
         '''
         if not isinstance(values, list) and not isinstance(values, tuple):
             raise ValueError('Input must be a list or tuple.')
-        data = []
-        lastkey = cur.key() if cur.last() else None
-        for v in values:
-            lastkey = self._key_seq.next(lastkey)
-            data.append((lastkey, v))
+        if self._txn.next_key is None:
+            self._txn.next_key = (
+                    self._key_seq.to_int(cur.key()) + 1 if cur.last() else 1)
+        keys = self._key_seq.range(self._txn.next_key, len(values))
+        self._txn.next_key += len(values)
 
-        cur.putmulti(data, **kwargs)
+        cur.putmulti(list(zip(keys, values)), **kwargs)
 
-        return [d[0] for d in data]
+        return keys
 
 
-    def _index_triple(self, action, spok):
+    def _index_triples(self, action, spoks):
         '''
-        Update index for a triple and context (add or remove).
+        Queue lookup index updates for a set of triples (add or remove).
+
+        The updates are applied by `_apply_idx_queue` when the transaction is
+        committed, or earlier if a lookup needs the indices.
 
         @param action (string) 'add' or 'remove'.
-        @param spok (bytes) Triple key.
-        indexed. Context MUST be specified for 'add'.
-        '''
-        # Split and rearrange-join keys for association and indices.
-        triple = bytes(spok).split(self.SEP_BYTE)
-        sk, pk, ok = triple
-        spk = self.SEP_BYTE.join(triple[:2])
-        sok = bytes(triple[0]) + self.SEP_BYTE + bytes(triple[2])
-        pok = self.SEP_BYTE.join(triple[1:3])
-
-        # Associate cursor labels with k/v pairs.
-        curs = {
-            's:po': (sk, pok),
-            'p:so': (pk, sok),
-            'o:sp': (ok, spk),
+        @param spoks (iterable(bytes)) Triple keys.
+        '''
+        if action not in ('add', 'remove'):
+            raise ValueError(
+                'Index action \'{}\' is not supported.'.format(action))
+
+        for spok in spoks:
+            self._txn.idx_queue[bytes(spok)] = action
+
+
+    def _apply_idx_queue(self):
+        '''
+        Write the queued lookup index updates in key order and clear the
+        queue.
+
+        A triple queued for removal is only removed from the indices if it is
+        no longer associated with any context, since removals can be
+        restricted to one context.
+        '''
+        if not self._txn.idx_queue:
+            return
+
+        sep = self._sep
+        idx_labels = ['s:po', 'p:so', 'o:sp']
+        if self.composite_idx:
+            idx_labels.extend(self.composite_keys)
+        entries = {
+            'add': {idx: [] for idx in idx_labels},
+            'remove': {idx: [] for idx in idx_labels},
         }
+        with self.cur('spo:c') as cur:
+            for spok, action in self._txn.idx_queue.items():
+                if action == 'remove' and cur.set_key(spok):
+                    continue
+                # Split and rearrange-join keys for association and indices.
+                sk, pk, ok = self._split_key(spok)
+                entries[action]['s:po'].append((sk, pk + sep + ok))
+                entries[action]['p:so'].append((pk, sk + sep + ok))
+                entries[action]['o:sp'].append((ok, sk + sep + pk))
+                if self.composite_idx:
+                    entries[action]['sp:o'].append((sk + sep + pk, ok))
+                    entries[action]['po:s'].append((pk + sep + ok, sk))
+                    entries[action]['so:p'].append((sk + sep + ok, pk))
+        self._txn.idx_queue.clear()
 
         # Add or remove triple lookups.
-        for clabel, terms in curs.items():
+        for clabel in idx_labels:
             with self.cur(clabel) as icur:
-                if action == 'remove':
-                    if icur.set_key_dup(*terms):
-                        icur.delete()
-                elif action == 'add':
-                    icur.put(*terms)
-                else:
-                    raise ValueError(
-                        'Index action \'{}\' is not supported.'.format(action))
+                rm_items = entries['remove'][clabel]
+                if rm_items:
+                    rm_items.sort()
+                    for k, v in rm_items:
+                        if icur.set_key_dup(k, v):
+                            icur.delete()
+                add_items = entries['add'][clabel]
+                if add_items:
+                    add_items.sort()
+                    icur.putmulti(add_items)
 
 
     ## Convenience methods—not necessary for functioning but useful for
@@ -1129,6 +3257,6 @@ class LmdbStore(Store):
         with self.cur('spo:c') as cur:
             if cur.set_key(tkey):
                 ctx = cur.iternext_dup()
-                return {self._unpickle(c) for c in ctx}
+                return {self._from_key(c)[0] for c in ctx}
             else:
                 return set()
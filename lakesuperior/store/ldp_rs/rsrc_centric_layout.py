@@ -1,10 +1,14 @@
 import logging
 
 from collections import defaultdict
-from itertools import chain
 
-from rdflib import Dataset, Graph, Literal, URIRef, plugin
+from rdflib import BNode, Dataset, Graph, Literal, URIRef, Variable, plugin
 from rdflib.namespace import RDF
+from rdflib.plugins.sparql import CUSTOM_EVALS
+from rdflib.plugins.sparql.evaluate import evalQuery
+from rdflib.plugins.sparql.parserutils import CompValue
+from rdflib.plugins.sparql.processor import prepareQuery
+from rdflib.plugins.sparql.sparql import Query
 from rdflib.query import ResultException
 from rdflib.resource import Resource
 from rdflib.store import Store
@@ -13,10 +17,13 @@ from lakesuperior.dictionaries.namespaces import ns_collection as nsc
 from lakesuperior.dictionaries.namespaces import ns_mgr as nsm
 from lakesuperior.dictionaries.srv_mgd_terms import  srv_mgd_subjects, \
         srv_mgd_predicates, srv_mgd_types
-from lakesuperior.exceptions import (InvalidResourceError,
-        ResourceNotExistsError, TombstoneError, PathSegmentError)
+from lakesuperior.exceptions import (InvalidQueryError,
+        InvalidResourceError, ResourceNotExistsError, TombstoneError,
+        PathSegmentError)
 from lakesuperior.env import env
 from lakesuperior.store.ldp_rs.lmdb_store import TxnManager
+from lakesuperior.store.ldp_rs.sparql_evals import (
+        bgp_eval, query_eval, text_search_eval)
 
 
 META_GR_URI = nsc['fcsystem']['meta']
@@ -26,6 +33,9 @@ VERS_CONT_LABEL = 'fcr:versions'
 
 Lmdb = plugin.register('Lmdb', Store,
         'lakesuperior.store.ldp_rs.lmdb_store', 'LmdbStore')
+CUSTOM_EVALS['lsup_query'] = query_eval
+CUSTOM_EVALS['lsup_text_search'] = text_search_eval
+CUSTOM_EVALS['lsup_bgp'] = bgp_eval
 logger = logging.getLogger(__name__)
 
 
@@ -109,6 +119,9 @@ class RsrcCentricLayout:
         nsc['fcstruct']: nsc['fcsystem'].StructureGraph,
     }
 
+    # URI prefixes of the resource graphs, for fast string matching.
+    _rsrc_gr_prefixes = tuple(str(pfx) for pfx in graph_ns_types.keys())
+
 
     ## MAGIC METHODS ##
 
@@ -122,7 +135,8 @@ class RsrcCentricLayout:
         which is currently the reference implementation.
         '''
         self.config = config
-        self.store = plugin.get('Lmdb', Store)(config['location'])
+        self.store = plugin.get('Lmdb', Store)(
+                config['location'], config=config)
         self.ds = Dataset(self.store, default_union=True)
         self.ds.namespace_manager = nsm
 
@@ -201,20 +215,146 @@ class RsrcCentricLayout:
         Return a count of first-class resources, subdivided in "live" and
         historic snapshots.
         '''
+        ptn = (None, nsc['foaf'].primaryTopic, None)
         with TxnManager(self.ds.store) as txn:
-            main = set(
-                    self.ds.graph(META_GR_URI)[ : nsc['foaf'].primaryTopic : ])
-            hist = set(
-                    self.ds.graph(HIST_GR_URI)[ : nsc['foaf'].primaryTopic : ])
+            main = self.ds.store.count(ptn, META_GR_URI)
+            hist = self.ds.store.count(ptn, HIST_GR_URI)
 
-        return {'main': len(main), 'hist': len(hist)}
+        return {'main': main, 'hist': hist}
 
 
-    def raw_query(self, qry_str):
+    def raw_query(self, qry_str, bindings=None):
         '''
         Perform a straight query to the graph store.
+
+        @param qry_str (string | rdflib.plugins.sparql.sparql.Query) SPARQL
+        query, or query parsed by `prepare_query`.
+        @param bindings (dict | None) Initial variable bindings.
+        '''
+        return self.ds.query(qry_str, initBindings=bindings or {})
+
+
+    def prepare_query(self, qry_str):
+        '''
+        Parse a query for `stream_query` or `raw_query`.
+
+        The configured namespace prefixes are available to the query, as in
+        `raw_query`.
+
+        @param qry_str (string) SPARQL query.
+
+        @return rdflib.plugins.sparql.sparql.Query
+
+        @raise InvalidQueryError If the query cannot be parsed or translated.
+        '''
+        init_ns = dict(self.ds.namespaces())
+        try:
+            return prepareQuery(qry_str, initNs=init_ns)
+        except Exception as e:
+            # Besides syntax errors, RDFLib raises plain exceptions for
+            # undeclared prefixes and queries it cannot translate. This only
+            # parses the query, so no other error is expected.
+            raise InvalidQueryError(str(e)) from e
+
+
+    def stream_query(self, qry, bindings=None):
+        '''
+        Evaluate a query without collecting its results.
+
+        Unlike `raw_query`, SELECT solutions and CONSTRUCT triples are
+        computed one by one as they are consumed, which must happen within
+        the same transaction. CONSTRUCT triples are not deduplicated.
+
+        @param qry (rdflib.plugins.sparql.sparql.Query) Query prepared with
+        `prepare_query`.
+        @param bindings (dict | None) Initial variable bindings.
+
+        @return tuple(string, list, iterator) Query type (`SELECT`, `ASK`,
+        `CONSTRUCT` or `DESCRIBE`); projected variables of a SELECT query;
+        and results: variable bindings for SELECT, triples for CONSTRUCT and
+        DESCRIBE, and a single boolean for ASK.
+        '''
+        algebra = qry.algebra
+        if algebra.name == 'ConstructQuery':
+            # Evaluate the pattern as a SELECT query and fill the template
+            # with each solution, instead of adding all the triples to a
+            # graph. The template is kept in the algebra so that its
+            # variables are decoded (see `sparql_evals.query_eval`).
+            template = algebra.template or algebra.p.p.triples
+            select = CompValue(
+                    'SelectQuery', p=algebra.p, PV=[], template=template,
+                    datasetClause=algebra.datasetClause)
+            res = evalQuery(self.ds, Query(qry.prologue, select), bindings or {})
+            return 'CONSTRUCT', [], (
+                trp for solution in res['bindings']
+                for trp in self._fill_template(template, solution))
+
+        res = evalQuery(self.ds, qry, bindings or {})
+        if res['type_'] == 'SELECT':
+            return 'SELECT', res['vars_'], res['bindings']
+        elif res['type_'] == 'ASK':
+            return 'ASK', [], iter((res['askAnswer'],))
+        else:
+            return res['type_'], [], iter(res['graph'])
+
+
+    def search_literals(self, text, prop=None, prefix=False):
+        '''
+        Find the resource properties whose value contains some words.
+
+        Historic versions are not searched.
+
+        @param text (string) Words to look for. See `LmdbStore.search_terms`.
+        @param prop (rdflib.URIRef | None) Only search values of this
+        property.
+        @param prefix (bool) Whether the words may also match the beginning
+        of longer words.
+
+        @return generator(tuple) UID, property and value of each match.
+        '''
+        return self._literal_matches(
+                self.store.search_terms(text, prefix), prop)
+
+
+    def search_values(
+            self, low=None, high=None, prop=None, incl_low=True,
+            incl_high=True):
+        '''
+        Find the resource properties whose value is within a range.
+
+        Historic versions are not searched.
+
+        @param low (rdflib.Literal | None) Lower bound. See
+        `LmdbStore.search_range`.
+        @param high (rdflib.Literal | None) Upper bound.
+        @param prop (rdflib.URIRef | None) Only search values of this
+        property.
+        @param incl_low (bool) Whether values equal to the lower bound match.
+        @param incl_high (bool) Whether values equal to the upper bound match.
+
+        @return generator(tuple) UID, property and value of each match, in
+        value order.
         '''
-        return self.ds.query(qry_str)
+        return self._literal_matches(
+                self.store.search_range(low, high, incl_low, incl_high),
+                prop)
+
+
+    def _literal_matches(self, literals, prop=None):
+        '''
+        Resource properties that have some literals as values.
+
+        @param literals (iterable(rdflib.Literal)) Values.
+        @param prop (rdflib.URIRef | None) Only yield this property.
+
+        @return generator(tuple) UID, property and value of each match,
+        excluding historic versions.
+        '''
+        for lit in literals:
+            for (s, p, o), _ in self.store.triples((None, prop, lit)):
+                uid = self.uri_to_uid(s)
+                if s.startswith(nsc['fcres']) and VERS_CONT_LABEL not in uid:
+                    yield uid, p, o
 
 
     def extract_imr(
@@ -232,13 +372,10 @@ class RsrcCentricLayout:
         if not incl_children:
             graphs.remove(nsc['fcstruct'][uid])
 
-        rsrc_graphs = [
-                self.ds.graph(gr)
-                for gr in graphs]
-        resultset = set(chain.from_iterable(rsrc_graphs))
-
+        # Read all the graphs in one pass and add the triples directly to the
+        # output graph, which also removes duplicates.
         gr = Graph()
-        gr += resultset
+        gr.addN(trp + (gr,) for trp in self.store.context_triples(graphs))
 
         # Include inbound relationships.
         if incl_inbound and len(gr):
@@ -272,7 +409,10 @@ class RsrcCentricLayout:
         logger.debug('Getting metadata for: {}'.format(uid))
         if ver_uid:
             uid = self.snapshot_uid(uid, ver_uid)
-        gr = self.ds.graph(nsc['fcadmin'][uid]) | Graph()
+        gr = Graph()
+        gr.addN(
+                trp + (gr,) for trp in self.store.context_triples(
+                    (nsc['fcadmin'][uid],)))
         uri = nsc['fcres'][uid]
 
         rsrc = Resource(gr, uri)
@@ -325,7 +465,13 @@ class RsrcCentricLayout:
         Query inbound relationships for a subject.
 
         This can be a list of either complete triples, or of subjects referring
-        to the given URI. It excludes historic version snapshots.
+        to the given URI. Only the triples having a live resource as a subject,
+        found in the graph of any live resource, are returned; historic version
+        snapshots are excluded.
+
+        Whether a graph is live is determined from its URI (see
+        `_graph_topic`). A subject is looked up in the metadata graph only if
+        it is not the resource that the graph is about, and once per call.
 
         @param subj_uri (rdflib.URIRef) Subject URI.
         @param full_triple (boolean) Whether to return the full triples found
@@ -334,14 +480,22 @@ class RsrcCentricLayout:
         @return iterator(tuple(rdflib.term.Identifier) | rdflib.URIRef)
         Inbound triples or subjects.
         '''
-        # Only return non-historic graphs.
-        meta_gr = self.ds.graph(META_GR_URI)
+        is_live = lambda gr_uri: self._graph_topic(gr_uri) is not None
         ptopic_uri = nsc['foaf'].primaryTopic
+        live_subjects = {}
+
+        def is_live_subject(s, gr_uri):
+            if s == self._graph_topic(gr_uri):
+                return True
+            if s not in live_subjects:
+                live_subjects[s] = bool(self.store.count(
+                        (None, ptopic_uri, s), META_GR_URI))
+            return live_subjects[s]
 
         yield from (
             (match[:3] if full_triple else match[0])
-            for match in self.ds.quads((None, None, subj_uri, None))
-            if set(meta_gr[ : ptopic_uri : match[0]])
+            for match in self.store.quads((None, None, subj_uri), is_live)
+            if is_live_subject(match[0], match[3])
         )
 
 
@@ -416,7 +570,7 @@ class RsrcCentricLayout:
 
         # Remove inbound references.
         if inbound:
-            for ibs in self.get_inbound_rel(uri):
+            for ibs in set(self.get_inbound_rel(uri)):
                 self.ds.remove(ibs)
 
         # Remove versions.
@@ -471,9 +625,11 @@ class RsrcCentricLayout:
         for gr_uri, trp in remove_routes.items():
             gr = self.ds.graph(gr_uri)
             gr -= trp
-        for gr_uri, trp in add_routes.items():
-            gr = self.ds.graph(gr_uri)
-            gr += trp
+        # All additions are inserted in one batch.
+        self.ds.addN(
+                (*t, gr_uri)
+                for gr_uri, trp in add_routes.items() for t in trp)
+        for gr_uri in add_routes.keys():
             # Add metadata.
             meta_gr.set(
                     (gr_uri, nsc['foaf'].primaryTopic, nsc['fcres'][uid]))
@@ -571,6 +727,53 @@ class RsrcCentricLayout:
             return qres.graph
 
 
+    def _fill_template(self, template, solution):
+        '''
+        Instantiate a CONSTRUCT template with a query solution.
+
+        Blank nodes in the template are replaced with new ones for each
+        solution. Triples with unbound variables are skipped.
+
+        @param template (list(tuple)) Triple patterns.
+        @param solution (dict) Variable bindings.
+
+        @return generator(tuple) Triples.
+        '''
+        bnodes = defaultdict(BNode)
+        for trp in template:
+            trp = tuple(
+                bnodes[term] if isinstance(term, BNode)
+                else solution.get(term) if isinstance(term, Variable)
+                else term
+                for term in trp)
+            if None not in trp:
+                yield trp
+
+
+    def _graph_topic(self, gr_uri):
+        '''
+        Get the resource that a graph is about, from the graph URI.
+
+        This is the same as the `foaf:primaryTopic` set for the graph in the
+        metadata graph by `modify_rsrc`. Version snapshots, whose UIDs contain
+        `VERS_CONT_LABEL`, and graphs that are not resource graphs have no
+        topic.
+
+        @param gr_uri (rdflib.URIRef) Graph URI.
+
+        @return rdflib.URIRef | None Resource URI.
+        '''
+        gr_str = str(gr_uri)
+        for pfx in self._rsrc_gr_prefixes:
+            if gr_str.startswith(pfx):
+                uid = gr_str[len(pfx):]
+                if VERS_CONT_LABEL not in uid:
+                    return nsc['fcres'][uid]
+                break
+
+        return None
+
+
     def _map_graph_uri(self, t, uid):
         '''
         Map a triple to a namespace prefix corresponding to a graph.
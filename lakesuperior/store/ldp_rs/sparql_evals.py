@@ -0,0 +1,261 @@
+import logging
+
+from collections import Counter
+from itertools import chain
+
+from rdflib import BNode, Variable
+from rdflib.graph import ConjunctiveGraph
+from rdflib.paths import Path
+from rdflib.plugins.sparql.evaluate import evalBGP
+from rdflib.plugins.sparql.parserutils import CompValue
+from rdflib.plugins.sparql.sparql import FrozenBindings, SPARQLError
+
+from lakesuperior.dictionaries.namespaces import ns_collection as nsc
+
+__doc__ = '''
+Custom SPARQL evaluation functions for the LMDB store.
+
+These are registered in `rdflib.plugins.sparql.CUSTOM_EVALS` by the store
+layout, and are tried by RDFLib on each part of a query before its own
+evaluation.
+'''
+
+logger = logging.getLogger(__name__)
+
+'''
+Text search predicates. In a basic graph pattern, `?lit fcsystem:textSearch
+"some words"` binds `?lit` to each literal containing all the words of the
+object, as found by `LmdbStore.search_terms`. `fcsystem:textPrefixSearch`
+also matches words starting with the given ones. E.g.:
+
+    SELECT ?s WHERE {
+        ?lit fcsystem:textSearch "pomegranate" .
+        ?s dcterms:title ?lit .
+    }
+'''
+TEXT_SEARCH = nsc['fcsystem'].textSearch
+TEXT_PREFIX_SEARCH = nsc['fcsystem'].textPrefixSearch
+TEXT_SEARCH_PREDICATES = (TEXT_SEARCH, TEXT_PREFIX_SEARCH)
+
+'''Algebra parts at the root of a query.'''
+QUERY_PARTS = ('SelectQuery', 'AskQuery', 'ConstructQuery', 'DescribeQuery')
+
+'''
+Key of the algebra of a basic graph pattern where `query_eval` stores the
+variables used outside of it.
+'''
+OUT_VARS_KEY = '_lsup_out_vars'
+
+
+def query_eval(ctx, part):
+    '''
+    Find the variables of each basic graph pattern of a query that are used
+    outside of it.
+
+    This does not evaluate the query: it stores the variables in the algebra
+    of each pattern, for `bgp_eval`, and lets RDFLib go on. The terms of the
+    other variables, which are only used to join the triple patterns, are
+    never decoded.
+
+    @param ctx (rdflib.plugins.sparql.sparql.QueryContext) Query context.
+    @param part (rdflib.plugins.sparql.parserutils.CompValue) Query part.
+    '''
+    if part.name not in QUERY_PARTS:
+        raise NotImplementedError()
+
+    bgps = []
+    outside = set()
+    _collect_vars(part, bgps, outside)
+    bgp_vars = [_pattern_vars(bgp.triples) for bgp in bgps]
+    # Variables found in more than one pattern.
+    shared = {
+        var for var, count in Counter(chain.from_iterable(bgp_vars)).items()
+        if count > 1}
+    for bgp, pattern_vars in zip(bgps, bgp_vars):
+        bgp[OUT_VARS_KEY] = {
+            var for var in pattern_vars
+            if var in outside or var in shared}
+
+    raise NotImplementedError()
+
+
+def bgp_eval(ctx, part):
+    '''
+    Evaluate a basic graph pattern by joining term keys in the store.
+
+    See `LmdbStore.join_patterns`.
+
+    @param ctx (rdflib.plugins.sparql.sparql.QueryContext) Query context.
+    @param part (rdflib.plugins.sparql.parserutils.CompValue) Query part.
+
+    @return generator(rdflib.plugins.sparql.sparql.FrozenBindings)
+    '''
+    if part.name != 'BGP' or not hasattr(ctx.graph.store, 'join_patterns'):
+        raise NotImplementedError()
+    if any(trp[1] in TEXT_SEARCH_PREDICATES for trp in part.triples):
+        # Handled by `text_search_eval`.
+        raise NotImplementedError()
+    if _has_paths(part.triples):
+        # Property paths are evaluated by RDFLib.
+        raise NotImplementedError()
+
+    return _eval_join(ctx, part.triples, getattr(part, OUT_VARS_KEY))
+
+
+def text_search_eval(ctx, part):
+    '''
+    Evaluate a basic graph pattern containing text search predicates.
+
+    The search patterns are resolved first, then the rest of the pattern is
+    evaluated with the literals found.
+
+    @param ctx (rdflib.plugins.sparql.sparql.QueryContext) Query context.
+    @param part (rdflib.plugins.sparql.parserutils.CompValue) Query part.
+
+    @return generator(rdflib.plugins.sparql.sparql.FrozenBindings)
+    '''
+    if part.name != 'BGP' or not hasattr(ctx.graph.store, 'search_terms'):
+        raise NotImplementedError()
+
+    search = [trp for trp in part.triples if trp[1] in TEXT_SEARCH_PREDICATES]
+    if not search:
+        raise NotImplementedError()
+    rest = [
+        trp for trp in part.triples if trp[1] not in TEXT_SEARCH_PREDICATES]
+
+    return _eval_search(ctx, search, rest, getattr(part, OUT_VARS_KEY))
+
+
+def _eval_search(ctx, search, rest, out_vars=None):
+    '''
+    Bind the subjects of text search patterns, then evaluate the others.
+
+    @param ctx (rdflib.plugins.sparql.sparql.QueryContext) Query context.
+    @param search (list(tuple)) Text search patterns not yet evaluated.
+    @param rest (list(tuple)) Other triple patterns.
+    @param out_vars (set | None) Variables used outside of the pattern. See
+    `query_eval`.
+    '''
+    if not search:
+        if (
+                hasattr(ctx.graph.store, 'join_patterns')
+                and not _has_paths(rest)):
+            yield from _eval_join(ctx, rest, out_vars)
+            return
+        # Patterns with more bound terms first, like RDFLib does.
+        yield from evalBGP(ctx, sorted(
+                rest, key=lambda trp: len([
+                    term for term in trp if ctx[term] is None])))
+        return
+
+    s, p, o = search[0]
+    text = ctx[o]
+    if text is None:
+        raise SPARQLError('The text to search for must be bound.')
+
+    bound_s = ctx[s]
+    for term in ctx.graph.store.search_terms(
+            str(text), prefix=p == TEXT_PREFIX_SEARCH):
+        if bound_s is None:
+            c = ctx.push()
+            c[s] = term
+        elif bound_s == term:
+            c = ctx
+        else:
+            continue
+        yield from _eval_search(c, search[1:], rest, out_vars)
+
+
+def _eval_join(ctx, triples, out_vars=None):
+    '''
+    Join triple patterns in the store.
+
+    Terms bound in the context are used as constants. Blank nodes in the
+    patterns are variables, as in RDFLib's own evaluation.
+
+    @param ctx (rdflib.plugins.sparql.sparql.QueryContext) Query context.
+    @param triples (list(tuple)) Triple patterns.
+    @param out_vars (set | None) Variables to bind in the solutions. If
+    None, all the variables are bound.
+
+    @return generator(rdflib.plugins.sparql.sparql.FrozenBindings)
+    '''
+    # Pattern variables by query variable or blank node. Blank node labels
+    # are made into names that no SPARQL variable can have.
+    pattern_vars = {
+        var: var if isinstance(var, Variable) else Variable('_:' + var)
+        for var in _pattern_vars(triples) if ctx[var] is None}
+    patterns = [
+        tuple(pattern_vars.get(term) or ctx[term] for term in trp)
+        for trp in triples]
+    query_vars = {pvar: var for var, pvar in pattern_vars.items()}
+    if out_vars is not None:
+        out_vars = {
+            pattern_vars[var] for var in out_vars if var in pattern_vars}
+
+    if isinstance(ctx.graph, ConjunctiveGraph):
+        context = (
+                None if ctx.graph.default_union
+                else ctx.graph.default_context.identifier)
+    else:
+        context = ctx.graph.identifier
+
+    bindings = list(ctx.bindings.items())
+    for row in ctx.graph.store.join_patterns(patterns, out_vars, context):
+        yield FrozenBindings(ctx, chain(
+                bindings,
+                ((query_vars[pvar], term) for pvar, term in row.items())))
+
+
+def _has_paths(triples):
+    '''
+    Whether any triple pattern has a property path, which cannot be joined
+    on term keys.
+
+    @param triples (list(tuple)) Triple patterns.
+
+    @return boolean
+    '''
+    return any(isinstance(term, Path) for trp in triples for term in trp)
+
+
+def _pattern_vars(triples):
+    '''
+    Variables and blank nodes in triple patterns.
+
+    @param triples (list(tuple)) Triple patterns.
+
+    @return set
+    '''
+    return {
+        term for trp in triples for term in trp
+        if isinstance(term, (Variable, BNode))}
+
+
+def _collect_vars(node, bgps, outside):
+    '''
+    Collect the basic graph patterns of a query and the variables used in
+    the rest of the query.
+
+    @param node Algebra node, or any value in it.
+    @param bgps (list) Basic graph pattern parts found.
+    @param outside (set) Variables and blank nodes found outside of the
+    basic graph patterns.
+    '''
+    if isinstance(node, CompValue):
+        if node.name == 'BGP':
+            bgps.append(node)
+            return
+        for key, val in node.items():
+            # Skip the variables in scope computed by RDFLib.
+            if not key.startswith('_'):
+                _collect_vars(val, bgps, outside)
+    elif isinstance(node, (Variable, BNode)):
+        outside.add(node)
+    elif isinstance(node, dict):
+        for key, val in node.items():
+            _collect_vars(key, bgps, outside)
+            _collect_vars(val, bgps, outside)
+    elif isinstance(node, (list, tuple, set, frozenset)):
+        for val in node:
+            _collect_vars(val, bgps, outside)
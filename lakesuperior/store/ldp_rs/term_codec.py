@@ -0,0 +1,290 @@
+import logging
+
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal, InvalidOperation
+from struct import Struct
+
+from rdflib import BNode, Literal, URIRef
+from rdflib.namespace import RDF, XSD
+
+
+__doc__ = '''
+Compact binary serialization of RDF terms.
+
+This is the format used by the LMDB store to persist terms in `t:st` and to
+generate the term hashes in `th:t`. It replaces the RDFLib pickles used in
+earlier versions, which are slower to encode and decode, take up more space
+and depend on RDFLib internals.
+
+A serialized term has the following layout:
+
+- 1 byte header: format version in the 4 high bits, term type in the 4 low
+  bits;
+- for language-tagged literals: 1 byte tag length, then the ASCII tag;
+- for typed literals: 1 byte datatype ID from `DATATYPES`. If the ID is 0, the
+  datatype is not in the table and its URI follows, prefixed by a 2-byte
+  length;
+- the UTF-8-encoded lexical value of the term, up to the end of the string.
+
+Serialized pickles always start with `\\x80`, so the two formats can be told
+apart by the first byte as long as `FORMAT_VERSION` is below 8.
+
+This module also computes the value keys of the range index (see
+`value_key`), which sort literals of the same kind by value rather than by
+lexical form.
+'''
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+# Term type tags.
+TYPE_URI = 1
+TYPE_BNODE = 2
+TYPE_LITERAL = 3
+TYPE_LANG_LITERAL = 4
+TYPE_TYPED_LITERAL = 5
+
+'''
+Well-known datatypes that are stored as a 1-byte ID.
+
+This list is part of the format: new entries can only be appended and
+existing ones MUST NOT be changed or reordered without bumping
+`FORMAT_VERSION`.
+'''
+DATATYPES = (
+    None, # 0 is reserved for datatypes stored inline.
+    XSD.string,
+    XSD.boolean,
+    XSD.decimal,
+    XSD.integer,
+    XSD.double,
+    XSD.float,
+    XSD.date,
+    XSD.time,
+    XSD.dateTime,
+    XSD.duration,
+    XSD.gYear,
+    XSD.gYearMonth,
+    XSD.gMonth,
+    XSD.gMonthDay,
+    XSD.gDay,
+    XSD.hexBinary,
+    XSD.base64Binary,
+    XSD.anyURI,
+    XSD.long,
+    XSD.int,
+    XSD.short,
+    XSD.byte,
+    XSD.nonNegativeInteger,
+    XSD.positiveInteger,
+    XSD.nonPositiveInteger,
+    XSD.negativeInteger,
+    XSD.unsignedLong,
+    XSD.unsignedInt,
+    XSD.unsignedShort,
+    XSD.unsignedByte,
+    XSD.normalizedString,
+    XSD.token,
+    XSD.language,
+    RDF.XMLLiteral,
+    RDF.HTML,
+)
+_dt_ids = {dt: i for i, dt in enumerate(DATATYPES) if dt is not None}
+
+_dt_len = Struct('>H')
+
+'''
+Kinds of values that have a value key: numbers of any of the
+`NUMERIC_DATATYPES`, `xsd:date` and `xsd:dateTime`. Values of different
+kinds are never compared with each other.
+'''
+NUMERIC_DATATYPES = {
+    XSD.integer, XSD.decimal, XSD.long, XSD.int, XSD.short, XSD.byte,
+    XSD.nonNegativeInteger, XSD.positiveInteger, XSD.nonPositiveInteger,
+    XSD.negativeInteger, XSD.unsignedLong, XSD.unsignedInt,
+    XSD.unsignedShort, XSD.unsignedByte}
+VALUE_KIND_NUMERIC = b'n'
+VALUE_KIND_DATE = b'd'
+VALUE_KIND_DATETIME = b't'
+
+'''
+Numbers with more significant digits than this have no value key, so that
+keys stay well below the LMDB key size limit.
+'''
+MAX_DIGITS = 256
+
+_exp = Struct('>I')
+_ordinal = Struct('>I')
+_usec = Struct('>Q')
+_EXP_BIAS = 2 ** 31
+_DT_MIN = datetime.min
+_usec_delta = timedelta(microseconds=1)
+
+PICKLE_MARKER = 0x80
+
+
+def _header(term_type):
+    return bytes(((FORMAT_VERSION << 4) | term_type,))
+
+
+_hdr = {
+    term_type: _header(term_type)
+    for term_type in (
+        TYPE_URI, TYPE_BNODE, TYPE_LITERAL, TYPE_LANG_LITERAL,
+        TYPE_TYPED_LITERAL)}
+
+
+def dumps(term):
+    '''
+    Serialize a term.
+
+    @param term (rdflib.term.Identifier) URI, blank node or literal.
+
+    @return bytes
+    '''
+    if isinstance(term, Literal):
+        if term.language:
+            lang = term.language.encode('ascii')
+            return (
+                    _hdr[TYPE_LANG_LITERAL] + bytes((len(lang),)) + lang
+                    + term.encode('UTF-8'))
+        elif term.datatype:
+            dt_id = _dt_ids.get(term.datatype)
+            if dt_id:
+                return (
+                        _hdr[TYPE_TYPED_LITERAL] + bytes((dt_id,))
+                        + term.encode('UTF-8'))
+            dt = term.datatype.encode('UTF-8')
+            return (
+                    _hdr[TYPE_TYPED_LITERAL] + b'\x00'
+                    + _dt_len.pack(len(dt)) + dt + term.encode('UTF-8'))
+        else:
+            return _hdr[TYPE_LITERAL] + term.encode('UTF-8')
+    elif isinstance(term, URIRef):
+        return _hdr[TYPE_URI] + term.encode('UTF-8')
+    elif isinstance(term, BNode):
+        return _hdr[TYPE_BNODE] + term.encode('UTF-8')
+
+    raise ValueError('Cannot serialize term of type {}.'.format(type(term)))
+
+
+def loads(data):
+    '''
+    Deserialize a term.
+
+    @param data (bytes | memoryview) Serialized term.
+
+    @return rdflib.term.Identifier
+    '''
+    data = bytes(data)
+    hdr = data[0]
+    if hdr >> 4 != FORMAT_VERSION:
+        raise ValueError(
+                'Unsupported term serialization format: {}'.format(hdr >> 4))
+    term_type = hdr & 0x0f
+
+    if term_type == TYPE_URI:
+        return URIRef(data[1:].decode('UTF-8'))
+    elif term_type == TYPE_LITERAL:
+        return Literal(data[1:].decode('UTF-8'))
+    elif term_type == TYPE_TYPED_LITERAL:
+        dt_id = data[1]
+        if dt_id:
+            return Literal(data[2:].decode('UTF-8'), datatype=DATATYPES[dt_id])
+        dt_end = 4 + _dt_len.unpack_from(data, 2)[0]
+        return Literal(
+                data[dt_end:].decode('UTF-8'),
+                datatype=URIRef(data[4:dt_end].decode('UTF-8')))
+    elif term_type == TYPE_LANG_LITERAL:
+        lang_end = 2 + data[1]
+        return Literal(
+                data[lang_end:].decode('UTF-8'),
+                lang=data[2:lang_end].decode('ascii'))
+    elif term_type == TYPE_BNODE:
+        return BNode(data[1:].decode('UTF-8'))
+
+    raise ValueError('Unknown term type: {}'.format(term_type))
+
+
+def is_pickle(data):
+    '''
+    Whether a serialized term is a legacy pickle rather than in this format.
+
+    @param data (bytes | memoryview) Serialized term.
+
+    @return boolean
+    '''
+    return bytes(data[:1]) == bytes((PICKLE_MARKER,))
+
+
+def value_key(term):
+    '''
+    Key that sorts a literal by value among literals of the same kind.
+
+    The first byte of the key is the kind of value (`VALUE_KIND_*`), so keys
+    of one kind are contiguous. The rest of the key is:
+
+    - for numbers (`NUMERIC_DATATYPES`): a sign byte, the 4-byte biased
+      decimal exponent and the ASCII significant digits. For negative numbers
+      the exponent and digits are inverted and the digits are followed by
+      `\\xff`, so that larger magnitudes sort first;
+    - for `xsd:date`: the 4-byte proleptic Gregorian ordinal of the date.
+      Time zones are ignored;
+    - for `xsd:dateTime`: the 8-byte number of microseconds since
+      0001-01-01T00:00:00 UTC. Values without a time zone are taken as UTC.
+
+    Equal values of different datatypes or lexical forms, e.g. `"1"^^xsd:int`
+    and `"1.0"^^xsd:decimal`, have the same key.
+
+    @param term (rdflib.term.Identifier) Term.
+
+    @return bytes | None The key, or None if the term is not a literal of a
+    supported datatype or its lexical form is not valid.
+    '''
+    if not isinstance(term, Literal) or term.datatype is None:
+        return None
+    val = term.toPython()
+
+    if term.datatype in NUMERIC_DATATYPES:
+        if not isinstance(val, (int, Decimal)) or isinstance(val, bool):
+            return None
+        try:
+            val = Decimal(val)
+        except InvalidOperation:
+            return None
+        if not val.is_finite():
+            return None
+        if val == 0:
+            return VALUE_KIND_NUMERIC + b'\x01'
+        sign, digits, _ = val.normalize().as_tuple()
+        if len(digits) > MAX_DIGITS:
+            return None
+        exp = val.adjusted() + _EXP_BIAS
+        if not 0 <= exp < 2 ** 32:
+            return None
+        digits = bytes(0x30 + d for d in digits)
+        if not sign:
+            return VALUE_KIND_NUMERIC + b'\x02' + _exp.pack(exp) + digits
+        return (
+                VALUE_KIND_NUMERIC + b'\x00'
+                + _exp.pack(2 ** 32 - 1 - exp)
+                + bytes(0xff - d for d in digits) + b'\xff')
+
+    elif term.datatype == XSD.date:
+        if not isinstance(val, date) or isinstance(val, datetime):
+            return None
+        return VALUE_KIND_DATE + _ordinal.pack(val.toordinal())
+
+    elif term.datatype == XSD.dateTime:
+        if not isinstance(val, datetime):
+            return None
+        try:
+            if val.tzinfo is not None:
+                val = val.astimezone(timezone.utc).replace(tzinfo=None)
+        except OverflowError:
+            return None
+        return VALUE_KIND_DATETIME + _usec.pack(
+                (val - _DT_MIN) // _usec_delta)
+
+    return None
@@ -0,0 +1,180 @@
+import pytest
+
+from lakesuperior.api.query import ResultCache
+
+
+class TestResultCacheKey:
+    '''
+    Tests for the normalization of queries into result cache keys.
+    '''
+    def test_whitespace_comments(self):
+        '''
+        Test that whitespace and comments do not change the key.
+        '''
+        key = ResultCache.key('SELECT ?s WHERE { ?s ?p ?o }', 'csv')
+        assert ResultCache.key(
+            '  SELECT ?s\n\tWHERE {\n  ?s ?p ?o # all triples\n}\n',
+            'csv') == key
+        assert ResultCache.key(
+            b'SELECT ?s WHERE { ?s ?p ?o }', 'csv') == key
+
+
+    def test_literals_iris(self):
+        '''
+        Test that string literals and IRIs are kept verbatim.
+        '''
+        qry = 'SELECT ?s WHERE {{ ?s <urn:p> {} }}'
+        keys = {
+            ResultCache.key(qry.format(lit), 'csv')[0]
+            for lit in (
+                '"a  b"', '"a b"', '"a # b"', "'a  b'", '"""a\n\nb"""',
+                "'''a\n\nb'''", '"a \\"  b"')
+        }
+        assert len(keys) == 7
+        assert ResultCache.key(qry.format('"a # b"'), 'csv')[0] == (
+                'SELECT ?s WHERE { ?s <urn:p> "a # b" }')
+        assert ResultCache.key(
+                'ASK { <urn:a#b> ?p ?o }', 'json')[0] == (
+                'ASK { <urn:a#b> ?p ?o }')
+
+
+    def test_params(self):
+        '''
+        Test that the format, bindings and limit are part of the key.
+        '''
+        qry = 'SELECT ?s WHERE { ?s ?p ?o }'
+        keys = {
+            ResultCache.key(qry, 'csv'),
+            ResultCache.key(qry, 'json'),
+            ResultCache.key(qry, 'csv', {'p': 'urn:p'}),
+            ResultCache.key(qry, 'csv', limit=10),
+        }
+        assert len(keys) == 4
+        assert ResultCache.key(qry, 'csv', {}) == ResultCache.key(qry, 'csv')
+
+
+    @pytest.mark.parametrize('qry', (
+        'SELECT (NOW() AS ?t) WHERE {}',
+        'SELECT (rand () AS ?r) WHERE {}',
+        'SELECT ?s WHERE { ?s ?p ?o BIND(UUID() AS ?u) }',
+        'SELECT ?s WHERE { ?s ?p ?o BIND(STRUUID() AS ?u) }',
+        'SELECT ?s WHERE { ?s ?p ?o BIND(BNODE() AS ?b) }',
+        'SELECT ?s WHERE { SERVICE <http://example.org/sparql> { ?s ?p ?o } }',
+    ))
+    def test_volatile(self, qry):
+        '''
+        Test that queries with volatile functions have no key.
+        '''
+        assert ResultCache.key(qry, 'csv') is None
+
+
+    def test_volatile_literal(self):
+        '''
+        Test that volatile function names only in literals are ignored.
+        '''
+        assert ResultCache.key(
+                'SELECT ?s WHERE { ?s ?p "NOW()" }', 'csv') is not None
+
+
+class TestResultCache:
+    '''
+    Tests for the result cache.
+    '''
+    def test_generation(self):
+        '''
+        Test that entries are only served for the generation they were
+        computed from.
+        '''
+        cache = ResultCache(10, 1000)
+        cache.put('a', (1, 1), b'a1')
+        assert cache.get('a', (1, 1)) == b'a1'
+        assert cache.get('a', (1, 2)) is None
+
+        # Results of a newer generation drop all the older entries.
+        cache.put('b', (1, 2), b'b2')
+        assert 'a' not in cache
+        assert cache.get('b', (1, 2)) == b'b2'
+        assert cache.bytes == 2
+
+        # Results of an older generation are not added.
+        cache.put('a', (1, 1), b'a1')
+        assert 'a' not in cache
+        assert cache.get('b', (1, 2)) == b'b2'
+        assert cache.generation == (1, 2)
+        assert cache.stats()['hits'] == 3
+        assert cache.stats()['misses'] == 1
+
+
+    def test_entry_limit(self):
+        '''
+        Test that the least recently used entry is evicted when the cache
+        is full.
+        '''
+        cache = ResultCache(2, 1000)
+        cache.put('a', (1,), b'a')
+        cache.put('b', (1,), b'b')
+        assert cache.get('a', (1,)) == b'a'
+        cache.put('c', (1,), b'c')
+        assert 'b' not in cache
+        assert len(cache) == 2
+        assert cache.bytes == 2
+
+
+    def test_byte_limit(self):
+        '''
+        Test that the least recently used entries are evicted when the
+        results exceed the size limit.
+        '''
+        cache = ResultCache(10, 10)
+        cache.put('a', (1,), b'aaaa')
+        cache.put('b', (1,), b'bbbb')
+        cache.put('c', (1,), b'cccc')
+        assert 'a' not in cache
+        assert len(cache) == 2
+        assert cache.bytes == 8
+
+        # Replacing an entry does not count its old size.
+        cache.put('c', (1,), b'cc')
+        assert len(cache) == 2
+        assert cache.bytes == 6
+        assert cache.get('c', (1,)) == b'cc'
+
+
+    def test_too_large(self):
+        '''
+        Test that results larger than the cache are not added and do not
+        evict anything.
+        '''
+        cache = ResultCache(10, 10)
+        cache.put('a', (1,), b'aaaa')
+        cache.put('b', (1,), b'b' * 11)
+        assert 'b' not in cache
+        assert cache.get('a', (1,)) == b'aaaa'
+        assert cache.bytes == 4
+
+        cache.put('c', (1,), b'c' * 10)
+        assert 'c' in cache
+        assert 'a' not in cache
+        assert cache.bytes == 10
+
+
+    def test_disabled(self):
+        '''
+        Test that nothing is cached with a size of 0.
+        '''
+        cache = ResultCache(0, 1000)
+        cache.put('a', (1,), b'a')
+        assert len(cache) == 0
+        assert cache.get('a', (1,)) is None
+
+
+    def test_clear(self):
+        '''
+        Test that clearing the cache resets its size.
+        '''
+        cache = ResultCache(10, 1000)
+        cache.put('a', (1,), b'aaa')
+        cache.clear()
+        assert len(cache) == 0
+        assert cache.bytes == 0
+        assert cache.get('a', (1,)) is None
@@ -707,6 +707,36 @@ class TestPrefHeader:
         assert not len(set(omit_gr[inbd_subject : :]))
 
 
+    def test_inbound_rel_other_subject(self):
+        '''
+        verify that inbound relationships from a resource are found in the
+        graph of another resource, and that those from subjects that are not
+        resources are not.
+        '''
+        self.client.put('/ldp/test_inbound_target')
+        self.client.put('/ldp/test_inbound_subject')
+        target_uri = URIRef(g.webroot + '/test_inbound_target')
+        subject_uri = URIRef(g.webroot + '/test_inbound_subject')
+        holder_uri = URIRef(g.webroot + '/test_inbound_holder')
+        rel = URIRef('http://ex.org/ns#shoots')
+        data = '''
+        <{0}> <{1}> <{2}> .
+        <{3}#frag> <{1}> <{2}> .
+        '''.format(subject_uri, rel, target_uri, holder_uri)
+        self.client.put('/ldp/test_inbound_holder', data=data,
+                headers={'Content-Type': 'text/turtle'})
+
+        incl_inbound_resp = self.client.get(
+                '/ldp/test_inbound_target', headers={
+            'Prefer' : 'return=representation; include="{}"'\
+                    .format(Ldpr.RETURN_INBOUND_REF_URI),
+        })
+        incl_gr = Graph().parse(data=incl_inbound_resp.data, format='turtle')
+
+        assert incl_gr[subject_uri : rel : target_uri]
+        assert not set(incl_gr[URIRef(holder_uri + '#frag') : : ])
+
+
     def test_srv_mgd_triples(self, cont_structure):
         '''
         verify the "server managed triples" prefer header.
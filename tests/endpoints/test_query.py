@@ -0,0 +1,168 @@
+import csv
+import json
+import pytest
+
+from io import StringIO
+from time import sleep
+
+from rdflib import Graph, Literal, URIRef
+from rdflib.compare import isomorphic
+from rdflib.namespace import XSD
+
+from lakesuperior.api import query as query_api
+from lakesuperior.env import env
+from lakesuperior.exceptions import QueryTimeoutError
+from lakesuperior.store.ldp_rs.lmdb_store import TxnManager
+
+
+s = URIRef('urn:qry:s')
+label = Literal('Say "hi"\nand\tleave\\', lang='en')
+trps = {
+    (s, URIRef('urn:qry:count'), Literal(5)),
+    (s, URIRef('urn:qry:label'), label),
+    (s, URIRef('urn:qry:link'), URIRef('urn:qry:o')),
+}
+select_qry = 'SELECT ?p ?o WHERE { <urn:qry:s> ?p ?o } ORDER BY ?p'
+
+
+@pytest.fixture(scope='module')
+def qry_data(db):
+    '''
+    Add triples with terms that need escaping in all formats.
+    '''
+    with TxnManager(db.store, True) as txn:
+        db.ds.addN(trp + (URIRef('urn:qry:g'),) for trp in trps)
+
+
+@pytest.mark.usefixtures('client_class')
+@pytest.mark.usefixtures('qry_data')
+class TestSparqlQuery:
+    '''
+    Test the SPARQL query endpoint.
+    '''
+    def _query(self, qry, accept):
+        return self.client.post(
+                '/query/sparql', data={'query': qry},
+                headers={'Accept': accept})
+
+
+    def test_csv(self):
+        '''
+        Get SELECT results as CSV.
+        '''
+        rsp = self._query(select_qry, 'text/csv')
+        assert rsp.status_code == 200
+        assert rsp.mimetype == 'text/csv'
+        assert rsp.data.decode('UTF-8') == (
+            'p,o\r\n'
+            'urn:qry:count,5\r\n'
+            'urn:qry:label,"Say ""hi""\nand\tleave\\"\r\n'
+            'urn:qry:link,urn:qry:o\r\n')
+        rows = list(csv.reader(StringIO(rsp.data.decode('UTF-8'))))
+        assert rows[2] == ['urn:qry:label', str(label)]
+
+
+    def test_tsv(self):
+        '''
+        Get SELECT results as TSV.
+        '''
+        rsp = self._query(select_qry, 'text/tab-separated-values')
+        assert rsp.status_code == 200
+        assert rsp.mimetype == 'text/tab-separated-values'
+        assert rsp.data.decode('UTF-8') == (
+            '?p\t?o\n'
+            '<urn:qry:count>\t"5"^^<{}>\n'
+            '<urn:qry:label>\t"Say \\"hi\\"\\nand\\tleave\\\\"@en\n'
+            '<urn:qry:link>\t<urn:qry:o>\n').format(XSD.integer)
+
+
+    def test_json(self):
+        '''
+        Get SELECT and ASK results as JSON.
+        '''
+        rsp = self._query(select_qry, 'application/sparql-results+json')
+        assert rsp.status_code == 200
+        assert rsp.mimetype == 'application/sparql-results+json'
+        res = json.loads(rsp.data.decode('UTF-8'))
+        assert res['head'] == {'vars': ['p', 'o']}
+        assert [row['o'] for row in res['results']['bindings']] == [
+            {'type': 'literal', 'value': '5', 'datatype': str(XSD.integer)},
+            {'type': 'literal', 'value': str(label), 'xml:lang': 'en'},
+            {'type': 'uri', 'value': 'urn:qry:o'},
+        ]
+
+        rsp = self._query(
+                'ASK { <urn:qry:s> ?p <urn:qry:o> }',
+                'application/sparql-results+json')
+        assert json.loads(rsp.data.decode('UTF-8')) == {
+                'head': {}, 'boolean': True}
+
+
+    def test_nt(self):
+        '''
+        Get CONSTRUCT results as N-Triples.
+        '''
+        rsp = self._query(
+                'CONSTRUCT WHERE { <urn:qry:s> ?p ?o }',
+                'application/n-triples')
+        assert rsp.status_code == 200
+        assert rsp.mimetype == 'application/n-triples'
+        out = rsp.data.decode('UTF-8')
+        assert (
+            '<urn:qry:s> <urn:qry:label> '
+            '"Say \\"hi\\"\\nand\\tleave\\\\"@en .\n') in out
+        assert len(out.splitlines()) == 3
+
+        gr = Graph()
+        gr.parse(data=out, format='nt')
+        expected = Graph()
+        for trp in trps:
+            expected.add(trp)
+        assert isomorphic(gr, expected)
+
+
+    def test_invalid_query(self):
+        '''
+        Send a query that cannot be parsed.
+        '''
+        for accept in ('text/csv', 'application/sparql-results+xml'):
+            rsp = self._query('SELEC ?s WHERE { ?s ?p ?o }', accept)
+            assert rsp.status_code == 400
+            # Undeclared prefix.
+            rsp = self._query('SELECT ?s WHERE { ?s foo:bar ?o }', accept)
+            assert rsp.status_code == 400
+            assert b'foo' in rsp.data
+
+
+    def test_unsupported_format(self):
+        '''
+        Request results in a format that does not apply to the query type.
+        '''
+        rsp = self._query('CONSTRUCT WHERE { <urn:qry:s> ?p ?o }', 'text/csv')
+        assert rsp.status_code == 406
+        rsp = self._query(select_qry, 'application/n-triples')
+        assert rsp.status_code == 406
+
+
+@pytest.mark.usefixtures('qry_data')
+class TestSparqlQueryStream:
+    '''
+    Test the streaming of query results.
+    '''
+    def test_stream_timeout(self):
+        '''
+        Test that the time spent sending the results counts towards the
+        stream time limit.
+        '''
+        config = env.app_globals.rdfly.config
+        orig = config.get('sparql_stream_timeout')
+        config['sparql_stream_timeout'] = 0.05
+        try:
+            out = query_api.sparql_query_stream(
+                    'SELECT ?o WHERE { <urn:qry:s> ?p ?o }', 'csv')
+            assert next(out).startswith(b'o\r\n')
+            sleep(0.1)
+            with pytest.raises(QueryTimeoutError):
+                next(out)
+        finally:
+            config['sparql_stream_timeout'] = orig
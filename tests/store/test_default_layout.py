@@ -0,0 +1,72 @@
+import errno
+import os
+import pytest
+
+from io import BytesIO
+from shutil import rmtree
+
+from lakesuperior.store.ldp_nr.default_layout import DefaultLayout
+
+
+@pytest.fixture
+def layout():
+    '''
+    Binary store with two files.
+    '''
+    layout = DefaultLayout({
+        'path': '/tmp/test_ldpnr_layout',
+        'pairtree_branch_length': 2,
+        'pairtree_branches': 4,
+    })
+    layout.bootstrap()
+    yield layout
+    rmtree(layout.root)
+
+
+class TestBackup:
+    '''
+    Tests for the backup of the binary store.
+    '''
+    dest = '/tmp/test_ldpnr_layout_bak'
+
+    def setup_method(self):
+        rmtree(self.dest, ignore_errors=True)
+
+
+    def teardown_method(self):
+        rmtree(self.dest, ignore_errors=True)
+
+
+    def test_backup(self, layout):
+        '''
+        Test that all files are linked, also into a previous backup.
+        '''
+        uuid1, size1 = layout.persist(BytesIO(b'file one'))
+        uuid2, size2 = layout.persist(BytesIO(b'second file'))
+        assert layout.backup(self.dest) == size1 + size2
+        assert layout.backup(self.dest) == size1 + size2
+        dest_path = layout.local_path(uuid1).replace(layout.root, self.dest)
+        with open(dest_path, 'rb') as f:
+            assert f.read() == b'file one'
+
+
+    @pytest.mark.parametrize('cross_device', (False, True))
+    def test_backup_deleted(self, layout, monkeypatch, cross_device):
+        '''
+        Test that a file deleted while the backup runs is skipped.
+        '''
+        uuid1, size1 = layout.persist(BytesIO(b'file one'))
+        uuid2, size2 = layout.persist(BytesIO(b'second file'))
+        deleted = layout.local_path(uuid1)
+        link = os.link
+
+        def link_racing_delete(src, dst):
+            if src == deleted:
+                layout.delete(uuid1)
+            if cross_device:
+                raise OSError(errno.EXDEV, 'Cross-device link')
+            link(src, dst)
+
+        monkeypatch.setattr(os, 'link', link_racing_delete)
+        assert layout.backup(self.dest) == size2
+        assert not os.path.exists(deleted.replace(layout.root, self.dest))
@@ -1,12 +1,22 @@
+import subprocess
+import sys
+
+import lmdb
 import pytest
 
+from collections import Counter
 from shutil import rmtree
+from textwrap import dedent
+from threading import Event, Thread
+from time import sleep
 
-from rdflib import Namespace, URIRef
+from rdflib import Literal, Namespace, URIRef, Variable
 from rdflib.graph import DATASET_DEFAULT_GRAPH_ID as RDFLIB_DEFAULT_GRAPH_URI
-from rdflib.namespace import RDF, RDFS
+from rdflib.namespace import RDF, RDFS, XSD
 
-from lakesuperior.store.ldp_rs.lmdb_store import LmdbStore, TxnManager
+from lakesuperior.exceptions import QueryRowLimitError, QueryTimeoutError
+from lakesuperior.store.ldp_rs.lmdb_store import (
+        LexicalSequence, LmdbStore, LruCache, QueryBudget, TxnManager)
 
 
 @pytest.fixture(scope='class')
@@ -138,6 +148,67 @@ class TestBasicOps:
             assert _clean(res3) == _clean(res2)
 
 
+    def test_2bound_index_choice(self):
+        '''
+        Test that two-bound lookups iterate over the smaller index entry.
+        '''
+        s = URIRef('urn:skew:s')
+        p = URIRef('urn:skew:p')
+        o = URIRef('urn:skew:o')
+        path = '/tmp/test_lmdbstore_skew'
+
+        iterated = []
+        class CursorSpy:
+            '''
+            Cursor recording the single-term indices iterated over.
+            '''
+            def __init__(self, cur, index):
+                self.cur = cur
+                self.index = index
+            def __enter__(self):
+                return self
+            def __exit__(self, *exc):
+                self.cur.close()
+            def __getattr__(self, name):
+                return getattr(self.cur, name)
+            def iternext_dup(self, *args, **kwargs):
+                if self.index in ('s:po', 'p:so', 'o:sp'):
+                    iterated.append(self.index)
+                return self.cur.iternext_dup(*args, **kwargs)
+
+        store = LmdbStore(path)
+        cur_fn = store.cur
+        store.cur = lambda index: CursorSpy(cur_fn(index), index)
+        try:
+            with TxnManager(store, True) as txn:
+                # `s` and `p` have many triples, `o` only a few.
+                for i in range(50):
+                    store.add((s, p, Literal(i)))
+                    store.add((URIRef('urn:skew:s{}'.format(i)), p, Literal(i)))
+                store.add((s, p, o))
+                store.add((URIRef('urn:skew:s0'), RDF.value, o))
+
+            with TxnManager(store) as txn:
+                assert not store.composite_idx
+                del iterated[:]
+                assert _clean(store.triples((s, None, o))) == {(s, p, o)}
+                assert iterated == ['o:sp']
+                del iterated[:]
+                assert _clean(store.triples((None, p, o))) == {(s, p, o)}
+                assert iterated == ['o:sp']
+                del iterated[:]
+                assert len(set(store.triples((s, p, None)))) == 51
+                assert iterated == ['s:po']
+                del iterated[:]
+                assert _clean(store.triples(
+                    (URIRef('urn:skew:s0'), p, None))) == {
+                        (URIRef('urn:skew:s0'), p, Literal(0))}
+                assert iterated == ['s:po']
+        finally:
+            store.close()
+            rmtree(path)
+
+
     def test_triple_no_match(self, store):
         '''
         Test various mismatches.
@@ -162,6 +233,37 @@ class TestBasicOps:
             assert len(res1) == len(res2) == len(res3) == 0
 
 
+    def test_add_n(self, store):
+        '''
+        Test adding a batch of quads.
+        '''
+        gr_uri = URIRef('urn:bogus:graph#addn')
+        gr2_uri = URIRef('urn:bogus:graph#addn2')
+        s = URIRef('urn:addn:s')
+        p = URIRef('urn:addn:p')
+        quads = (
+            (s, p, URIRef('urn:addn:o1'), gr_uri),
+            (s, p, URIRef('urn:addn:o1'), gr_uri),
+            (s, p, URIRef('urn:addn:o1'), gr2_uri),
+            (s, p, Literal('addn', lang='en'), gr_uri),
+            (s, p, Literal('addn', lang='EN'), gr_uri),
+        )
+        with TxnManager(store, True) as txn:
+            store.addN(quads)
+
+            # RDFLib considers the two literals equal, so no sets here.
+            assert len(list(store.triples((s, None, None)))) == 3
+            assert len(list(store.triples((None, None, None), gr_uri))) == 3
+            assert len(set(store.triples((None, p, None), gr2_uri))) == 1
+            for trp, ctx in store.triples((s, p, URIRef('urn:addn:o1'))):
+                assert {gr.identifier for gr in ctx} == {gr_uri, gr2_uri}
+            assert gr2_uri in {
+                ctx.identifier for ctx in store.contexts()}
+
+            store.remove((s, None, None))
+            assert len(set(store.triples((s, None, None)))) == 0
+
+
     def test_remove(self, store):
         '''
         Test removing one or more triples.
@@ -178,6 +280,63 @@ class TestBasicOps:
             assert len(res2) == 0
 
 
+@pytest.mark.usefixtures('store')
+class TestTermKeys:
+    '''
+    Tests for term key generation.
+    '''
+    def test_sequence(self):
+        '''
+        Test that integer positions map to the lexical sequence.
+        '''
+        seq = LexicalSequence(2, 5)
+        keys = [seq.next(None)]
+        for i in range(600):
+            keys.append(seq.next(keys[-1]))
+        assert seq.range(1, 601) == keys
+        assert [seq.to_int(k) for k in keys] == list(range(1, 602))
+        assert seq.from_int(seq.to_int(b'\x02\x03\xff\x02\x09')) == \
+                b'\x02\x03\xff\x02\x09'
+        with pytest.raises(RuntimeError):
+            seq.from_int(254 ** 5)
+
+
+    def test_key_allocation(self, store):
+        '''
+        Test that new term keys follow the last stored one across
+        transactions and after a rollback.
+        '''
+        def last_key():
+            with store.cur('t:st') as cur:
+                return bytes(cur.key()) if cur.last() else None
+
+        with TxnManager(store, True) as txn:
+            store.add((
+                URIRef('urn:tk:s1'), URIRef('urn:tk:p'), Literal('tk1')))
+            store.add((
+                URIRef('urn:tk:s1'), URIRef('urn:tk:p'), Literal('tk2')))
+            lk = last_key()
+
+        try:
+            with TxnManager(store, True) as txn:
+                store.add((
+                    URIRef('urn:tk:s2'), URIRef('urn:tk:p'), Literal('tk3')))
+                raise RuntimeError
+        except RuntimeError:
+            pass
+
+        with TxnManager(store, True) as txn:
+            store.add((
+                URIRef('urn:tk:s2'), URIRef('urn:tk:p'), Literal('tk4')))
+            # The rolled back terms are added again.
+            assert {
+                store._to_key(URIRef('urn:tk:s2')),
+                store._to_key(Literal('tk4'))} == set(
+                    store._key_seq.range(store._key_seq.to_int(lk) + 1, 2))
+            assert store.data_txn.stat(store.dbs['t:st'])['entries'] == \
+                    store._key_seq.to_int(last_key())
+
+
 @pytest.mark.usefixtures('store')
 class TestBindings:
     '''
@@ -291,6 +450,115 @@ class TestContext:
                     RDFLIB_DEFAULT_GRAPH_URI))
 
 
+    def test_idx_queue(self, store):
+        '''
+        Test lookup index updates deferred within a transaction.
+        '''
+        gr_uri = URIRef('urn:bogus:graph#c')
+        gr2_uri = URIRef('urn:bogus:graph#d')
+        trp1 = (URIRef('urn:s:4'), URIRef('urn:p:4'), URIRef('urn:o:4'))
+        trp2 = (URIRef('urn:s:5'), URIRef('urn:p:5'), URIRef('urn:o:5'))
+
+        with TxnManager(store, True) as txn:
+            store.add(trp1, gr_uri)
+            store.add(trp1, gr2_uri)
+            # Added and removed before the queue is applied.
+            store.add(trp2, gr_uri)
+            store.remove(trp2, gr_uri)
+
+        with TxnManager(store, True) as txn:
+            # Still in the other context.
+            store.remove(trp1, gr_uri)
+            assert trp1 in _clean(store.triples((URIRef('urn:s:4'), None, None)))
+            assert trp2 not in _clean(store.triples(
+                    (URIRef('urn:s:5'), None, None)))
+
+        with TxnManager(store) as txn:
+            assert trp1 in _clean(store.triples((None, URIRef('urn:p:4'), None)))
+            assert trp1 not in _clean(store.triples(
+                    (None, URIRef('urn:p:4'), None), gr_uri))
+            assert trp1 in _clean(store.triples(
+                    (None, None, URIRef('urn:o:4')), gr2_uri))
+            assert store.idx_txn.get(
+                    store._to_key(URIRef('urn:s:5')),
+                    db=store.dbs['s:po']) is None
+
+
+    def test_count(self, store):
+        '''
+        Test counting triples by context and pattern.
+        '''
+        gr_uri = URIRef('urn:bogus:graph#e')
+        gr2_uri = URIRef('urn:bogus:graph#f')
+        s = URIRef('urn:s:6')
+        trps = [
+            (s, URIRef('urn:p:6'), URIRef('urn:o:6')),
+            (s, URIRef('urn:p:6'), URIRef('urn:o:7')),
+            (s, URIRef('urn:p:7'), URIRef('urn:o:6')),
+        ]
+
+        with TxnManager(store, True) as txn:
+            num_trp = len(store)
+            for trp in trps:
+                store.add(trp, gr_uri)
+            store.add(trps[0], gr2_uri)
+
+            assert len(store) == num_trp + 3
+            assert store.__len__(gr_uri) == 3
+            assert store.__len__(gr2_uri) == 1
+            assert store.__len__(URIRef('urn:bogus:graph#nonexisting')) == 0
+            assert store.count((s, None, None)) == 3
+            assert store.count((None, URIRef('urn:p:6'), None)) == 2
+            assert store.count((None, None, URIRef('urn:o:6'))) == 2
+            assert store.count((s, URIRef('urn:p:6'), None)) == 2
+            assert store.count((s, None, None), gr2_uri) == 1
+            assert store.count(trps[2]) == 1
+            assert store.count(trps[2], gr2_uri) == 0
+            assert store.count((URIRef('urn:s:nonexisting'), None, None)) == 0
+            assert store.count(context=gr_uri) == 3
+
+
+    def test_context_triples(self, store):
+        '''
+        Test reading all the triples of several contexts at once.
+        '''
+        gr_uri = URIRef('urn:bogus:graph#e') # From previous test
+        gr2_uri = URIRef('urn:bogus:graph#f') # From previous test
+
+        with TxnManager(store) as txn:
+            trps = list(store.context_triples((
+                    gr_uri, URIRef('urn:bogus:graph#nonexisting'), gr2_uri)))
+            assert len(trps) == 4
+            assert set(trps) == _clean(store.triples(
+                    (None, None, None), gr_uri))
+            assert trps[-1] == (
+                    URIRef('urn:s:6'), URIRef('urn:p:6'), URIRef('urn:o:6'))
+            assert list(store.context_triples(())) == []
+
+
+    def test_quads(self, store):
+        '''
+        Test getting triples with their contexts, filtered by context.
+        '''
+        gr_uri = URIRef('urn:bogus:graph#e') # From previous test
+        gr2_uri = URIRef('urn:bogus:graph#f') # From previous test
+        s = URIRef('urn:s:6')
+        o = URIRef('urn:o:6')
+
+        with TxnManager(store) as txn:
+            assert set(store.quads((None, None, o))) == {
+                (s, URIRef('urn:p:6'), o, gr_uri),
+                (s, URIRef('urn:p:6'), o, gr2_uri),
+                (s, URIRef('urn:p:7'), o, gr_uri),
+            }
+            assert set(store.quads(
+                    (None, None, o), lambda ctx: ctx == gr2_uri)) == {
+                (s, URIRef('urn:p:6'), o, gr2_uri)}
+            assert list(store.quads((None, None, o), lambda ctx: False)) == []
+            assert list(store.quads(
+                    (None, None, URIRef('urn:o:nonexisting')))) == []
+
+
     #def test_delete_from_ctx(self, store):
     #    '''
     #    Delete triples from a named graph and from the default graph.
@@ -310,13 +578,1155 @@ class TestContext:
     #        assert len(store) == 0
 
 
+@pytest.mark.usefixtures('store')
+class TestCache:
+    '''
+    Tests for the term caches.
+    '''
+    def test_lru_eviction(self):
+        '''
+        Test that the least recently used entry is evicted first.
+        '''
+        cache = LruCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        assert cache.get('a') == 1
+        cache.put('c', 3)
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+        assert len(cache) == 2
+        assert cache.stats()['hits'] == 3
+        assert cache.stats()['misses'] == 1
+
+
+    def test_term_key_cache(self, store):
+        '''
+        Test that term keys are cached and served from the cache.
+        '''
+        trp = (
+            URIRef('urn:cache:s'), URIRef('urn:cache:p'),
+            URIRef('urn:cache:o'))
+        with TxnManager(store, True) as txn:
+            store.add(trp)
+
+        with TxnManager(store) as txn:
+            hits = store._term_key_cache.hits
+            assert store._to_key(trp[1]) is not None
+            assert store._term_key_cache.hits == hits + 1
+            assert _clean(store.triples((None, trp[1], None))) == {trp}
+
+
+    def test_key_term_cache(self, store):
+        '''
+        Test that decoded terms are cached and shared across results.
+        '''
+        p = URIRef('urn:cache:p')
+        with TxnManager(store, True) as txn:
+            for i in range(3):
+                store.add((URIRef('urn:cache:s'), p, URIRef(
+                    'urn:cache:o{}'.format(i))))
+
+        store._key_term_cache.clear()
+        with TxnManager(store) as txn:
+            preds = [trp[1] for trp, ctx in store.triples((None, p, None))]
+        assert len(preds) == 4
+        assert all(pred is preds[0] for pred in preds)
+        assert store._key_term_cache.hits >= 3
+
+
+    def test_cache_rollback(self, store):
+        '''
+        Test that the term key cache is invalidated on rollback.
+        '''
+        trp = (
+            URIRef('urn:cache:s'), URIRef('urn:cache:p'),
+            URIRef('urn:cache:rolledback'))
+        try:
+            with TxnManager(store, True) as txn:
+                store.add(trp)
+                assert len(store._term_key_cache)
+                raise RuntimeError
+        except RuntimeError:
+            pass
+
+        assert len(store._term_key_cache) == 0
+        assert len(store._key_term_cache) == 0
+        with TxnManager(store) as txn:
+            assert store._to_key(trp[2]) is None
+
+
+class TestTermFormat:
+    '''
+    Tests for the term serialization format and its migration.
+    '''
+    def test_legacy_migration(self):
+        '''
+        Test converting a store with pickled terms to the binary format.
+        '''
+        path = '/tmp/test_lmdbstore_legacy'
+        gr_uri = URIRef('urn:bogus:graph#legacy')
+        trp = (
+            URIRef('urn:legacy:s'), URIRef('urn:legacy:p'),
+            Literal('legacy', lang='en'))
+
+        # Simulate a store written with an earlier version.
+        store = LmdbStore(path)
+        store._pickle = store.node_pickler.dumps
+        store._unpickle = store.node_pickler.loads
+        with TxnManager(store, True) as txn:
+            store.add(trp, gr_uri)
+        store.close()
+
+        store = LmdbStore(path)
+        try:
+            assert store.term_format == 'pickle'
+            with TxnManager(store) as txn:
+                assert _clean(store.triples((None, None, None))) == {trp}
+
+            assert store.migrate_term_format() == 4
+            assert store.term_format == 'binary'
+            with TxnManager(store) as txn:
+                assert _clean(store.triples(
+                    (None, URIRef('urn:legacy:p'), None), gr_uri)) == {trp}
+            store.close()
+
+            store = LmdbStore(path)
+            assert store.term_format == 'binary'
+            with TxnManager(store, True) as txn:
+                # Existing terms must be found, not duplicated.
+                store.add(trp, gr_uri)
+                assert len(store) == 1
+                assert store.data_txn.stat(
+                        store.dbs['t:st'])['entries'] == 4
+        finally:
+            store.close()
+            rmtree(path)
+
+
+class TestKeyFormat:
+    '''
+    Tests for the compound key formats and their migration.
+    '''
+    path = '/tmp/test_lmdbstore_keyfmt'
+    gr_uri = URIRef('urn:bogus:graph#keyfmt')
+    trps = [
+        (URIRef('urn:kf:s1'), RDF.type, URIRef('urn:kf:C')),
+        (URIRef('urn:kf:s2'), RDF.type, URIRef('urn:kf:C')),
+        (URIRef('urn:kf:s1'), RDFS.label, Literal('s1')),
+    ]
+    ptns = [
+        (URIRef('urn:kf:s1'), None, None),
+        (None, RDF.type, None),
+        (None, None, URIRef('urn:kf:C')),
+        (URIRef('urn:kf:s1'), RDF.type, None),
+        (None, RDF.type, URIRef('urn:kf:C')),
+        (URIRef('urn:kf:s2'), None, URIRef('urn:kf:C')),
+        (URIRef('urn:kf:s1'), RDFS.label, Literal('s1')),
+        (None, None, None),
+    ]
+
+    def _matches(self, store):
+        with TxnManager(store) as txn:
+            return [
+                _clean(store.triples(ptn, self.gr_uri)) for ptn in self.ptns
+            ] + [_clean(store.triples(ptn)) for ptn in self.ptns]
+
+
+    @pytest.mark.parametrize('composite_idx', (False, True))
+    def test_migrate_keys(self, composite_idx):
+        '''
+        Test that both formats give the same results, and converting a store
+        with separator-joined keys to fixed-width keys.
+        '''
+        config = {'composite_indices': composite_idx}
+        store = LmdbStore(self.path, config={
+            'key_format': 'separator', **config})
+        try:
+            assert store.key_format == 'separator'
+            with TxnManager(store, True) as txn:
+                store.addN((*trp, self.gr_uri) for trp in self.trps)
+                spok = bytes(next(store._triple_keys((None, None, None))))
+                assert len(spok) == store.KEY_LENGTH * 3 + 2
+            expected = self._matches(store)
+            assert expected[-1] == set(self.trps)
+            store.close()
+
+            store = LmdbStore(self.path, config=config)
+            assert store.key_format == 'separator'
+            assert store.migrate_key_format('fixed') == 3
+            assert store.migrate_key_format('fixed') == 0
+            assert self._matches(store) == expected
+            store.close()
+
+            store = LmdbStore(self.path, config=config)
+            assert store.key_format == 'fixed'
+            assert self._matches(store) == expected
+            with TxnManager(store, True) as txn:
+                assert len(store) == 3
+                assert store.__len__(self.gr_uri) == 3
+                store.remove(self.trps[0], self.gr_uri)
+                assert store.count((None, RDF.type, None)) == 1
+        finally:
+            store.close()
+            rmtree(self.path)
+
+
+class TestCompositeIndices:
+    '''
+    Tests for the optional two-term lookup indices.
+    '''
+    path = '/tmp/test_lmdbstore_composite'
+    trps = [
+        (URIRef('urn:ci:s1'), RDF.type, URIRef('urn:ci:C')),
+        (URIRef('urn:ci:s2'), RDF.type, URIRef('urn:ci:C')),
+        (URIRef('urn:ci:s1'), RDF.type, URIRef('urn:ci:D')),
+        (URIRef('urn:ci:s1'), RDFS.label, Literal('s1')),
+    ]
+
+    def _matches(self, store):
+        with TxnManager(store) as txn:
+            return [
+                _clean(store.triples(ptn)) for ptn in (
+                    (URIRef('urn:ci:s1'), RDF.type, None),
+                    (None, RDF.type, URIRef('urn:ci:C')),
+                    (URIRef('urn:ci:s1'), None, URIRef('urn:ci:D')),
+                    (URIRef('urn:ci:s3'), RDF.type, None),
+                )]
+
+
+    def test_lookup(self):
+        '''
+        Test that two-term lookups give the same results with and without
+        the composite indices, which are built and dropped on open.
+        '''
+        store = LmdbStore(self.path)
+        try:
+            with TxnManager(store, True) as txn:
+                store.addN((*trp, URIRef('urn:ci:g')) for trp in self.trps)
+            expected = self._matches(store)
+            assert expected == [
+                set(self.trps[0::2]), set(self.trps[:2]), {self.trps[2]},
+                set()]
+            store.close()
+
+            store = LmdbStore(self.path, config={'composite_indices': True})
+            with TxnManager(store) as txn:
+                assert store.idx_txn.stat(
+                        store.dbs['sp:o'])['entries'] == len(self.trps)
+                assert store.count(
+                        (URIRef('urn:ci:s1'), RDF.type, None)) == 2
+            assert self._matches(store) == expected
+
+            with TxnManager(store, True) as txn:
+                store.remove(self.trps[1])
+                store.add((URIRef('urn:ci:s3'), RDF.type, URIRef('urn:ci:C')))
+                assert _clean(store.triples(
+                        (None, RDF.type, URIRef('urn:ci:C')))) == {
+                            self.trps[0],
+                            (URIRef('urn:ci:s3'), RDF.type, URIRef('urn:ci:C'))}
+            store.close()
+
+            store = LmdbStore(self.path)
+            with TxnManager(store) as txn:
+                assert store.idx_txn.stat(store.dbs['sp:o'])['entries'] == 0
+        finally:
+            store.close()
+            rmtree(self.path)
+
+
+class TestTextIndex:
+    '''
+    Tests for the literal text index and search.
+    '''
+    path = '/tmp/test_lmdbstore_text'
+    s = URIRef('urn:txt:s')
+    trps = [
+        (s, RDFS.label, Literal('Pomegranate Seeds')),
+        (s, RDFS.comment, Literal('A seedless fruit', lang='en')),
+        (s, RDFS.comment, Literal('Granada, España')),
+        (s, RDF.value, Literal(42)),
+    ]
+
+    def _search(self, store, text, prefix=False):
+        with TxnManager(store) as txn:
+            return set(store.search_terms(text, prefix))
+
+
+    @pytest.mark.parametrize('text_idx', (True, False))
+    def test_search(self, text_idx):
+        '''
+        Test searching with and without the index.
+        '''
+        store = LmdbStore(self.path, config={'text_index': text_idx})
+        try:
+            with TxnManager(store, True) as txn:
+                store.addN((*trp, URIRef('urn:txt:g')) for trp in self.trps)
+                store.add((self.s, RDFS.seeAlso, URIRef('urn:txt:seeds')))
+
+            assert self._search(store, 'seeds') == {self.trps[0][2]}
+            assert self._search(store, 'SEEDS pomegranate') == {
+                    self.trps[0][2]}
+            assert self._search(store, 'seed') == set()
+            assert self._search(store, 'seed', True) == {
+                    self.trps[0][2], self.trps[1][2]}
+            assert self._search(store, 'españa') == {self.trps[2][2]}
+            assert self._search(store, '42') == {self.trps[3][2]}
+            assert self._search(store, 'seeds fruit') == set()
+            assert self._search(store, '...') == set()
+
+            with TxnManager(store, True) as txn:
+                store.remove(self.trps[0])
+            assert self._search(store, 'pomegranate') == set()
+        finally:
+            store.close()
+            rmtree(self.path)
+
+
+    def test_maintenance(self):
+        '''
+        Test building, clearing and cleaning up the index.
+        '''
+        store = LmdbStore(self.path)
+        try:
+            with TxnManager(store, True) as txn:
+                store.addN((*trp, URIRef('urn:txt:g')) for trp in self.trps)
+            store.close()
+
+            store = LmdbStore(self.path, config={'text_index': True})
+            with TxnManager(store) as txn:
+                # 8 words in 4 literals.
+                assert store.idx_txn.stat(
+                        store.dbs['tok:t'])['entries'] == 8
+            with TxnManager(store, True) as txn:
+                store.remove(self.trps[0])
+            store.remove_orphan_terms()
+            with TxnManager(store) as txn:
+                assert store.idx_txn.stat(
+                        store.dbs['tok:t'])['entries'] == 6
+            store.close()
+
+            store = LmdbStore(self.path)
+            with TxnManager(store) as txn:
+                assert store.idx_txn.stat(
+                        store.dbs['tok:t'])['entries'] == 0
+        finally:
+            store.close()
+            rmtree(self.path)
+
+
+    def test_sparql(self):
+        '''
+        Test the text search predicates in SPARQL queries.
+        '''
+        from rdflib import Dataset
+        from rdflib.plugins.sparql import CUSTOM_EVALS
+        from lakesuperior.store.ldp_rs.sparql_evals import text_search_eval
+
+        CUSTOM_EVALS['lsup_text_search'] = text_search_eval
+        store = LmdbStore(self.path, config={'text_index': True})
+        try:
+            with TxnManager(store, True) as txn:
+                store.addN((*trp, URIRef('urn:txt:g')) for trp in self.trps)
+                store.add(
+                    (URIRef('urn:txt:s2'), RDFS.label, Literal('Seedy place')),
+                    URIRef('urn:txt:g'))
+            ds = Dataset(store, default_union=True)
+            qry = '''
+            PREFIX fcsystem: <info:fcsystem/>
+            PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+            SELECT ?s ?lit WHERE {{
+                ?lit fcsystem:{} "{}" .
+                ?s rdfs:label ?lit .
+            }}'''
+            with TxnManager(store) as txn:
+                assert set(ds.query(qry.format('textSearch', 'seeds'))) == {
+                        (self.s, self.trps[0][2])}
+                assert {
+                    row[0] for row in ds.query(
+                        qry.format('textPrefixSearch', 'see'))} == {
+                    self.s, URIRef('urn:txt:s2')}
+                assert not list(ds.query(qry.format('textSearch', 'fruit')))
+                # Property path in the rest of the pattern.
+                assert set(ds.query(qry.format('textSearch', 'seeds').replace(
+                    'rdfs:label', 'rdfs:label|rdfs:comment'))) == {
+                        (self.s, self.trps[0][2])}
+        finally:
+            store.close()
+            rmtree(self.path)
+
+
+class TestSparqlJoin:
+    '''
+    Tests for the evaluation of basic graph patterns on term keys.
+    '''
+    path = '/tmp/test_lmdbstore_join'
+    ns = Namespace('urn:jn:')
+    queries = (
+        # Multi-pattern join with a variable not in the results.
+        '''SELECT ?s ?title WHERE {
+            ?s a jn:Book ; jn:author ?a ; jn:title ?title .
+            ?a jn:name "Author 3" .
+        }''',
+        '''SELECT * WHERE { ?s jn:author ?a . ?a jn:name ?n }''',
+        '''SELECT ?s WHERE { ?s jn:author ?a . ?a jn:name ?n }''',
+        '''SELECT DISTINCT ?a WHERE { ?s jn:author ?a ; jn:title ?t }''',
+        # Variable used in a filter and in an optional pattern.
+        '''SELECT ?s WHERE {
+            ?s jn:author ?a ; jn:pages ?p .
+            OPTIONAL { ?a jn:name ?n }
+            FILTER (?p > 150)
+        }''',
+        # Repeated variable in a pattern, blank node, cross product.
+        '''SELECT ?x WHERE { ?x jn:cites ?x }''',
+        '''SELECT ?t WHERE { _:b jn:author jn:a2 ; jn:title ?t }''',
+        '''SELECT ?a ?b WHERE {
+            ?a jn:name "Author 1" . ?b jn:name "Author 2" }''',
+        # Named graph, unknown term, counting.
+        '''SELECT ?s ?t WHERE {
+            GRAPH jn:g1 { ?s jn:title ?t ; jn:author jn:a1 } }''',
+        '''SELECT ?g ?s WHERE { GRAPH ?g { ?s jn:author jn:a2 } }''',
+        '''SELECT ?s WHERE { ?s jn:author jn:nobody ; jn:title ?t }''',
+        '''SELECT (COUNT(?s) AS ?c) WHERE { ?s a jn:Book ; jn:pages ?p }''',
+        '''ASK { ?s jn:cites ?o . ?o jn:cites ?s }''',
+        # Property paths, alone and joined with other patterns.
+        '''SELECT ?s ?n WHERE { ?s jn:author/jn:name ?n }''',
+        '''SELECT ?s ?o WHERE { ?s jn:cites+ ?o }''',
+        '''SELECT ?o WHERE { jn:b3 jn:cites* ?o }''',
+        '''SELECT ?s ?o WHERE { ?s jn:cites|jn:author ?o }''',
+        '''SELECT ?a ?s WHERE { ?a ^jn:author ?s }''',
+        '''SELECT ?t ?n WHERE {
+            ?s jn:title ?t ; jn:author/jn:name ?n ; jn:pages ?p }''',
+    )
+
+    def _results(self, ds, store, qry):
+        with TxnManager(store) as txn:
+            res = ds.query('PREFIX jn: <urn:jn:> ' + qry)
+            if res.type == 'ASK':
+                return res.askAnswer
+            return Counter(tuple(row) for row in res)
+
+
+    @pytest.mark.parametrize('composite_idx', (True, False))
+    def test_join(self, composite_idx):
+        '''
+        Test that queries return the same results as RDFLib's evaluation.
+        '''
+        from rdflib import Dataset
+        from rdflib.plugins.sparql import CUSTOM_EVALS
+        from lakesuperior.store.ldp_rs.sparql_evals import (
+                bgp_eval, query_eval)
+
+        ns = self.ns
+        store = LmdbStore(
+                self.path, config={'composite_indices': composite_idx})
+        try:
+            with TxnManager(store, True) as txn:
+                quads = []
+                for i in range(60):
+                    book = ns['b{}'.format(i)]
+                    g = ns['g{}'.format(i % 2)]
+                    quads += [
+                        (book, RDF.type, ns.Book, g),
+                        (book, ns.author, ns['a{}'.format(i % 7)], g),
+                        (book, ns.title, Literal('Title {}'.format(i)), g),
+                        (book, ns.pages, Literal(i * 5), g),
+                        (book, ns.cites, ns['b{}'.format(i % 5)], g),
+                    ]
+                for i in range(5):
+                    quads.append((
+                        ns['a{}'.format(i)], ns.name,
+                        Literal('Author {}'.format(i)), ns.g2))
+                store.addN(quads)
+            ds = Dataset(store, default_union=True)
+
+            saved_evals = dict(CUSTOM_EVALS)
+            CUSTOM_EVALS.clear()
+            try:
+                expected = [
+                        self._results(ds, store, qry) for qry in self.queries]
+                CUSTOM_EVALS['lsup_query'] = query_eval
+                CUSTOM_EVALS['lsup_bgp'] = bgp_eval
+                for qry, exp in zip(self.queries, expected):
+                    assert self._results(ds, store, qry) == exp, qry
+            finally:
+                CUSTOM_EVALS.clear()
+                CUSTOM_EVALS.update(saved_evals)
+            assert any(expected[:4])
+        finally:
+            store.close()
+            rmtree(self.path)
+
+
+class TestRangeIndex:
+    '''
+    Tests for the literal range index and search.
+    '''
+    path = '/tmp/test_lmdbstore_range'
+    s = URIRef('urn:rng:s')
+    trps = [
+        (s, RDF.value, Literal(-3)),
+        (s, RDF.value, Literal('0.5', datatype=XSD.decimal)),
+        (s, RDF.value, Literal(2)),
+        (s, RDF.value, Literal('2.0', datatype=XSD.decimal)),
+        (s, RDF.value, Literal(10)),
+        (s, RDFS.label, Literal('10')),
+        (s, URIRef('urn:rng:date'), Literal('2018-03-01', datatype=XSD.date)),
+        (s, URIRef('urn:rng:modified'), Literal(
+            '2018-03-01T10:00:00Z', datatype=XSD.dateTime)),
+        (s, URIRef('urn:rng:modified'), Literal(
+            '2018-03-01T12:00:00+01:00', datatype=XSD.dateTime)),
+    ]
+
+    def _search(self, store, *args, **kwargs):
+        with TxnManager(store) as txn:
+            return list(store.search_range(*args, **kwargs))
+
+
+    @pytest.mark.parametrize('range_idx', (True, False))
+    def test_search(self, range_idx):
+        '''
+        Test range searches with and without the index.
+        '''
+        store = LmdbStore(self.path, config={'range_index': range_idx})
+        o = [trp[2] for trp in self.trps]
+        try:
+            with TxnManager(store, True) as txn:
+                store.addN((*trp, URIRef('urn:rng:g')) for trp in self.trps)
+
+            # Results are in value order.
+            assert self._search(store, high=Literal(1)) == o[:2]
+            assert self._search(
+                    store, high=Literal(2), incl_high=False) == o[:2]
+            assert set(self._search(store, Literal(0))) == set(o[1:5])
+            assert set(self._search(store, high=Literal(2))) == set(o[:4])
+            assert self._search(
+                    store, Literal(2), incl_low=False) == [o[4]]
+            # Equal values of different datatypes.
+            assert set(self._search(store, Literal(2), Literal(2))) == set(
+                    o[2:4])
+            assert self._search(
+                    store, Literal(2), Literal(2), incl_low=False) == []
+            assert self._search(
+                    store, Literal('2018-03-01T10:30:00Z',
+                    datatype=XSD.dateTime)) == [o[8]]
+            assert self._search(
+                    store, Literal('2018-01-01', datatype=XSD.date)) == [o[6]]
+
+            with pytest.raises(ValueError):
+                self._search(store, Literal('10'))
+            with pytest.raises(ValueError):
+                self._search(store, Literal(1), Literal(
+                    '2018-01-01', datatype=XSD.date))
+
+            with TxnManager(store, True) as txn:
+                store.remove(self.trps[4])
+            assert self._search(store, Literal(2), incl_low=False) == []
+        finally:
+            store.close()
+            rmtree(self.path)
+
+
+    def test_maintenance(self):
+        '''
+        Test building, clearing and cleaning up the index.
+        '''
+        store = LmdbStore(self.path)
+        try:
+            with TxnManager(store, True) as txn:
+                store.addN((*trp, URIRef('urn:rng:g')) for trp in self.trps)
+            store.close()
+
+            store = LmdbStore(self.path, config={'range_index': True})
+            with TxnManager(store) as txn:
+                assert store.idx_txn.stat(
+                        store.dbs['val:t'])['entries'] == 8
+            with TxnManager(store, True) as txn:
+                store.remove(self.trps[0])
+            store.remove_orphan_terms()
+            with TxnManager(store) as txn:
+                assert store.idx_txn.stat(
+                        store.dbs['val:t'])['entries'] == 7
+            store.close()
+
+            store = LmdbStore(self.path)
+            with TxnManager(store) as txn:
+                assert store.idx_txn.stat(
+                        store.dbs['val:t'])['entries'] == 0
+        finally:
+            store.close()
+            rmtree(self.path)
+
+
+class TestReindex:
+    '''
+    Tests for rebuilding the indices.
+    '''
+    path = '/tmp/test_lmdbstore_reindex'
+
+    def _idx_contents(self, store):
+        with TxnManager(store) as txn:
+            return {
+                db_label: [
+                    (bytes(k), bytes(v))
+                    for k, v in store.idx_txn.cursor(store.dbs[db_label])]
+                for db_label in store.idx_keys}
+
+
+    @pytest.mark.parametrize('env_layout', LmdbStore.ENV_LAYOUTS)
+    @pytest.mark.parametrize('workers', (1, 3))
+    def test_reindex(self, env_layout, workers):
+        '''
+        Test that rebuilt indices are identical to the original ones.
+        '''
+        store = LmdbStore(self.path, config={
+            'env_layout': env_layout, 'composite_indices': True,
+            'range_index': True})
+        try:
+            with TxnManager(store, True) as txn:
+                store.bind('ns1', URIRef('urn:ns1#'))
+                store.addN(
+                        (URIRef('urn:ri:s{}'.format(i % 7)),
+                            URIRef('urn:ri:p{}'.format(i % 3)),
+                            Literal(i), URIRef('urn:ri:g{}'.format(i % 2)))
+                        for i in range(500))
+                store.add_graph(URIRef('urn:ri:empty'))
+            orig = self._idx_contents(store)
+
+            with TxnManager(store, True) as txn:
+                for db_label in ('th:t', 's:po', 'c:spo', 'ns:pfx'):
+                    store.idx_txn.drop(store.dbs[db_label], delete=False)
+
+            assert store.rebuild_indices(workers) == 500
+            assert self._idx_contents(store) == orig
+            with TxnManager(store) as txn:
+                assert len(set(store.triples(
+                        (URIRef('urn:ri:s1'), None, None)))) == 72
+                assert store.prefix(URIRef('urn:ns1#')) == 'ns1'
+        finally:
+            store.close()
+            rmtree(self.path)
+
+
+class TestCleanup:
+    '''
+    Tests for deleting orphan terms and compacting the store.
+    '''
+    path = '/tmp/test_lmdbstore_cleanup'
+
+    @pytest.mark.parametrize('env_layout', LmdbStore.ENV_LAYOUTS)
+    def test_cleanup(self, env_layout):
+        '''
+        Test that only unused terms are deleted and that compaction keeps
+        the data.
+        '''
+        gr = URIRef('urn:gc:g')
+        kept = (URIRef('urn:gc:s'), RDF.type, URIRef('urn:gc:C'))
+        store = LmdbStore(self.path, config={'env_layout': env_layout})
+        try:
+            with TxnManager(store, True) as txn:
+                store.add(kept, gr)
+                store.addN(
+                        (URIRef('urn:gc:s'), RDFS.label,
+                            Literal('label {}'.format(i)), gr)
+                        for i in range(1000))
+                store.add_graph(URIRef('urn:gc:empty'))
+            with TxnManager(store, True) as txn:
+                store.remove((None, RDFS.label, None), gr)
+
+            assert store.remove_orphan_terms() == 1001
+            assert store.remove_orphan_terms() == 0
+            size_before, size_after = store.compact()
+            assert size_after < size_before
+
+            with TxnManager(store) as txn:
+                assert _clean(store.triples((None, None, None))) == {kept}
+                assert store._to_key(RDFS.label) is None
+                assert store._to_key(Literal('label 1')) is None
+                assert store._to_key(URIRef('urn:gc:empty')) is not None
+                assert store.idx_txn.stat(store.dbs['th:t'])['entries'] \
+                        == store.data_txn.stat(store.dbs['t:st'])['entries'] \
+                        == 5
+            with TxnManager(store, True) as txn:
+                store.add((URIRef('urn:gc:s'), RDFS.label, Literal('new')))
+            with TxnManager(store) as txn:
+                assert len(set(store.triples((None, RDFS.label, None)))) == 1
+        finally:
+            store.close()
+            rmtree(self.path)
+
+
+class TestBackup:
+    '''
+    Tests for copying a store in use.
+    '''
+    path = '/tmp/test_lmdbstore_backup'
+    dest = '/tmp/test_lmdbstore_backup_copy'
+    trp = (URIRef('urn:bk:s'), RDF.type, URIRef('urn:bk:C'))
+
+    @pytest.mark.parametrize('env_layout', LmdbStore.ENV_LAYOUTS)
+    def test_backup(self, env_layout):
+        '''
+        Test that the copy has the committed data and is usable.
+        '''
+        store = LmdbStore(self.path, config={'env_layout': env_layout})
+        try:
+            with TxnManager(store, True) as txn:
+                store.add(self.trp, URIRef('urn:bk:g'))
+                store.bind('bk', URIRef('urn:bk:'))
+            assert store.backup(self.dest) > 0
+            with pytest.raises(FileExistsError):
+                store.backup(self.dest)
+
+            with TxnManager(store, True) as txn:
+                store.remove(self.trp)
+            copy = LmdbStore(self.dest)
+            try:
+                assert copy.env_layout == env_layout
+                with TxnManager(copy) as txn:
+                    assert _clean(copy.triples((None, None, None))) == {
+                            self.trp}
+                    assert copy.prefix(URIRef('urn:bk:')) == 'bk'
+            finally:
+                copy.close()
+        finally:
+            store.close()
+            rmtree(self.path)
+            rmtree(self.dest)
+
+
+    @pytest.mark.parametrize('env_layout', LmdbStore.ENV_LAYOUTS)
+    def test_copy_matches(self, env_layout):
+        '''
+        Test that every database of the copy has the same records as the
+        source, including index keys with more values than fit in a page.
+        '''
+        p = URIRef('urn:bk:p')
+        store = LmdbStore(self.path, config={'env_layout': env_layout})
+        try:
+            with TxnManager(store, True) as txn:
+                store.addN(
+                        (URIRef('urn:bk:s{}'.format(i)), p, Literal(i),
+                            URIRef('urn:bk:g'))
+                        for i in range(2000))
+            store.backup(self.dest)
+
+            copy = LmdbStore(self.dest)
+            try:
+                with TxnManager(store) as txn, TxnManager(copy) as copy_txn:
+                    assert store.count((None, p, None)) == 2000
+                    for db_label in store.data_keys + store.idx_keys:
+                        with store.cur(db_label) as cur, \
+                                copy.cur(db_label) as copy_cur:
+                            assert (
+                                    list(copy_cur.iternext())
+                                    == list(cur.iternext())), db_label
+            finally:
+                copy.close()
+        finally:
+            store.close()
+            rmtree(self.path)
+            rmtree(self.dest)
+
+
+class TestEnvLayout:
+    '''
+    Tests for the single-environment layout.
+    '''
+    path = '/tmp/test_lmdbstore_layout'
+    trp = (URIRef('urn:lay:s'), RDF.type, URIRef('urn:lay:C'))
+
+    def test_single(self):
+        '''
+        Test writing to a single environment and detecting it on reopening.
+        '''
+        store = LmdbStore(self.path, config={'env_layout': 'single'})
+        try:
+            assert store.data_env is store.idx_env
+            with TxnManager(store, True) as txn:
+                assert store.data_txn is store.idx_txn
+                store.add(self.trp)
+            store.begin(write=True)
+            store.remove(self.trp)
+            store.rollback()
+            store.close()
+
+            store = LmdbStore(self.path)
+            assert store.env_layout == 'single'
+            with TxnManager(store) as txn:
+                assert _clean(store.triples((None, None, None))) == {self.trp}
+                stats = store.stats()
+                assert stats['idx_db_size'] > 0
+                assert stats['data_db_size'] > 0
+        finally:
+            store.close()
+            rmtree(self.path)
+
+
+    def test_invalid(self):
+        '''
+        Test that an unknown layout is rejected.
+        '''
+        with pytest.raises(ValueError):
+            LmdbStore(self.path, config={'env_layout': 'sharded'})
+
+
+class TestEnvProfiles:
+    '''
+    Tests for the LMDB environment profiles.
+    '''
+    path = '/tmp/test_lmdbstore_profiles'
+    trp = (URIRef('urn:prof:s'), RDF.type, URIRef('urn:prof:C'))
+
+    def test_options(self):
+        '''
+        Test merging profile options and overrides.
+        '''
+        store = LmdbStore(self.path, config={
+            'lmdb_profile': 'fast-ingest', 'lmdb_options': {'map_async': True}})
+        try:
+            assert store.env_options['sync'] is False
+            assert store.env_options['map_async'] is True
+            assert store.env_options['map_size'] == LmdbStore.MAP_SIZE
+            assert store.data_env.flags()['sync'] is False
+        finally:
+            store.close()
+            rmtree(self.path)
+
+
+    def test_invalid(self):
+        '''
+        Test that unknown profiles and options are rejected.
+        '''
+        with pytest.raises(ValueError):
+            LmdbStore(self.path, config={'lmdb_profile': 'reckless'})
+        with pytest.raises(ValueError):
+            LmdbStore(self.path, config={'lmdb_options': {'nosync': True}})
+
+
+    def test_fast_ingest(self):
+        '''
+        Test that data written without sync are there after a checkpoint.
+        '''
+        store = LmdbStore(self.path, config={'lmdb_profile': 'fast-ingest'})
+        try:
+            with TxnManager(store, True) as txn:
+                store.add(self.trp)
+            store.checkpoint()
+            store.close()
+
+            store = LmdbStore(self.path)
+            with TxnManager(store) as txn:
+                assert _clean(store.triples((None, None, None))) == {self.trp}
+        finally:
+            store.close()
+            rmtree(self.path)
+
+
+    def test_read_replica(self):
+        '''
+        Test reading from a read-only store and refusing writes.
+        '''
+        store = LmdbStore(self.path)
+        with TxnManager(store, True) as txn:
+            store.add(self.trp)
+        store.close()
+
+        store = LmdbStore(self.path, config={'lmdb_profile': 'read-replica'})
+        try:
+            with TxnManager(store) as txn:
+                assert _clean(store.triples((None, None, None))) == {self.trp}
+            with pytest.raises(lmdb.Error):
+                store.begin(write=True)
+            assert not store.is_txn_open
+        finally:
+            store.close()
+            rmtree(self.path)
+
+
 @pytest.mark.usefixtures('store')
 class TestTransactions:
     '''
     Tests for transaction handling.
     '''
-    # @TODO Test concurrent reads and writes.
-    pass
+    def test_concurrent_txn(self, store):
+        '''
+        Test reading in several threads while another thread writes.
+        '''
+        trp = (
+            URIRef('urn:txn:s'), URIRef('urn:txn:p'), URIRef('urn:txn:o'))
+        written = Event()
+        done = Event()
+        results = {}
+
+        def write():
+            with TxnManager(store, True) as txn:
+                store.add(trp)
+                written.set()
+                done.wait(5)
+
+        def read(i):
+            written.wait(5)
+            with TxnManager(store) as txn:
+                results[i] = (len(set(store.triples(trp))), store.is_txn_rw)
+
+        writer = Thread(target=write)
+        writer.start()
+        readers = [Thread(target=read, args=(i,)) for i in range(4)]
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join(5)
+        # The main thread has no transaction open.
+        assert not store.is_txn_open
+        done.set()
+        writer.join(5)
+
+        # Readers do not see uncommitted data.
+        assert results == {i: (0, False) for i in range(4)}
+        with TxnManager(store) as txn:
+            assert len(set(store.triples(trp))) == 1
+
+
+    def test_nested_txn(self, store):
+        '''
+        Test reusing an open transaction in nested contexts.
+        '''
+        trp = (
+            URIRef('urn:txn:s'), URIRef('urn:txn:p'), URIRef('urn:txn:o3'))
+        with TxnManager(store, True) as txn:
+            store.add(trp)
+            txn_id = store.data_txn.id()
+            with TxnManager(store) as txn2:
+                assert store.is_txn_rw
+                assert len(set(store.triples(trp))) == 1
+            with TxnManager(store, True) as txn2:
+                assert store.data_txn.id() == txn_id
+            assert store.is_txn_open
+        assert not store.is_txn_open
+
+        with TxnManager(store) as txn:
+            with pytest.raises(RuntimeError):
+                with TxnManager(store, True) as txn2:
+                    pass
+            assert store.is_txn_open
+            assert len(set(store.triples(trp))) == 1
+        assert not store.is_txn_open
+
+        # Roll back from an inner context.
+        try:
+            with TxnManager(store, True) as txn:
+                store.remove(trp)
+                with TxnManager(store) as txn2:
+                    raise RuntimeError
+        except RuntimeError:
+            pass
+        assert not store.is_txn_open
+        with TxnManager(store) as txn:
+            assert len(set(store.triples(trp))) == 1
+
+
+    def test_write_lock(self, store):
+        '''
+        Test that write transactions are serialized.
+        '''
+        trp = (
+            URIRef('urn:txn:s'), URIRef('urn:txn:p'), URIRef('urn:txn:o2'))
+        order = []
+
+        def write():
+            with TxnManager(store, True) as txn:
+                # Written after the first transaction was committed.
+                order.append(('second', len(set(store.triples(trp)))))
+
+        with TxnManager(store, True) as txn:
+            store.add(trp)
+            writer = Thread(target=write)
+            writer.start()
+            writer.join(0.2)
+            assert writer.is_alive()
+            order.append('first')
+        writer.join(5)
+
+        assert order == ['first', ('second', 1)]
+
+
+    def test_greenlet_side_writes(self):
+        '''
+        Test graphs and namespaces added outside of a write transaction while
+        another greenlet holds one.
+        '''
+        pytest.importorskip('gevent')
+        path = '/tmp/test_lmdbstore_greenlets'
+        # gevent must patch the threading module before the store is loaded.
+        script = dedent('''
+            from gevent import monkey; monkey.patch_all()
+            import gevent
+            from rdflib import URIRef
+            from lakesuperior.store.ldp_rs.lmdb_store import (
+                    LmdbStore, TxnManager)
+
+            store = LmdbStore({!r})
+            gr_uri = URIRef('urn:greenlet:g')
+            trp = (URIRef('urn:greenlet:s'), URIRef('urn:greenlet:p'),
+                    URIRef('urn:greenlet:o'))
+
+            def write():
+                with TxnManager(store, True):
+                    store.add(trp)
+                    gevent.sleep(0.2)
+
+            def read():
+                with TxnManager(store):
+                    store.add_graph(gr_uri)
+                    store.bind('gl', URIRef('urn:greenlet:ns#'))
+
+            gevent.joinall(
+                    [gevent.spawn(write), gevent.spawn(read)],
+                    raise_error=True)
+            with TxnManager(store):
+                assert gr_uri in {{gr.identifier for gr in store.contexts()}}
+                assert store.namespace('gl') == URIRef('urn:greenlet:ns#')
+                assert len(store) == 1
+            store.close()
+        ''').format(path)
+        try:
+            proc = subprocess.run(
+                    [sys.executable, '-c', script], capture_output=True,
+                    text=True, timeout=60)
+            assert proc.returncode == 0, proc.stderr
+        finally:
+            rmtree(path, ignore_errors=True)
+
+
+    def test_generation(self, store):
+        '''
+        Test that the store generation only changes on write commits.
+        '''
+        trp = (
+            URIRef('urn:txn:s'), URIRef('urn:txn:p'), URIRef('urn:txn:o4'))
+        gen = store.generation
+        with TxnManager(store) as txn:
+            set(store.triples((None, None, None)))
+        with TxnManager(store, True) as txn:
+            pass
+        store.begin(write=True)
+        store.add(trp)
+        store.rollback()
+        assert store.generation == gen
+
+        with TxnManager(store, True) as txn:
+            store.add(trp)
+            assert store.generation == gen
+        assert store.generation > gen
+
+
+    def test_map_full(self):
+        '''
+        Test that a transaction filling the map is rolled back with an error.
+        '''
+        path = '/tmp/test_lmdbstore_map_full'
+        trp = (URIRef('urn:txn:s'), URIRef('urn:txn:p'), URIRef('urn:txn:o5'))
+        store = LmdbStore(path, config={'lmdb_options': {'map_size': 3 << 20}})
+        try:
+            with pytest.raises(lmdb.MapFullError):
+                with TxnManager(store, True) as txn:
+                    for i in range(15000):
+                        store.add((
+                            URIRef('urn:txn:s{}'.format(i)),
+                            URIRef('urn:txn:p'), Literal(i)))
+            assert not store.is_txn_open
+            assert store._term_key_cache.stats()['entries'] == 0
+
+            # The store is still usable, and has none of the triples.
+            with TxnManager(store, True) as txn:
+                store.add(trp)
+            with TxnManager(store) as txn:
+                assert _clean(store.triples((None, None, None))) == {trp}
+        finally:
+            store.close()
+            rmtree(path)
+
+
+
+class TestQueryBudget:
+    '''
+    Tests for the query time and row limits.
+    '''
+    ns = Namespace('urn:qb:')
+
+    def test_row_limit(self, store):
+        '''
+        Test aborting lookups and joins that read too many triples.
+        '''
+        ns = self.ns
+        with TxnManager(store, True) as txn:
+            for i in range(10):
+                store.add((ns['s{}'.format(i)], ns.p, Literal(i)))
+
+        with TxnManager(store) as txn:
+            with QueryBudget(store, max_rows=10) as budget:
+                assert len(set(store.triples((None, ns.p, None)))) == 10
+                assert budget.rows == 10
+                with pytest.raises(QueryRowLimitError):
+                    set(store.triples((None, ns.p, None)))
+            assert store._txn.budget is None
+
+            with QueryBudget(store, max_rows=15) as budget:
+                patterns = [(Variable('s'), ns.p, Variable('o'))] * 2
+                with pytest.raises(QueryRowLimitError):
+                    list(store.join_patterns(patterns))
+                # Nested budgets.
+                with QueryBudget(store) as inner:
+                    set(store.triples((None, ns.p, None)))
+                assert inner.rows == 10
+                assert store._txn.budget is budget
+
+
+    def test_timeout(self, store):
+        '''
+        Test aborting a query running longer than allowed.
+        '''
+        with TxnManager(store) as txn:
+            with QueryBudget(store, timeout=0.01) as budget:
+                trps = store.triples((None, self.ns.p, None))
+                next(trps)
+                sleep(0.02)
+                with pytest.raises(QueryTimeoutError) as exc_info:
+                    next(trps)
+            assert exc_info.value.elapsed >= 0.01
+            assert exc_info.value.rows == 2
+
+
+    def test_paused(self, store):
+        '''
+        Test that the time spent with the budget paused is not counted.
+        '''
+        with TxnManager(store) as txn:
+            with QueryBudget(store, timeout=0.05) as budget:
+                trps = store.triples((None, self.ns.p, None))
+                next(trps)
+                with budget.paused():
+                    sleep(0.1)
+                next(trps)
+                assert budget.elapsed < 0.05
+
+
+    def test_max_duration(self, store):
+        '''
+        Test that the time spent with the budget paused counts towards the
+        maximum duration.
+        '''
+        with TxnManager(store) as txn:
+            with QueryBudget(store, timeout=1, max_duration=0.05) as budget:
+                trps = store.triples((None, self.ns.p, None))
+                next(trps)
+                with budget.paused():
+                    sleep(0.1)
+                assert budget.elapsed < 0.05
+                with pytest.raises(QueryTimeoutError) as exc_info:
+                    next(trps)
+                assert exc_info.value.limit == 0.05
 
 
 #@pytest.mark.usefixtures('store')
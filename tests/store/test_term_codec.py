@@ -0,0 +1,121 @@
+import pytest
+
+from datetime import date, datetime
+from decimal import Decimal
+
+from rdflib import BNode, Literal, URIRef
+from rdflib.namespace import XSD
+from rdflib.store import NodePickler
+
+from lakesuperior.store.ldp_rs import term_codec
+
+
+@pytest.fixture
+def terms():
+    return (
+        URIRef('info:fcres/a/b'),
+        URIRef('http://example.org/ñ#frag'),
+        BNode('b0'),
+        Literal(''),
+        Literal('Plain literal'),
+        Literal('Ŝtring with lang', lang='eo'),
+        Literal('Mixed-case tag', lang='en-US'),
+        Literal(12345),
+        Literal('2018-03-01T12:00:00Z', datatype=XSD.dateTime),
+        Literal('x', datatype=URIRef('urn:custom:datatype')),
+    )
+
+
+class TestTermCodec:
+    '''
+    Tests for the binary term serialization.
+    '''
+    def test_roundtrip(self, terms):
+        '''
+        Test that terms are deserialized into identical terms.
+        '''
+        for term in terms:
+            out = term_codec.loads(term_codec.dumps(term))
+            assert type(out) == type(term)
+            assert out == term
+            if isinstance(term, Literal):
+                assert out.language == term.language
+                assert out.datatype == term.datatype
+
+
+    def test_memoryview(self, terms):
+        '''
+        Test deserializing from a buffer.
+        '''
+        for term in terms:
+            assert term_codec.loads(memoryview(term_codec.dumps(term))) == term
+
+
+    def test_distinct(self, terms):
+        '''
+        Test that different terms are never serialized the same way.
+        '''
+        more_terms = terms + (
+            Literal('info:fcres/a/b'),
+            Literal('Mixed-case tag', lang='EN-us'),
+            Literal('12345'),
+        )
+        assert len({term_codec.dumps(t) for t in more_terms}) \
+                == len(more_terms)
+
+
+    def test_pickle_detection(self, terms):
+        '''
+        Test telling legacy pickles apart from binary terms.
+        '''
+        pickler = NodePickler()
+        for term in terms:
+            assert term_codec.is_pickle(pickler.dumps(term))
+            assert not term_codec.is_pickle(term_codec.dumps(term))
+
+
+    def test_unsupported(self):
+        '''
+        Test serializing a non-term and deserializing an unknown version.
+        '''
+        with pytest.raises(ValueError):
+            term_codec.dumps(('not', 'a', 'term'))
+        with pytest.raises(ValueError):
+            term_codec.loads(b'\x71urn:a')
+
+
+    def test_value_key_order(self):
+        '''
+        Test that value keys sort numbers, dates and date-times by value.
+        '''
+        numbers = [
+            Decimal('-1E+30'), -1234, -123, Decimal('-0.5'), 0,
+            Decimal('1E-30'), Decimal('0.5'), 1, Decimal('1.05'), 10, 123,
+            1234, 10 ** 40]
+        dates = [date(1, 1, 1), date(1969, 12, 31), date(2018, 3, 1)]
+        dts = [
+            Literal('2018-03-01T12:00:00+02:00', datatype=XSD.dateTime),
+            Literal('2018-03-01T10:00:01Z', datatype=XSD.dateTime),
+            Literal('2018-03-01T11:00:00', datatype=XSD.dateTime),
+            Literal(datetime(2019, 1, 1))]
+        for values in numbers, dates, dts:
+            keys = [term_codec.value_key(Literal(v)) for v in values]
+            assert sorted(keys) == keys
+            assert len(set(keys)) == len(keys)
+            assert len({k[:1] for k in keys}) == 1
+
+        assert term_codec.value_key(Literal(1)) == term_codec.value_key(
+                Literal('1.0', datatype=XSD.decimal))
+        assert term_codec.value_key(Literal(-1)) == term_codec.value_key(
+                Literal('-01', datatype=XSD.long))
+
+
+    def test_value_key_unsupported(self):
+        '''
+        Test terms that have no value key.
+        '''
+        for term in (
+                URIRef('urn:a'), Literal('12'), Literal(True),
+                Literal(1.5), Literal('1.5', datatype=XSD.integer),
+                Literal('x', datatype=XSD.dateTime)):
+            assert term_codec.value_key(term) is None
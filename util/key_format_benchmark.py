@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+import sys
+sys.path.append('.')
+
+from os import path
+from tempfile import TemporaryDirectory
+from timeit import timeit
+
+from rdflib import URIRef
+
+from lakesuperior.store.ldp_rs.lmdb_store import LmdbStore, TxnManager
+
+'''
+Compare `_lookup_1bound` throughput with the fixed-width and the
+separator-joined triple key formats.
+
+The store holds one subject with `n` triples, `n` subjects sharing the same
+predicate and object, and `n` subjects pointing to the same object through
+different predicates, so that each of the `s:po`, `p:so` and `o:sp` indices
+has one key with `n` values. Only the index lookups are timed, not the term
+conversion.
+'''
+
+default_n = 100000
+rounds = 10
+
+sys.stdout.write('How many values per key? [{}] >'.format(default_n))
+choice = input().lower()
+n = int(choice) if choice else default_n
+
+s = URIRef('urn:bench:s')
+p = URIRef('urn:bench:p')
+o = URIRef('urn:bench:o')
+gr = URIRef('urn:bench:g')
+quads = (
+    [(s, URIRef('urn:bench:p{}'.format(i)), URIRef('urn:bench:o{}'.format(i)),
+        gr) for i in range(n)]
+    + [(URIRef('urn:bench:s{}'.format(i)), p, URIRef('urn:bench:p_o'), gr)
+        for i in range(n)]
+    + [(URIRef('urn:bench:o_s{}'.format(i)), URIRef(
+        'urn:bench:o_p{}'.format(i)), o, gr) for i in range(n)]
+)
+
+print('{:<12}{:>12}{:>12}{:>12}'.format(
+    'Format', 's:po (s)', 'p:so (s)', 'o:sp (s)'))
+for key_format in ('separator', 'fixed'):
+    with TemporaryDirectory() as tmpdir:
+        store = LmdbStore(
+                path.join(tmpdir, 'bench'), config={'key_format': key_format})
+        with TxnManager(store, True):
+            store.addN(quads)
+
+        times = []
+        with TxnManager(store):
+            for label, term in (('s', s), ('p', p), ('o', o)):
+                times.append(timeit(
+                        lambda: sum(1 for _ in store._lookup_1bound(
+                            label, term)),
+                        number=rounds) / rounds)
+        store.close()
+
+    print('{:<12}{:>12.4f}{:>12.4f}{:>12.4f}'.format(key_format, *times))
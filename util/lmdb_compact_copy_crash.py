@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+import os
+import subprocess
+import sys
+
+from tempfile import TemporaryDirectory
+
+import lmdb
+
+'''
+Reproduce the crash of LMDB's compacting copy on `dupfixed` databases.
+
+`Environment.copy(compact=True)` crashes the interpreter with a segmentation
+fault when a `dupsort` + `dupfixed` database has a key with more values than
+fit in one page (about 500 8-byte values with 4 Kb pages), with or without a
+`txn` argument. The lookup indices of `LmdbStore` are such databases, with
+one key per term, so `LmdbStore.compact` and `LmdbStore.backup` copy the
+databases record by record instead (see `LmdbStore._copy_env`).
+
+Each case runs in a child process, so that a crash can be reported. Observed
+with py-lmdb 3.0.0 and LMDB 0.9.36:
+
+    dupsort,    1000 values, compact copy:         ok
+    dupsort,    1000 values, compact copy in txn:  ok
+    dupfixed,    100 values, compact copy:         ok
+    dupfixed,   1000 values, compact copy:         crashed (signal 11)
+    dupfixed,   1000 values, compact copy in txn:  crashed (signal 11)
+'''
+
+cases = (
+    ('dupsort', 1000, False),
+    ('dupsort', 1000, True),
+    ('dupfixed', 100, False),
+    ('dupfixed', 1000, False),
+    ('dupfixed', 1000, True),
+)
+
+
+def copy(path, dupfixed, n, in_txn):
+    '''
+    Write `n` values under one key and make a compacting copy.
+    '''
+    env = lmdb.open(os.path.join(path, 'src'), subdir=False, max_dbs=1)
+    db = env.open_db(b'db', dupsort=True, dupfixed=dupfixed)
+    with env.begin(write=True) as txn:
+        for i in range(n):
+            txn.put(b'key', i.to_bytes(8, 'big'), db=db)
+    dest = os.path.join(path, 'dest')
+    if in_txn:
+        with env.begin() as txn:
+            env.copy(dest, compact=True, txn=txn)
+    else:
+        env.copy(dest, compact=True)
+
+
+if len(sys.argv) > 1:
+    # Child process.
+    copy(sys.argv[1], sys.argv[2] == 'dupfixed', int(sys.argv[3]),
+            sys.argv[4] == 'txn')
+    sys.exit()
+
+print('py-lmdb {}, LMDB {}'.format(
+    lmdb.__version__, '.'.join(str(v) for v in lmdb.version())))
+for flags, n, in_txn in cases:
+    with TemporaryDirectory() as path:
+        proc = subprocess.run([
+            sys.executable, __file__, path, flags, str(n),
+            'txn' if in_txn else 'notxn'])
+    if proc.returncode < 0:
+        result = 'crashed (signal {})'.format(-proc.returncode)
+    elif proc.returncode:
+        result = 'failed (exit status {})'.format(proc.returncode)
+    else:
+        result = 'ok'
+    print('{:9} {:6} values, compact copy{:9} {}'.format(
+        flags + ',', n, ' in txn:' if in_txn else ':', result))
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+import sys
+sys.path.append('.')
+
+from os import path
+from tempfile import TemporaryDirectory
+from time import time
+
+from rdflib import URIRef
+
+from lakesuperior.store.ldp_rs.lmdb_store import LmdbStore, TxnManager
+
+'''
+Compare ingest throughput with the writable LMDB environment profiles.
+
+Each transaction adds a small resource, similar to what a single LDP request
+writes, so that the per-commit cost dominates. The `fast-ingest` time includes
+a final checkpoint.
+'''
+
+default_n = 2000
+triples_per_txn = 20
+
+sys.stdout.write('How many transactions? [{}] >'.format(default_n))
+choice = input().lower()
+n = int(choice) if choice else default_n
+
+print('{:<14}{:>10}{:>12}{:>14}'.format(
+    'Profile', 'Time (s)', 'Txn/s', 'Triples/s'))
+for profile in ('safe', 'fast-ingest'):
+    with TemporaryDirectory() as tmpdir:
+        store = LmdbStore(
+                path.join(tmpdir, 'bench'), config={'lmdb_profile': profile})
+        start = time()
+        for i in range(n):
+            s = URIRef('urn:bench:s{}'.format(i))
+            gr = URIRef('urn:bench:g{}'.format(i))
+            with TxnManager(store, True):
+                store.addN(
+                        (s, URIRef('urn:bench:p{}'.format(j)),
+                            URIRef('urn:bench:o{}'.format(j)), gr)
+                        for j in range(triples_per_txn))
+        store.checkpoint()
+        elapsed = time() - start
+        store.close()
+
+    print('{:<14}{:>10.2f}{:>12.0f}{:>14.0f}'.format(
+        profile, elapsed, n / elapsed, n * triples_per_txn / elapsed))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+import sys
+sys.path.append('.')
+
+from hashlib import sha1
+from os import path
+from tempfile import TemporaryDirectory
+from timeit import timeit
+
+import arrow
+import lmdb
+
+from rdflib import Literal, URIRef
+from rdflib.namespace import XSD
+from rdflib.store import NodePickler
+
+from lakesuperior.store.ldp_rs import term_codec
+from util.generators import random_utf8_string
+
+'''
+Compare the binary term serialization with the legacy RDFLib pickles.
+
+The terms are modeled after the data set used by `benchmark.py`: repository
+URIs, external URIs, 64-character random strings, plus some typed and
+language-tagged literals.
+
+The size comparison writes the serialized terms to an LMDB database laid out
+like `t:st` and their hashes to one laid out like `th:t`.
+'''
+
+default_n = 100000
+
+sys.stdout.write('How many terms? [{}] >'.format(default_n))
+choice = input().lower()
+n = int(choice) if choice else default_n
+
+terms = []
+for i in range(n):
+    mod = i % 10
+    if mod < 3:
+        terms.append(URIRef('info:fcres/pomegranate/{}'.format(i)))
+    elif mod < 5:
+        terms.append(URIRef('http://exmple.edu/res/{}'.format(i)))
+    elif mod < 8:
+        terms.append(Literal(random_utf8_string(64)))
+    elif mod == 8:
+        terms.append(Literal(arrow.utcnow().shift(seconds=i).isoformat(),
+            datatype=XSD.dateTime))
+    else:
+        terms.append(Literal(random_utf8_string(16), lang='en'))
+
+pickler = NodePickler()
+codecs = (
+    ('pickle', pickler.dumps, pickler.loads),
+    ('binary', term_codec.dumps, term_codec.loads),
+)
+
+
+def db_size(dumps):
+    '''
+    Store all terms and their hashes and return the database size in bytes.
+    '''
+    with TemporaryDirectory() as tmpdir:
+        env = lmdb.open(path.join(tmpdir, 'bench'), subdir=False,
+                map_size=1024 ** 3, max_dbs=2)
+        t_db = env.open_db(b't:st')
+        th_db = env.open_db(b'th:t')
+        with env.begin(write=True) as txn:
+            for i, term in enumerate(terms):
+                key = i.to_bytes(5, 'big')
+                st = dumps(term)
+                txn.put(key, st, db=t_db, append=True)
+                txn.put(sha1(st).digest(), key, db=th_db)
+        size = (env.info()['last_pgno'] + 1) * env.stat()['psize']
+        env.close()
+
+    return size
+
+
+print('{:<8}{:>14}{:>14}{:>14}{:>14}'.format(
+        'Format', 'Encode (s)', 'Decode (s)', 'Avg. size (b)',
+        'DB size (Kb)'))
+for label, dumps, loads in codecs:
+    serialized = [dumps(t) for t in terms]
+    enc_time = timeit(lambda: [dumps(t) for t in terms], number=1)
+    dec_time = timeit(lambda: [loads(st) for st in serialized], number=1)
+    avg_size = sum(len(st) for st in serialized) / n
+    print('{:<8}{:>14.3f}{:>14.3f}{:>14.1f}{:>14}'.format(
+            label, enc_time, dec_time, avg_size, db_size(dumps) // 1024))